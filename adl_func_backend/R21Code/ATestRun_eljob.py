@@ -7,6 +7,12 @@ parser = optparse.OptionParser()
 parser.add_option( '-s', '--submission-dir', dest = 'submission_dir',
                    action = 'store', type = 'string', default = 'submitDir',
                    help = 'Submission directory for EventLoop' )
+parser.add_option( '--skip-events', dest = 'skip_events',
+                   action = 'store', type = 'int', default = 0,
+                   help = 'Number of events to skip at the start of the input' )
+parser.add_option( '--max-events', dest = 'max_events',
+                   action = 'store', type = 'int', default = -1,
+                   help = 'Maximum number of events to process (-1 for all of them)' )
 ( options, args ) = parser.parse_args()
 
 # Set up (Py)ROOT.
@@ -25,7 +31,10 @@ sh.printContent()
 # Create an EventLoop job.
 job = ROOT.EL.Job()
 job.sampleHandler( sh )
-# job.options().setDouble( ROOT.EL.Job.optMaxEvents, 500 )
+if options.skip_events > 0:
+    job.options().setDouble( ROOT.EL.Job.optSkipEvents, options.skip_events )
+if options.max_events >= 0:
+    job.options().setDouble( ROOT.EL.Job.optMaxEvents, options.max_events )
 
 # Commented out for now because it really slows things down. Uncomment and change
 # the bank to be Analysis_NOSYS in query.cxx and it will work again.
@@ -48,12 +57,33 @@ job.sampleHandler( sh )
 from AnaAlgorithm.DualUseConfig import createAlgorithm
 alg = createAlgorithm ( 'query', 'AnalysisAlg' )
 
-# later on we'll add some configuration options for our algorithm that go here
+# The values of the query's parameters for this run, if it has any
+import json
+parameters = {}
+if os.path.exists( 'parameters.json' ):
+    with open( 'parameters.json' ) as f:
+        parameters = json.load( f )
+
+# The generic query algorithm is given the plan of the query to run, and looks its
+# parameters up by name. Otherwise each parameter is a property of the algorithm.
+if os.path.exists( 'plan.txt' ):
+    with open( 'plan.txt' ) as f:
+        alg.plan = f.read()
+    alg.parameters = ' '.join( '{0}={1!r}'.format( name, float( value ) ) for name, value in parameters.items() )
+else:
+    for name, value in parameters.items():
+        setattr( alg, name, value )
 
 # Add our algorithm to the job
 job.algsAdd( alg )
 job.outputAdd (ROOT.EL.OutputStream ('ANALYSIS'))
 
-# Run the job using the direct driver.
-driver = ROOT.EL.DirectDriver()
+# Run the job with the driver picked when the query was translated. The direct driver runs
+# everything in this process. PROOF-Lite runs several local processes and merges the output.
+driver_name = "{{driver}}"
+if driver_name == "proof":
+    driver = ROOT.EL.ProofDriver()
+    driver.numWorkers = int("{{workers}}")
+else:
+    driver = ROOT.EL.DirectDriver()
 driver.submit( job, options.submission_dir )
\ No newline at end of file
@@ -0,0 +1,287 @@
+#include <AsgTools/MessageCheck.h>
+#include <analysis/query.h>
+
+#include <xAODJet/JetContainer.h>
+
+#include <TTree.h>
+
+#include <algorithm>
+#include <cmath>
+#include <map>
+#include <sstream>
+
+namespace {
+  // The methods of a jet a plan can call (the "acc" words). This must match object_accessors
+  // in query_plan.py.
+  const std::vector<std::string> accessor_names = {"pt", "eta", "phi", "m", "e", "rapidity", "px", "py", "pz"};
+
+  double call_accessor (size_t index, const xAOD::Jet& jet)
+  {
+    switch (index) {
+    case 0: return jet.pt();
+    case 1: return jet.eta();
+    case 2: return jet.phi();
+    case 3: return jet.m();
+    case 4: return jet.e();
+    case 5: return jet.rapidity();
+    case 6: return jet.px();
+    case 7: return jet.py();
+    default: return jet.pz();
+    }
+  }
+
+  // The operators of an expression, by their word in the plan
+  const std::map<std::string, query::plan_op::code_t> operator_codes = {
+    {"add", query::plan_op::ADD}, {"sub", query::plan_op::SUB}, {"mul", query::plan_op::MUL}, {"div", query::plan_op::DIV},
+    {"lt", query::plan_op::LT}, {"le", query::plan_op::LE}, {"gt", query::plan_op::GT}, {"ge", query::plan_op::GE},
+    {"eq", query::plan_op::EQ}, {"ne", query::plan_op::NE}, {"and", query::plan_op::AND}, {"or", query::plan_op::OR},
+    {"neg", query::plan_op::NEG}, {"not", query::plan_op::NOT}, {"abs", query::plan_op::ABS}
+  };
+
+  // The types a column can have, by their name in the plan
+  const std::map<std::string, query::column_t::type_t> column_types = {
+    {"double", query::column_t::DOUBLE}, {"float", query::column_t::FLOAT},
+    {"int", query::column_t::INT}, {"bool", query::column_t::BOOL}
+  };
+
+  // How many expressions follow an operator
+  int n_operands (query::plan_op::code_t code)
+  {
+    if (code == query::plan_op::NUMBER || code == query::plan_op::ACCESSOR || code == query::plan_op::ATTRIBUTE) {
+      return 0;
+    }
+    if (code == query::plan_op::NEG || code == query::plan_op::NOT || code == query::plan_op::ABS) {
+      return 1;
+    }
+    return 2;
+  }
+
+  // Return the position just after the expression that starts at pos
+  size_t skip (const std::vector<query::plan_op>& expr, size_t pos)
+  {
+    int n = n_operands (expr[pos++].code);
+    for (int i = 0; i < n; i++) {
+      pos = skip (expr, pos);
+    }
+    return pos;
+  }
+}
+
+query :: query (const std::string& name,
+                                  ISvcLocator *pSvcLocator)
+    : EL::AnaAlgorithm (name, pSvcLocator),
+      m_tree (0)
+{
+  // The plan, and the values of its parameters, are set by the job script
+  declareProperty ("plan", m_plan, "The query plan to run");
+  declareProperty ("parameters", m_parameters, "The values of the query parameters");
+}
+
+StatusCode query :: initialize ()
+{
+  // Read the plan
+  std::istringstream plan (m_plan);
+  std::string line;
+  while (std::getline (plan, line)) {
+    std::istringstream in (line);
+    std::string what;
+    if (!(in >> what)) {
+      continue;
+    }
+    if (what == "collection") {
+      std::string collection_type;
+      in >> collection_type >> m_collection_name;
+      if (collection_type != "Jets") {
+        ANA_MSG_ERROR ("The generic query can't loop over " << collection_type);
+        return StatusCode::FAILURE;
+      }
+    } else if (what == "tree") {
+      in >> m_tree_name;
+    } else if (what == "filter") {
+      m_filters.push_back (std::vector<plan_op> ());
+      ANA_CHECK (parse_expr (in, m_filters.back ()));
+    } else if (what == "column") {
+      column_t column;
+      std::string type_name;
+      in >> column.name >> type_name;
+      auto type = column_types.find (type_name);
+      if (type == column_types.end ()) {
+        ANA_MSG_ERROR ("Unknown type for column " << column.name << ": " << type_name);
+        return StatusCode::FAILURE;
+      }
+      column.type = type->second;
+      ANA_CHECK (parse_expr (in, column.expr));
+      m_columns.push_back (column);
+    } else {
+      ANA_MSG_ERROR ("Unknown statement in the query plan: " << line);
+      return StatusCode::FAILURE;
+    }
+  }
+  if (m_collection_name.empty () || m_tree_name.empty ()) {
+    ANA_MSG_ERROR ("The query plan needs a collection and a tree");
+    return StatusCode::FAILURE;
+  }
+
+  // Book the tree, with a branch for each column
+  ANA_CHECK (book (TTree (m_tree_name.c_str (), "My analysis ntuple")));
+  m_tree = tree (m_tree_name);
+  for (auto&& c : m_columns) {
+    switch (c.type) {
+    case column_t::DOUBLE: m_tree->Branch (c.name.c_str (), &c.double_value); break;
+    case column_t::FLOAT: m_tree->Branch (c.name.c_str (), &c.float_value); break;
+    case column_t::INT: m_tree->Branch (c.name.c_str (), &c.int_value); break;
+    default: m_tree->Branch (c.name.c_str (), &c.bool_value); break;
+    }
+  }
+
+  return StatusCode::SUCCESS;
+}
+
+StatusCode query :: parse_expr (std::istream& in, std::vector<plan_op>& expr)
+{
+  std::string word;
+  if (!(in >> word)) {
+    ANA_MSG_ERROR ("The query plan has an expression that is not complete");
+    return StatusCode::FAILURE;
+  }
+
+  plan_op op;
+  op.value = 0.0;
+  op.index = 0;
+  if (word == "num") {
+    op.code = plan_op::NUMBER;
+    in >> op.value;
+  } else if (word == "par") {
+    // The value of a parameter is fixed for the whole run
+    std::string name;
+    in >> name;
+    std::istringstream parameters (m_parameters);
+    std::string p;
+    bool found = false;
+    while (parameters >> p) {
+      auto eq = p.find ('=');
+      if (eq != std::string::npos && p.substr (0, eq) == name) {
+        op.value = std::stod (p.substr (eq + 1));
+        found = true;
+      }
+    }
+    if (!found) {
+      ANA_MSG_ERROR ("No value was given for the query parameter " << name);
+      return StatusCode::FAILURE;
+    }
+    op.code = plan_op::NUMBER;
+  } else if (word == "acc") {
+    std::string name;
+    in >> name;
+    op.code = plan_op::ACCESSOR;
+    op.index = std::find (accessor_names.begin (), accessor_names.end (), name) - accessor_names.begin ();
+    if (op.index == accessor_names.size ()) {
+      ANA_MSG_ERROR ("The generic query doesn't know the method " << name);
+      return StatusCode::FAILURE;
+    }
+  } else if (word == "attr") {
+    // Looking up an attribute by name is slow, so an accessor is made once for each one.
+    std::string name;
+    in >> name;
+    op.code = plan_op::ATTRIBUTE;
+    op.index = std::find (m_attribute_names.begin (), m_attribute_names.end (), name) - m_attribute_names.begin ();
+    if (op.index == m_attribute_names.size ()) {
+      m_attribute_names.push_back (name);
+      m_attributes.push_back (SG::AuxElement::ConstAccessor<float> (name));
+    }
+  } else {
+    auto code = operator_codes.find (word);
+    if (code == operator_codes.end ()) {
+      ANA_MSG_ERROR ("Unknown word in a query plan expression: " << word);
+      return StatusCode::FAILURE;
+    }
+    op.code = code->second;
+  }
+
+  expr.push_back (op);
+  for (int i = 0; i < n_operands (op.code); i++) {
+    ANA_CHECK (parse_expr (in, expr));
+  }
+  return StatusCode::SUCCESS;
+}
+
+double query :: eval (const std::vector<plan_op>& expr, size_t& pos, const xAOD::Jet& jet) const
+{
+  const plan_op& op = expr[pos++];
+  switch (op.code) {
+  case plan_op::NUMBER: return op.value;
+  case plan_op::ACCESSOR: return call_accessor (op.index, jet);
+  case plan_op::ATTRIBUTE: return m_attributes[op.index] (jet);
+  case plan_op::NEG: return -eval (expr, pos, jet);
+  case plan_op::NOT: return eval (expr, pos, jet) == 0.0 ? 1.0 : 0.0;
+  case plan_op::ABS: return std::abs (eval (expr, pos, jet));
+  case plan_op::AND:
+    if (eval (expr, pos, jet) == 0.0) {
+      pos = skip (expr, pos);
+      return 0.0;
+    }
+    return eval (expr, pos, jet) != 0.0 ? 1.0 : 0.0;
+  case plan_op::OR:
+    if (eval (expr, pos, jet) != 0.0) {
+      pos = skip (expr, pos);
+      return 1.0;
+    }
+    return eval (expr, pos, jet) != 0.0 ? 1.0 : 0.0;
+  default:
+    break;
+  }
+
+  double left = eval (expr, pos, jet);
+  double right = eval (expr, pos, jet);
+  switch (op.code) {
+  case plan_op::ADD: return left + right;
+  case plan_op::SUB: return left - right;
+  case plan_op::MUL: return left * right;
+  case plan_op::DIV: return left / right;
+  case plan_op::LT: return left < right ? 1.0 : 0.0;
+  case plan_op::LE: return left <= right ? 1.0 : 0.0;
+  case plan_op::GT: return left > right ? 1.0 : 0.0;
+  case plan_op::GE: return left >= right ? 1.0 : 0.0;
+  case plan_op::EQ: return left == right ? 1.0 : 0.0;
+  default: return left != right ? 1.0 : 0.0;
+  }
+}
+
+StatusCode query :: execute ()
+{
+  const xAOD::JetContainer* jets = 0;
+  ANA_CHECK (evtStore()->retrieve (jets, m_collection_name));
+
+  for (auto&& jet : *jets) {
+    bool pass = true;
+    for (auto&& f : m_filters) {
+      size_t pos = 0;
+      if (eval (f, pos, *jet) == 0.0) {
+        pass = false;
+        break;
+      }
+    }
+    if (!pass) {
+      continue;
+    }
+
+    for (auto&& c : m_columns) {
+      size_t pos = 0;
+      double value = eval (c.expr, pos, *jet);
+      switch (c.type) {
+      case column_t::DOUBLE: c.double_value = value; break;
+      case column_t::FLOAT: c.float_value = value; break;
+      case column_t::INT: c.int_value = value; break;
+      default: c.bool_value = value != 0.0; break;
+      }
+    }
+    m_tree->Fill ();
+  }
+
+  return StatusCode::SUCCESS;
+}
+
+StatusCode query :: finalize ()
+{
+  return StatusCode::SUCCESS;
+}
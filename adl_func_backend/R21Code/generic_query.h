@@ -0,0 +1,74 @@
+#ifndef analysis_query_H
+#define analysis_query_H
+
+#include <AnaAlgorithm/AnaAlgorithm.h>
+#include <AthContainers/AuxElement.h>
+#include <xAODJet/Jet.h>
+
+#include <string>
+#include <vector>
+
+class TTree;
+
+// The generic query algorithm. Rather than running code written for one query, it runs
+// the query plan it is given (see query_plan.py). It is built once and used for any query
+// that can be planned.
+class query : public EL::AnaAlgorithm
+{
+public:
+  // this is a standard algorithm constructor
+  query (const std::string& name, ISvcLocator* pSvcLocator);
+
+  // these are the functions inherited from Algorithm
+  virtual StatusCode initialize () override;
+  virtual StatusCode execute () override;
+  virtual StatusCode finalize () override;
+
+  // One step of an expression. An expression is stored in prefix order.
+  struct plan_op
+  {
+    enum code_t { NUMBER, ACCESSOR, ATTRIBUTE, ADD, SUB, MUL, DIV, LT, LE, GT, GE, EQ, NE, AND, OR, NEG, NOT, ABS };
+    code_t code;
+    double value;
+    size_t index;
+  };
+
+  // A column of the tree. It is written out with the type the compiled query would use, so the
+  // output is the same either way.
+  struct column_t
+  {
+    enum type_t { DOUBLE, FLOAT, INT, BOOL };
+    std::string name;
+    type_t type;
+    std::vector<plan_op> expr;
+    double double_value;
+    float float_value;
+    int int_value;
+    bool bool_value;
+  };
+
+private:
+  // Read an expression from the plan
+  StatusCode parse_expr (std::istream& in, std::vector<plan_op>& expr);
+
+  // Evaluate the expression that starts at pos, leaving pos just after it
+  double eval (const std::vector<plan_op>& expr, size_t& pos, const xAOD::Jet& jet) const;
+
+  // The text of the plan, and the values of the query parameters ("name=value name=value")
+  std::string m_plan;
+  std::string m_parameters;
+
+  // The plan, once it has been read
+  std::string m_collection_name; //!
+  std::string m_tree_name; //!
+  std::vector<std::vector<plan_op>> m_filters; //!
+  std::vector<column_t> m_columns; //!
+
+  // The attributes used by the plan, looked up once
+  std::vector<std::string> m_attribute_names; //!
+  std::vector<SG::AuxElement::ConstAccessor<float>> m_attributes; //!
+
+  TTree* m_tree; //!
+};
+
+#endif
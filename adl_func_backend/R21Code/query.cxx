@@ -1,10 +1,6 @@
 #include <AsgTools/MessageCheck.h>
 #include <analysis/query.h>
 
-{% for i in include_files %}
-#include "{{i}}"
-{% endfor %}
-
 #include <TTree.h>
 
 query :: query (const std::string& name,
@@ -16,6 +12,10 @@ query :: query (const std::string& name,
   // declare all properties for your algorithm.  Note that things like
   // resetting statistics variables or booking histograms should
   // rather go into the initialize() function.
+
+  {% for l in constructor_code %}
+  {{l}}
+  {% endfor %}
 }
 
 StatusCode query :: initialize ()
@@ -58,5 +58,10 @@ StatusCode query :: finalize ()
   // Most of the time you want to do your post-processing on the
   // submission node after all your histogram outputs have been
   // merged.
+
+  {% for l in finalize_code %}
+  {{l}}
+  {% endfor %}
+
   return StatusCode::SUCCESS;
 }
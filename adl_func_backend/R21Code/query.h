@@ -3,6 +3,11 @@
 
 #include <AnaAlgorithm/AnaAlgorithm.h>
 
+// Everything the query code uses (the class level variables too)
+{% for i in include_files %}
+#include <{{i}}>
+{% endfor %}
+
 class query : public EL::AnaAlgorithm
 {
 public:
@@ -7,19 +7,75 @@ set -e
 # Meant to be invokved in an ATLAS R21 analysis container.
 # This follows the tutorial from https://atlassoftwaredocs.web.cern.ch/ABtutorial/release_setup/
 
-# Setup and config
-source /home/atlas/release_setup.sh
+# Setup and config. A warm container from a pool has already done this once and saved the
+# resulting environment, which is much faster to restore than to re-create.
+if [ -e /tmp/release_env.sh ]; then
+  source /tmp/release_env.sh
+else
+  source /home/atlas/release_setup.sh
+fi
 
 # Remember where we are and the script location.
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 local=`pwd`
 
-# Create a release directory
-mkdir rel
-cd rel
+# If a build cache is mounted at /build_cache, the build is done there, in a directory named by
+# a hash of the generated C++ and the release. A query that renders to identical code can then
+# skip cmake and make and go straight to running.
+#
+# If instead a workspace is mounted at /workspace, a single build tree is kept there for the
+# release. Once it has been configured, only the query files are swapped in and make is re-run,
+# which recompiles the query and relinks. The workspace lock is held until the run is done so
+# another query can't replace the library out from under this one.
+build_hash={{build_hash}}
+if [ -d /build_cache ]; then
+  rel_dir=/build_cache/$build_hash
+  exec 8>/build_cache/$build_hash.lock
+  flock 8
+elif [ -d /workspace ]; then
+  rel_dir=/workspace/rel
+  exec 9>/workspace/build.lock
+  flock 9
+else
+  rel_dir=$local/rel
+fi
+
+# If a compiler cache is mounted at /ccache, use it (if the release has ccache). It keeps object
+# files across containers, so code that has been compiled before - by any query - isn't again.
+# A precompiled header (with a CMake that can make one) defines macros of its own, which ccache
+# must be told are fine. The launcher is always given, so a tree configured with it can be
+# configured without it again.
+launcher=""
+if [ -d /ccache ] && command -v ccache > /dev/null; then
+  export CCACHE_DIR=/ccache
+  export CCACHE_SLOPPINESS=pch_defines,time_macros
+  launcher=ccache
+fi
+cmake_args="-DCMAKE_BUILD_TYPE=Release -DCMAKE_CXX_COMPILER_LAUNCHER=$launcher"
+
+# Copy a file, but only if it is different - leaves the timestamp alone so make won't rebuild
+# things that have not changed.
+update_file() {
+  if ! cmp -s $1 $2; then
+    cp $1 $2
+  fi
+}
+
+if [ -e $rel_dir/build/.build_complete ]; then
+  echo "Using the cached build $rel_dir"
+else
+
+if [ -e $rel_dir/build/.configured ]; then
+  echo "Reusing the configured build tree $rel_dir"
+  cd $rel_dir/source
+else
+
+# Create a release directory (clearing out any half finished build)
+rm -rf $rel_dir
+mkdir -p $rel_dir
+cd $rel_dir
 mkdir source
 mkdir build
-mkdir run
 
 # Create cmake infrastructure
 cat > source/CMakeLists.txt << 'EOF'
@@ -87,15 +143,6 @@ mkdir analysis/src
 mkdir analysis/src/components
 mkdir analysis/share
 
-# Create the basics for cmake
-cp $DIR/package_CMakeLists.txt analysis/CMakeLists.txt
-
-# Next, copy over the algorithm. The source directory needs to be correctly mounted.
-cp $DIR/query.h analysis/analysis
-cp $DIR/query.cxx analysis/Root
-cp $DIR/ATestRun_eljob.py analysis/share
-chmod +x analysis/share/ATestRun_eljob.py
-
 cat > analysis/analysis/queryDict.h << EOF
 #ifndef analysis_query_DICT_H
 #define analysis_query_DICT_H
@@ -119,21 +166,68 @@ cat > analysis/analysis/selection.xml << EOF
 </lcgdict>
 EOF
 
+fi
+
+# Create the basics for cmake
+update_file $DIR/package_CMakeLists.txt analysis/CMakeLists.txt
+
+# Next, copy over the algorithm. The source directory needs to be correctly mounted.
+update_file $DIR/query.h analysis/analysis/query.h
+update_file $DIR/query.cxx analysis/Root/query.cxx
+update_file $DIR/ATestRun_eljob.py analysis/share/ATestRun_eljob.py
+chmod +x analysis/share/ATestRun_eljob.py
 
-# Do the build
+# Do the build, optimized and using all the cores. Configure only if this tree hasn't been, or was
+# configured with other arguments (.configured holds them) - make re-runs cmake on its own if the
+# package CMakeLists.txt changed.
 cd ../build
-cmake ../source
-make
-source x86_64-slc6-gcc62-opt/setup.sh
+if [ ! -e .configured ] || [ "$(cat .configured)" != "$cmake_args" ]; then
+  cmake $cmake_args ../source
+  echo "$cmake_args" > .configured
+fi
+make -j$(nproc)
+if [ -d /build_cache ]; then
+  touch .build_complete
+fi
+
+fi
+
+# Release the build cache lock - nothing changes in the build area from here on.
+if [ -d /build_cache ]; then
+  flock -u 8
+fi
+source $rel_dir/build/x86_64-slc6-gcc62-opt/setup.sh
 
-# Do the run.
-#ATestRun_eljob.py --submission-dir=bogus
+# Do the run. This happens outside the build area so the build can be shared.
+mkdir -p $local/run
+cd $local/run
 if [ -e $DIR/filelist.txt ]; then
    cp $DIR/filelist.txt .
 else
    cp $local/filelist.txt .
 fi
-python ../source/analysis/share/ATestRun_eljob.py --submission-dir=bogus
+
+# The values of the query parameters for this run. Ones written for just this run take precedence.
+if [ -e $local/parameters.json ]; then
+  cp $local/parameters.json .
+elif [ -e $DIR/parameters.json ]; then
+  cp $DIR/parameters.json .
+fi
+
+# The plan, if the query is run by the generic query algorithm
+if [ -e $DIR/plan.txt ]; then
+  cp $DIR/plan.txt .
+else
+  rm -f plan.txt
+fi
+
+# If only part of the input is to be processed, the range of events is in eventrange.txt
+event_args=""
+if [ -e $local/eventrange.txt ]; then
+  read skip_events max_events < $local/eventrange.txt
+  event_args="--skip-events=$skip_events --max-events=$max_events"
+fi
+python $DIR/ATestRun_eljob.py --submission-dir=bogus $event_args
 
 # Place the output file where it belongs
 if [ -z "$1" ]; then
@@ -147,3 +241,8 @@ else
   fi
 fi
 $cmd ./bogus/data-ANALYSIS/ANALYSIS.root $destination
+
+# Histograms are written to a file of their own
+if [ -e ./bogus/hist-ANALYSIS.root ]; then
+  $cmd ./bogus/hist-ANALYSIS.root $destination
+fi
@@ -1,14 +1,40 @@
 # Stuff to calculate a hash of an ast
 import ast
 import hashlib
+import json
+from typing import Dict, Iterable, Optional
+
+from adl_func_client.query_ast import value_hash
 
 def calc_ast_hash (a : ast.AST) -> str:
     '''Calculate the hash for an AST.
     
     This hash takes into account everything about the ast,
-    including the input datasets
+    including the input datasets. Query nodes cache their hash,
+    so re-hashing a query, or one built on top of it, is cheap.
     '''
-    
-    b = bytearray()
-    b.extend(map(ord, ast.dump(a)))
-    return hashlib.md5(b).hexdigest()
+    return value_hash(a)
+
+def calc_code_hash (a : ast.AST) -> str:
+    '''Calculate the hash for the query in an AST.
+
+    The datasets the query runs on, and the values of its parameters, are left out, so
+    the same query run against different datasets (or with different cuts) has the same
+    hash. Anything built from the query alone (generated code, compiled code) can be
+    shared using this as a key.
+    '''
+    return value_hash(a, abstract_datasets=True)
+
+def calc_data_hash (urls : Iterable[str], parameters : Optional[Dict[str, float]] = None) -> str:
+    '''Calculate the hash for the list of files a query runs over, and the values of its
+    parameters (if it has any).
+
+    The order of the files matters - results come back in file order.
+    '''
+    h = hashlib.md5()
+    for u in urls:
+        h.update(u.encode())
+        h.update(b'\0')
+    if parameters:
+        h.update(json.dumps(parameters, sort_keys=True).encode())
+    return h.hexdigest()
@@ -0,0 +1,90 @@
+# Put a query AST into a canonical form, so that queries that differ only cosmetically
+# end up as identical ASTs (and so hash the same).
+import ast
+import copy
+from typing import Dict, List, Optional
+
+from adl_func_client.query_ast import Select, Where
+from adl_func_client.util_ast import lambda_build
+from adl_func_backend.cpplib.cpp_ast import CPPCodeValue
+
+def _int_value(node: ast.AST) -> Optional[int]:
+    'If this is an integer constant, return its value. Otherwise None.'
+    if isinstance(node, ast.Num) and type(node.n) is int:
+        return node.n
+    return None
+
+def _is_true(node: ast.AST) -> bool:
+    'Is this the constant True?'
+    return isinstance(node, ast.NameConstant) and node.value is True
+
+class canonicalize_ast(ast.NodeTransformer):
+    r'''
+    Re-write an AST into a canonical form. Run this after all the other transformations, just before
+    the AST is translated. It will:
+
+        - Rename every lambda argument by how deeply nested its lambda is (`lambda j: j.pt()` and
+          `lambda jet: jet.pt()` both become `lambda a0: a0.pt()`).
+        - Write integer constants in comparisons as floats (`j.pt() > 30` and `j.pt() > 30.0`). Constants
+          elsewhere are left alone, as integer arithmetic isn't the same in C++.
+        - Remove identity `Select`s (`Select(s, lambda x: x)`) and `Where(s, lambda x: True)`.
+
+    Like the other transformations, the AST is modified in place.
+    '''
+    def __init__(self):
+        self._renames: List[Dict[str, str]] = []
+
+    def _lookup(self, name: str) -> str:
+        'Find the new name for an argument, innermost lambda first. Free names are left alone.'
+        for d in reversed(self._renames):
+            if name in d:
+                return d[name]
+        return name
+
+    def visit_Lambda(self, node: ast.Lambda):
+        depth = len(self._renames)
+        arg_names = [a.arg for a in node.args.args]
+        new_names = [f'a{depth}' if len(arg_names) == 1 else f'a{depth}_{i}' for i in range(len(arg_names))]
+        self._renames.append(dict(zip(arg_names, new_names)))
+        try:
+            body = self.visit(node.body)
+        finally:
+            self._renames.pop()
+        return lambda_build(new_names, body)
+
+    def visit_Name(self, node: ast.Name):
+        return ast.Name(id=self._lookup(node.id), ctx=node.ctx)
+
+    def visit_Call(self, node: ast.Call):
+        self.generic_visit(node)
+
+        # A C++ method call refers to the object it is called against by name.
+        if isinstance(node.func, CPPCodeValue) and node.func.replacement_instance_obj is not None:
+            cpp = copy.copy(node.func)
+            cpp.replacement_instance_obj = (cpp.replacement_instance_obj[0], self._lookup(cpp.replacement_instance_obj[1]))
+            node.func = cpp
+        return node
+
+    def visit_Compare(self, node: ast.Compare):
+        self.generic_visit(node)
+        node.left = self._as_float(node.left)
+        node.comparators = [self._as_float(c) for c in node.comparators]
+        return node
+
+    def _as_float(self, node: ast.AST) -> ast.AST:
+        v = _int_value(node)
+        return node if v is None else ast.Num(n=float(v))
+
+    def visit_Select(self, node: Select):
+        self.generic_visit(node)
+        l = node.selection
+        if isinstance(l, ast.Lambda) and len(l.args.args) == 1 \
+                and isinstance(l.body, ast.Name) and l.body.id == l.args.args[0].arg:
+            return node.source
+        return node
+
+    def visit_Where(self, node: Where):
+        self.generic_visit(node)
+        if isinstance(node.filter, ast.Lambda) and _is_true(node.filter.body):
+            return node.source
+        return node
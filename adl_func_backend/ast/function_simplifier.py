@@ -1,20 +1,13 @@
 # Various node visitors to clean up nested function calls of various types.
-from adl_func_client.query_ast import Select, Where, SelectMany, First
+from adl_func_client.event_dataset import EventDataset
+from adl_func_client.query_ast import QueryNode, QueryParameter, Select, Where, SelectMany, First
 from adl_func_client.util_ast import lambda_body, lambda_body_replace, lambda_unwrap, lambda_call, lambda_build, lambda_is_identity, lambda_test, lambda_is_true
 from adl_func_backend.ast.call_stack import argument_stack, stack_frame
 import copy
 import ast
 
-argument_var_counter = 0
-def arg_name():
-    'Return a unique name that can be used as an argument'
-    global argument_var_counter
-    n = 'arg_{0}'.format(argument_var_counter)
-    argument_var_counter += 1
-    return n
-
-def convolute(ast_g, ast_f):
-    'Return an AST that represents g(f(args))'
+def convolute(ast_g, ast_f, x: str):
+    'Return an AST that represents g(f(args)), with x as the name of the argument'
     #TODO: fix up the ast.Calls to use lambda_call if possible
 
     # Sanity checks. For example, g can have only one input argument (e.g. f's result)
@@ -25,7 +18,6 @@ def convolute(ast_g, ast_f):
     l_g = copy.deepcopy(lambda_unwrap(ast_g))
     l_f = copy.deepcopy(lambda_unwrap(ast_f))
 
-    x = arg_name()
     f_arg = ast.Name(x, ast.Load())
     call_g = ast.Call(l_g, [ast.Call(l_f, [f_arg], [])], [])
 
@@ -36,6 +28,59 @@ def convolute(ast_g, ast_f):
     # Build a new call to nest the functions
     return call_g_lambda
 
+def needs_loop(a: ast.AST) -> bool:
+    'Does evaluating this expression need a loop over some sequence (a LINQ operator or an aggregate)?'
+    for n in ast.walk(a):
+        if isinstance(n, QueryNode) and not isinstance(n, QueryParameter):
+            return True
+        if isinstance(n, ast.Call) and isinstance(n.func, ast.Attribute) and n.func.attr == 'Aggregate':
+            return True
+    return False
+
+def and_terms(a: ast.AST):
+    'Return the list of terms that are and-ed together in an expression (just the expression if it is not an and)'
+    if isinstance(a, ast.BoolOp) and isinstance(a.op, ast.And):
+        return [t for v in a.values for t in and_terms(v)]
+    return [a]
+
+def can_fail(a: ast.AST) -> bool:
+    'Might evaluating this expression fail (a division that might be by zero, or an index that might be out of range)?'
+    for n in ast.walk(a):
+        if isinstance(n, ast.Subscript):
+            return True
+        if isinstance(n, ast.BinOp) and isinstance(n.op, (ast.Div, ast.FloorDiv, ast.Mod)):
+            return True
+    return False
+
+def objects_used(a: ast.AST, arg: str):
+    'Return the things of the lambda argument `arg` (like `e.Jets` or `e.met`) an expression uses, as dumps of their AST'
+    return set(ast.dump(n) for n in ast.walk(a)
+        if isinstance(n, ast.Attribute) and isinstance(n.value, ast.Name) and n.value.id == arg)
+
+def cheap_terms_first(filter: ast.Lambda) -> ast.Lambda:
+    r'''
+    If the filter is a number of terms and-ed together, reorder them so the terms that do not
+    need a loop are tested first. As the and is short-circuited, the loops are then only run
+    when the cheap terms have passed. Otherwise the terms keep their order.
+
+    A term that might fail is not moved ahead of a term that uses the same things - that term might
+    be there to guard it (e.g. `e.Jets().Count() > 0 and e.Jets()[0].pt() > 30`).
+    '''
+    terms = and_terms(lambda_body(filter))
+    if len(terms) < 2:
+        return filter
+    arg = filter.args.args[0].arg
+    cheap, others = [], []
+    for t in terms:
+        if needs_loop(t) or (can_fail(t) and any(objects_used(t, arg) & objects_used(o, arg) for o in others)):
+            others.append(t)
+        else:
+            cheap.append(t)
+    ordered = cheap + others
+    if all(o is t for o, t in zip(ordered, terms)):
+        return filter
+    return lambda_body_replace(filter, ast.BoolOp(op=ast.And(), values=ordered))
+
 def make_Select(source, selection):
     'Make a select, and return source is selection is an identity'
     return source if lambda_is_identity(selection) else Select(source, selection) 
@@ -49,6 +94,13 @@ class simplify_chained_calls(ast.NodeTransformer):
 
     def __init__(self):
         self._arg_stack = argument_stack()
+        self._arg_index = 0
+
+    def arg_name(self):
+        'Return a unique name that can be used as an argument. Names are numbered from zero for each instance.'
+        n = 'arg_{0}'.format(self._arg_index)
+        self._arg_index += 1
+        return n
 
     def visit_Select_of_Select(self, parent, selection):
         r'''
@@ -63,7 +115,7 @@ class simplify_chained_calls(ast.NodeTransformer):
 
         # Convolute the two functions
         # TODO: should this be generic of just visit?
-        new_selection = self.visit(convolute(func_g, func_f))
+        new_selection = self.visit(convolute(func_g, func_f, self.arg_name()))
 
         # And return the parent select with the new selection function
         return make_Select(parent.source, new_selection)
@@ -124,7 +176,7 @@ class simplify_chained_calls(ast.NodeTransformer):
         func_f = parent.selection
         seq = parent.source
 
-        new_selection = self.generic_visit(convolute(func_g, func_f))
+        new_selection = self.generic_visit(convolute(func_g, func_f, self.arg_name()))
         return self.visit(SelectMany(seq, new_selection))
     
     def visit_SelectMany_of_SelectMany(self, parent, selection):
@@ -181,7 +233,7 @@ class simplify_chained_calls(ast.NodeTransformer):
         func_f = parent.filter
         func_g = filter
 
-        arg = arg_name()
+        arg = self.arg_name()
         return self.visit(Where(parent.source, lambda_build(arg, ast.BoolOp(ast.And(), [lambda_call(arg, func_f), lambda_call(arg, func_g)]))))
 
     def visit_Where_of_Select(self, parent, filter):
@@ -196,7 +248,7 @@ class simplify_chained_calls(ast.NodeTransformer):
         func_g = filter
         seq = parent.source
 
-        w = Where(seq, self.visit(convolute(func_g, func_f)))
+        w = Where(seq, self.visit(convolute(func_g, func_f, self.arg_name())))
         s = make_Select(w, func_f)
 
         # Recursively visit this mess to see if the Where needs to move further up.
@@ -250,6 +302,9 @@ class simplify_chained_calls(ast.NodeTransformer):
             f = self.visit(node.filter)
             if lambda_is_true(f):
                 return parent_where
+            elif isinstance(parent_where, EventDataset):
+                # Only the terms of a filter on the events are tested one at a time (see `visit_Where_event`).
+                return Where(parent_where, cheap_terms_first(lambda_unwrap(f)))
             else:
                 return Where(parent_where, f)
     
@@ -293,7 +348,7 @@ class simplify_chained_calls(ast.NodeTransformer):
         source = first.source
 
         # Build the select that starts from the source and does the slice.
-        a = arg_name()
+        a = self.arg_name()
         select = make_Select(source, lambda_build(a, ast.Subscript(ast.Name(a, ast.Load()), s, ast.Load())))
 
         return self.visit(First(select))
@@ -2,8 +2,11 @@
 #
 # This is one mechanism to allow for a leaky abstraction.
 import ast
+import copy
 from adl_func_backend.cpplib.cpp_vars import unique_name
-from adl_func_backend.cpplib.cpp_representation import cpp_value
+from adl_func_backend.cpplib.cpp_representation import cpp_value, cpp_variable
+import adl_func_backend.cpplib.cpp_types as ctyp
+from adl_func_backend.xAODlib.util_scope import dependency_scope, top_level_scope
 import adl_func_backend.xAODlib.statement as statements
 
 # The list of methods and the re-write functions for them. Each rewrite function
@@ -26,6 +29,12 @@ class CPPCodeValue (ast.AST):
         # Code that is run once at the start of each "event"
         self.initialization_code = []
 
+        # Variables of the query class, set up once when the job starts (e.g. an accessor for a decoration).
+        # A list of tuples: the string to be replaced by the variable's name in all the code, the C++ type
+        # of the variable, and the lines of code that initialize it. Code that sets up a variable the
+        # same way shares it.
+        self.class_variables = []
+
         # Code that is run when the particular bit of code needs to be invoked (e.g. in the middle of a hot loop).
         # This is invoked in its own scope (between "{" and "}") so there are no variable collisions.
         self.running_code = []
@@ -43,12 +52,21 @@ class CPPCodeValue (ast.AST):
         # in all the code lines above.
         self.result = None
 
+        # If true, the code depends only on the event and on constant arguments (like retrieving a collection).
+        # It is then run once per event, at the top of the event's code, and every use in that event shares the result.
+        self.once_per_event = False
+
         # Representation to use for the resulting variable. Includes C++ type information.
         # A lambda that takes teh scope as an argument and returns a cpp variable to hold things.
         self.result_rep = None
 
-        # We have no further fields for the ast machinery to explore, so this is empty for now.
-        self.fields=[]
+        # The name of the method call this code replaced (e.g. "Jets"). Set by `cpp_ast_finder`, for
+        # anything that needs to recognize the call after the C++ has been put in place.
+        self.method_name = None
+
+        # None of these are AST's for the ast machinery to explore, but they are listed so that
+        # two different bits of C++ don't look the same (e.g. to ast.dump or when hashing).
+        self._fields = ('include_files', 'initialization_code', 'class_variables', 'running_code', 'args', 'replacement_instance_obj', 'result', 'once_per_event')
 
 class cpp_ast_finder(ast.NodeTransformer):
     r'''
@@ -60,6 +78,8 @@ class cpp_ast_finder(ast.NodeTransformer):
         'Try to use name to do the call. Returns (ok, result) monad'
         if name in method_names:
             cpp_call_ast = method_names[name](node)
+            if cpp_call_ast is not None and isinstance(cpp_call_ast.func, CPPCodeValue):
+                cpp_call_ast.func.method_name = name
             return (cpp_call_ast is not None, cpp_call_ast)
         return (False, None)
 
@@ -100,11 +120,9 @@ def process_ast_node(visitor, gc, call_node: ast.Call):
     representation - A value that represents the output
     '''
 
-    # We write everything into a new scope to prevent conflicts. So we have to declare the result ahead of time.
+    # We write everything into a new scope to prevent conflicts. So the result is declared at the scope we start in.
     cpp_ast_node = call_node.func
-    result_rep = cpp_ast_node.result_rep(gc.current_scope())
-
-    gc.declare_variable(result_rep)
+    declare_scope = gc.current_scope()
 
     # Include files
     for i in cpp_ast_node.include_files:
@@ -113,26 +131,89 @@ def process_ast_node(visitor, gc, call_node: ast.Call):
     # Build the dictionary for replacement for the object we are calling
     # against, if any.
     repl_list = []
+    depends_on = []
     if cpp_ast_node.replacement_instance_obj is not None:
-        repl_list += [(cpp_ast_node.replacement_instance_obj[0], visitor.resolve_id(cpp_ast_node.replacement_instance_obj[1]).rep.as_cpp())]
+        rep = visitor.resolve_id(cpp_ast_node.replacement_instance_obj[1]).rep
+        repl_list += [(cpp_ast_node.replacement_instance_obj[0], rep.as_cpp())]
+        depends_on.append(rep)
 
     # Process the arguments that are getting passed to the function
     for arg,dest in zip(cpp_ast_node.args, call_node.args):
         rep = visitor.get_rep(dest)
         repl_list += [(arg, rep.as_cpp())]
+        if not isinstance(dest, (ast.Num, ast.Str)):
+            depends_on.append(rep)
+
+    # Class variables are set up once, and then used by name
+    for name, cpp_type, init_code in cpp_ast_node.class_variables:
+        init_lines = _replace_all(init_code, repl_list)
+        key = ('class_variable', str(cpp_type), tuple(init_lines))
+        var = gc.get_class_rep(key)
+        if var is None:
+            var = cpp_variable(unique_name(name, is_class_var=True), top_level_scope(), cpp_type=ctyp.terminal(str(cpp_type)))
+            gc.declare_class_variable(var)
+            for l in init_lines:
+                gc.add_book_statement(statements.arbitrary_statement(l.replace(name, var.as_cpp())))
+            gc.set_class_rep(key, var)
+        repl_list += [(name, var.as_cpp())]
+
+    lines = _replace_all(cpp_ast_node.running_code, repl_list)
+
+    # Code that is the same for the whole event is only run once, no matter how often it is used.
+    if cpp_ast_node.once_per_event:
+        key = ('once_per_event', tuple(lines), cpp_ast_node.result)
+        result_rep = gc.get_event_rep(key)
+        if result_rep is None:
+            result_rep = cpp_ast_node.result_rep(gc.event_scope())
+            gc.declare_event_variable(result_rep)
+            blk = _code_block(lines, result_rep, cpp_ast_node.result, gc.event_scope())
+            gc.add_event_statement(blk)
+            gc.set_event_rep(key, result_rep)
+        # Each use gets its own copy: the same collection used twice is still two different sequences
+        # (think of looping over pairs of jets).
+        return copy.copy(result_rep)
+
+    # If the identical code has already been run and its result is still in scope, then use that result
+    # (as if it had been calculated here).
+    key = ('cpp_code', tuple(lines), cpp_ast_node.result)
+    result_rep = gc.get_rep(key)
+    if result_rep is not None:
+        return result_rep.copy_with_new_scope(gc.current_scope())
+
+    # If the code does not depend on anything in the loops we are in, then run it just before those loops.
+    dep_scope = dependency_scope(depends_on)
+    hoist_scope = gc.loop_invariant_scope(dep_scope) if dep_scope is not None else None
+    if hoist_scope is not None:
+        current_scope = gc.current_scope()
+        result_rep = cpp_ast_node.result_rep(hoist_scope)
+        hoist_scope.declare_variable(result_rep)
+        hoist_scope.frame_statements(-1).set_rep(key, result_rep)
+        gc.add_statement_before_loop(hoist_scope, _code_block(lines, result_rep, cpp_ast_node.result, hoist_scope))
+        gc.set_scope(current_scope)
+        return result_rep.copy_with_new_scope(current_scope)
+
+    result_rep = cpp_ast_node.result_rep(declare_scope)
+    declare_scope.declare_variable(result_rep)
+    gc.set_rep(key, result_rep)
+    gc.add_statement(_code_block(lines, result_rep, cpp_ast_node.result, gc.current_scope()))
+    gc.pop_scope()
 
-    # Emit the statements.
-    blk = statements.block()
-    visitor._gc.add_statement(blk)
+    return copy.copy(result_rep)
 
-    for s in cpp_ast_node.running_code:
+def _replace_all(code, repl_list):
+    'Return the lines of code, with each replacement in repl_list done'
+    lines = []
+    for s in code:
         l = s
         for src,dest in repl_list:
-            l = l.replace(src, str(dest))            
-        blk.add_statement(statements.arbitrary_statement(l))
-
-    # Set the result and close the scope
-    blk.add_statement(statements.set_var(result_rep, cpp_value(cpp_ast_node.result, gc.current_scope(), result_rep.cpp_type())))
-    gc.pop_scope()
+            l = l.replace(src, str(dest))
+        lines.append(l)
+    return lines
 
-    return result_rep
+def _code_block(lines, result_rep, result, scope):
+    'Wrap the lines of code in their own block, ending by setting result_rep to the result'
+    blk = statements.block()
+    for l in lines:
+        blk.add_statement(statements.arbitrary_statement(l))
+    blk.add_statement(statements.set_var(result_rep, cpp_value(result, scope, result_rep.cpp_type())))
+    return blk
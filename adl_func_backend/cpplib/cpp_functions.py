@@ -17,7 +17,7 @@ class FunctionAST(ast.AST):
         self.cpp_name = cpp_name
         self.include_files = include_files
         self.cpp_return_type = cpp_return_type
-        self.fields = []
+        self._fields = ('cpp_name', 'include_files', 'cpp_return_type')
 
 class find_known_functions(ast.NodeTransformer):
     def visit_Call(self, node):
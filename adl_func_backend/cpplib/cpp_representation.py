@@ -68,7 +68,7 @@ def dereference_var(v):
 
     # We will go under the covers and "fix" this.
     new_v = copy.copy(v)
-    new_v._expression = "*" + new_v._expression
+    new_v._expression = "*" + new_v.as_cpp()
     new_v._cpp_type = new_v._cpp_type.dereference()
     return new_v
 class dummy_ast(ast.AST):
@@ -118,6 +118,8 @@ class cpp_value(cpp_rep_base):
         return self._cpp_type.is_pointer()
 
     def as_cpp(self):
+        if isinstance(self._expression, cpp_format):
+            return self._expression.as_cpp()
         return self._expression
 
     def reset_scope(self, scope: gc_scope):
@@ -154,6 +156,87 @@ class cpp_variable(cpp_value):
     def initial_value(self):
         return self._initial_value
 
+class cpp_format:
+    r'''
+    C++ code made from other values, like "(a+b)". It is only written out when it is asked for, so it
+    picks up how each value ends up being written (see `cpp_shared_value`).
+    '''
+    def __init__(self, format: str, *values):
+        r'''
+        format:     A format string, with a {n} for each value
+        values:     The values. Those that are C++ representations are written with their `as_cpp`.
+        '''
+        self._format = format
+        self._values = values
+
+    def values(self):
+        return self._values
+
+    def as_cpp(self):
+        return self._format.format(*[v.as_cpp() if isinstance(v, cpp_rep_base) else v for v in self._values])
+
+class _shared_value_uses:
+    'How a shared value is written, kept apart so copies of the value (see `copy_with_new_scope`) agree'
+    def __init__(self):
+        self.declared = False
+        self.n_uses = None
+
+class cpp_shared_value(cpp_value):
+    r'''
+    A value that might be used in several places, but should only be calculated once. If it is used
+    more than once it is written as a variable (declared where the value was asked for), otherwise
+    as the value itself. Which is only known once all the code has been made, and the uses
+    have been counted (see `generated_code.share_value`).
+    '''
+    def __init__(self, name: str, scope: Union[gc_scope, gc_scope_top_level], value: cpp_value):
+        cpp_value.__init__(self, name, scope, value.cpp_type())
+        self._value = value
+        self._uses = _shared_value_uses()
+
+    def value(self) -> cpp_value:
+        return self._value
+
+    def variable_name(self) -> str:
+        return self._expression
+
+    def is_declared(self) -> bool:
+        'True if this is written as a variable'
+        return self._uses.declared
+
+    def count_uses(self):
+        'Start counting the number of times this is written, as a variable'
+        self._uses.declared = True
+        self._uses.n_uses = 0
+
+    def uses(self) -> int:
+        return self._uses.n_uses
+
+    def remove_uses(self, n: int):
+        'Take away uses that were counted, but will not be written after all'
+        self._uses.n_uses -= n
+
+    def set_declared(self, declared: bool):
+        'Stop counting, and write this as a variable or not'
+        self._uses.declared = declared
+        self._uses.n_uses = None
+
+    def as_cpp(self):
+        if self._uses.n_uses is not None:
+            self._uses.n_uses += 1
+        return self._expression if self._uses.declared else self._value.as_cpp()
+
+def changes_as_code_runs(v: cpp_value) -> bool:
+    r'''
+    True if `v` can be different from one line of the code to the next: it is, or is made from, a
+    variable with an initial value, which the code then updates (like an accumulator).
+    '''
+    if isinstance(v, cpp_variable) and v.initial_value() is not None:
+        return True
+    if isinstance(v, cpp_shared_value):
+        return changes_as_code_runs(v.value())
+    return isinstance(v, cpp_value) and isinstance(v._expression, cpp_format) \
+        and any(changes_as_code_runs(u) for u in v._expression.values())
+
 class cpp_collection(cpp_value):
     r'''
     Represents a special kind of value - a collection (vector<float>).
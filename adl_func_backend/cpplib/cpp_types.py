@@ -33,14 +33,21 @@ class collection:
         '''
         Initialize a collection type.
 
-        t:      The type of each element in the collection
+        t:          The type of each element in the collection
+        is_pointer: If true, this is a pointer to a collection we can only read (owned by someone else).
         '''
         self._element_type = t
         self._is_pointer = is_pointer
 
     def __str__(self):
+        if self._is_pointer:
+            return "const std::vector<" + str(self._element_type) + ">*"
         return "std::vector<" + str(self._element_type) + ">"
 
+    def dereference(self):
+        'Return the type of the collection the pointer points to'
+        return collection(self._element_type)
+
     def element_type(self):
         return self._element_type
 
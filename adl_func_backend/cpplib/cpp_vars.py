@@ -1,9 +1,29 @@
 # Utility routines to help with variables
+from contextlib import contextmanager
+from contextvars import ContextVar
 
 # A global counter to help with unique variable numbering.
 
 unique_var_index = 0
 
+# The counter for the translation currently running, if any (a one element list, so it can be
+# bumped in place). See `unique_name_scope`.
+_scoped_var_index = ContextVar('scoped_var_index', default=None)
+
+@contextmanager
+def unique_name_scope():
+    r'''Number variable names from zero while in this context.
+
+    Wrap a complete translation in this, and translating the same AST always gives the
+    same variable names - no matter what else has been translated before in this process. Each
+    thread or async task that enters the context gets its own numbering.
+    '''
+    token = _scoped_var_index.set([0])
+    try:
+        yield
+    finally:
+        _scoped_var_index.reset(token)
+
 def unique_name(name, is_class_var = False):
     r'''Will return a new C++ legal variable name that has been made unique with an index.
 
@@ -15,7 +35,12 @@ def unique_name(name, is_class_var = False):
     String of a new variable number.
     '''
 
-    global unique_var_index
-    v_name = ("_" if is_class_var else "") + name + str(unique_var_index)
-    unique_var_index += 1
-    return v_name
+    scoped_index = _scoped_var_index.get()
+    if scoped_index is not None:
+        index = scoped_index[0]
+        scoped_index[0] += 1
+    else:
+        global unique_var_index
+        index = unique_var_index
+        unique_var_index += 1
+    return ("_" if is_class_var else "") + name + str(index)
@@ -2,40 +2,99 @@
 # Utility routines to manipulate LINQ expressions.
 import adl_func_client.query_ast as query_ast
 from adl_func_client.event_dataset import EventDataset
+from adl_func_client.query_result_asts import ResultScalar
 import ast
-from typing import Optional
+from typing import Dict, List, Optional
 
-def find_dataset(a: ast.AST) -> EventDataset:
+def find_datasets(a: ast.AST) -> List[EventDataset]:
     r'''
-    Given an input query ast, find the EventDataSet and return it.
+    Given an input query ast, find all the EventDataSet's in it. A batch of queries has one for each
+    query (often the same one).
 
     Args:
-        a:      An AST that represents a query
+        a:      An AST that represents a query, or a batch of queries
 
     Returns:
-        The `EventDataSet` at the root of this query. It will not be None.
+        Each `EventDataSet` node in the query, once. It will not be empty.
 
     Exceptions:
-        If there is more than one `EventDataSet` found in the query or if there
-        is no `EventDataSet` at the root of the query, then an exception is thrown.
+        If the datasets are not all the same (they do not refer to the same files), or if there is
+        no `EventDataSet` in the query, an exception is thrown.
     '''
 
     class ds_finder(ast.NodeVisitor):
         def __init__(self):
-            self.ds: Optional[EventDataset] = None
-        
+            self.ds: List[EventDataset] = []
+
         def visit_EventDataset(self, node):
-            if self.ds is not None:
+            if any(node is d for d in self.ds):
+                return
+            if len(self.ds) > 0 and node.url != self.ds[0].url:
                 raise BaseException("AST Query has more than one EventDataSet in it!")
-            self.ds = node
+            self.ds.append(node)
 
         def generic_visit(self, node):
             ast.NodeVisitor.generic_visit(self, node)
-    
+
     ds_f = ds_finder()
     ds_f.visit(a)
 
-    if ds_f.ds is None:
+    if len(ds_f.ds) == 0:
         raise BaseException("AST Query has no root EventDataset")
 
     return ds_f.ds
+
+def find_dataset(a: ast.AST) -> EventDataset:
+    r'''
+    Given an input query ast, find the EventDataSet and return it.
+
+    Args:
+        a:      An AST that represents a query
+
+    Returns:
+        The `EventDataSet` at the root of this query. It will not be None.
+
+    Exceptions:
+        If there is more than one `EventDataSet` found in the query (that does not refer to the same files),
+        or if there is no `EventDataSet` at the root of the query, then an exception is thrown.
+    '''
+    return find_datasets(a)[0]
+
+def find_event_count_dataset(a: ast.AST) -> Optional[EventDataset]:
+    r'''
+    If the query just counts the events in a dataset (no filter), return the dataset.
+
+    Args:
+        a:      An AST that represents a query, after the transformations have been applied.
+
+    Returns:
+        The `EventDataset` whose events are counted, or None if the query does anything else. A `Select`
+        on the events doesn't change how many there are, so it is allowed.
+    '''
+    if not isinstance(a, ResultScalar) or a.operation != 'Count':
+        return None
+    s = a.source
+    while isinstance(s, query_ast.Select):
+        s = s.source
+    return s if isinstance(s, EventDataset) else None
+
+def find_query_parameters(a: ast.AST) -> Dict[str, float]:
+    r'''
+    Find the parameters in a query, and the values they have for this run.
+
+    Args:
+        a:      An AST that represents a query
+
+    Returns:
+        Dictionary of the value of each parameter, by name.
+
+    Exceptions:
+        If a parameter is used more than once with different values.
+    '''
+    parameters: Dict[str, float] = {}
+    for node in ast.walk(a):
+        if isinstance(node, query_ast.QueryParameter):
+            if parameters.get(node.name, node.value) != node.value:
+                raise BaseException(f'Parameter {node.name} has two different values: {parameters[node.name]} and {node.value}')
+            parameters[node.name] = node.value
+    return parameters
@@ -93,6 +93,7 @@ def getCollection(info, call_node):
     r.running_code += ['{0} result = 0;'.format(info['container_type']),
                         'ANA_CHECK (evtStore()->retrieve(result, collection_name));']
     r.result = 'result'
+    r.once_per_event = True
 
     is_collection = info['is_collection'] if 'is_collection' in info else True
     if is_collection:
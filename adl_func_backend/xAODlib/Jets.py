@@ -5,6 +5,18 @@ import adl_func_backend.cpplib.cpp_types as ctyp
 from adl_func_backend.cpplib.cpp_vars import unique_name
 import ast
 
+def attribute_accessor(attribute_type: str):
+    r'''
+    Return the class variable for an accessor of an attribute (see `CPPCodeValue.class_variables`). Looking
+    up an attribute by its name is slow, so it is done once, when the job starts. The variable is called
+    `moment_accessor` in the code, and the name of the attribute is `moment_name`.
+
+    attribute_type - The C++ type of the attribute
+    '''
+    accessor_type = 'SG::AuxElement::ConstAccessor<{0}>'.format(attribute_type)
+    return ('moment_accessor', 'std::unique_ptr<{0}>'.format(accessor_type),
+            ['moment_accessor = std::make_unique<{0}>(moment_name);'.format(accessor_type)])
+
 def getAttributeFloatAst(call_node: ast.Call):
     r'''
     Return an attribute on one of the xAOD objects.
@@ -16,10 +28,11 @@ def getAttributeFloatAst(call_node: ast.Call):
         raise BaseException("Calling getMomentFloat - only acceptable argument is a string")
 
     r = cpp_ast.CPPCodeValue()
-    # We don't need include files for this - just quick access
+    r.include_files += ['memory', 'AthContainers/AuxElement.h']
     r.args = ['moment_name',]
     r.replacement_instance_obj = ('obj_j', call_node.func.value.id)
-    r.running_code += ['float result = obj_j->getAttribute<float>(moment_name);']
+    r.class_variables += [attribute_accessor('float')]
+    r.running_code += ['float result = (*moment_accessor)(*obj_j);']
     r.result = 'result'
     r.result_rep = lambda sc: crep.cpp_variable(unique_name("jet_attrib"), scope=sc, cpp_type=ctyp.terminal('float'))
 
@@ -39,12 +52,15 @@ def getAttributeVectorFloatAst(call_node: ast.Call):
         raise BaseException("Calling getMomentFloat - only acceptable argument is a string")
 
     r = cpp_ast.CPPCodeValue()
-    r.include_files += ['vector']
+    r.include_files += ['vector', 'memory', 'AthContainers/AuxElement.h']
     r.args = ['moment_name',]
     r.replacement_instance_obj = ('obj_j', call_node.func.value.id)
-    r.running_code += ['auto result = obj_j->getAttribute<std::vector<double>>(moment_name);']
-    r.result = 'result'
-    r.result_rep = lambda sc: crep.cpp_collection(unique_name("jet_vec_attrib_"), scope=sc, collection_type=ctyp.collection(ctyp.terminal('double')))
+    r.class_variables += [attribute_accessor('std::vector<double>')]
+
+    # The vector stays in the object's store, so we point at it rather than copying it.
+    r.running_code += ['const std::vector<double>& result = (*moment_accessor)(*obj_j);']
+    r.result = '&result'
+    r.result_rep = lambda sc: crep.cpp_collection(unique_name("jet_vec_attrib_"), scope=sc, collection_type=ctyp.collection(ctyp.terminal('double'), is_pointer=True))
 
     # Replace it as the function that is going to get called.
     call_node.func = r
@@ -2,9 +2,10 @@
 # Python AST code.
 
 from adl_func_backend.xAODlib.generated_code import generated_code
-from adl_func_backend.xAODlib.util_scope import deepest_scope, top_level_scope
+from adl_func_backend.xAODlib.util_scope import deepest_scope, dependency_scope, gc_scope, top_level_scope
 import adl_func_backend.xAODlib.statement as statement
-from adl_func_client.util_ast import lambda_unwrap
+from adl_func_client.util_ast import lambda_body_replace, lambda_unwrap
+from adl_func_backend.ast.function_simplifier import and_terms
 from adl_func_backend.cpplib.cpp_vars import unique_name
 import adl_func_backend.cpplib.cpp_ast as cpp_ast
 import adl_func_backend.cpplib.cpp_representation as crep
@@ -23,7 +24,7 @@ import adl_func_backend.cpplib.math_utils
 import ast
 from shutil import copyfile
 from copy import copy
-from typing import Union
+from typing import Optional, Union
 from collections import namedtuple
 
 # Convert between Python comparisons and C++.
@@ -52,6 +53,26 @@ def rep_is_collection(rep):
     if isinstance(rep, crep.cpp_collection):
         return True
 
+def valid_in_scope(rep, scope):
+    r'''
+    A value calculated from an element of a sequence only exists where that element does. If
+    `rep` was calculated from things defined further out (like something retrieved once per
+    event), move it into `scope`, so that anything done with it (like filling a TTree) also
+    only happens there (e.g. inside the if statement of a Where).
+
+    rep - The value
+    scope - The scope of the sequence element it was calculated from
+
+    returns:
+
+    rep, or a copy of it in `scope`
+    '''
+    if isinstance(rep, crep.cpp_tuple):
+        return crep.cpp_tuple(tuple(valid_in_scope(v, scope) for v in rep.values()), scope)
+    if isinstance(rep, crep.cpp_value) and scope.starts_with(rep.scope()):
+        return rep.copy_with_new_scope(scope)
+    return rep
+
 def get_ttree_type(rep):
     'Looking at a rep, figure out how it should get stored in a tree'
     if isinstance(rep, crep.cpp_sequence):
@@ -88,6 +109,36 @@ def determine_type_mf(parent_type, function_name):
     print ("Warning: assumping that the method '{0}.{1}(...)' has return type 'double'. Use cpp_types.add_method_type_info to suppress (or correct) this warning.".format(str(s_parent_type), function_name))
     return ctyp.terminal('double')
 
+class free_names(ast.NodeVisitor):
+    r'''
+    Find everything an AST refers to that it does not define itself: the names that are not
+    arguments of one of its own lambdas, and the representations already attached to it.
+    '''
+    def __init__(self):
+        self.names = set()
+        self.reps = []
+        self._bound = []
+
+    def visit_Lambda(self, node: ast.Lambda):
+        self._bound.append(set(a.arg for a in node.args.args))
+        self.visit(node.body)
+        self._bound.pop()
+
+    def visit_Name(self, node: ast.Name):
+        self._add_name(node.id)
+
+    def visit_Call(self, node: ast.Call):
+        if isinstance(node.func, cpp_ast.CPPCodeValue) and node.func.replacement_instance_obj is not None:
+            self._add_name(node.func.replacement_instance_obj[1])
+        self.generic_visit(node)
+
+    def visit_dummy_ast(self, node: crep.dummy_ast):
+        self.reps.append(node.rep)
+
+    def _add_name(self, name: str):
+        if not any(name in b for b in self._bound):
+            self.names.add(name)
+
 class query_ast_visitor(ast.NodeVisitor):
     r"""
     Drive the conversion to C++ from the top level query
@@ -102,6 +153,15 @@ class query_ast_visitor(ast.NodeVisitor):
         self._arg_stack = argument_stack()
         self._result = None
 
+        # Loops that have been started, in order, and whether new sequences may run in an
+        # existing loop (see `as_exclusive_sequence`).
+        self._loops = []
+        self._no_loop_fusion = 0
+
+        # If false, a filter on the events can't just stop processing the event (other
+        # queries in a batch may still want it).
+        self._can_skip_events = True
+
     def include_files(self):
         return self._gc.include_files()
 
@@ -113,6 +173,14 @@ class query_ast_visitor(ast.NodeVisitor):
         'Emit the parsed lines'
         self._gc.emit_book_code(e)
 
+    def emit_constructor(self, e):
+        'Emit the lines that go in the constructor'
+        self._gc.emit_constructor_code(e)
+
+    def emit_finalize(self, e):
+        'Emit the lines to run after the last event'
+        self._gc.emit_finalize_code(e)
+
     def class_declaration_code(self):
         return self._gc.class_declaration_code()
 
@@ -204,11 +272,57 @@ class query_ast_visitor(ast.NodeVisitor):
         element_type = rep.cpp_type().element_type()
         iterator_value = crep.cpp_value(unique_name("i_obj"), None, element_type)
         l = statement.loop(iterator_value, crep.dereference_var(rep))
+        enclosing_block = self._gc.current_scope().frame_statements(-1)
         self._gc.add_statement(l)
+        self._loops.append(l)
         iterator_value.reset_scope(self._gc.current_scope())
 
         # For a new sequence like this the sequence and iterator value are the same
-        return crep.cpp_sequence(iterator_value, iterator_value)
+        seq = crep.cpp_sequence(iterator_value, iterator_value)
+
+        # Later loops over this collection in the same block can run in this loop.
+        enclosing_block.forget_rep(l.fusion_key())
+        enclosing_block.set_rep(l.fusion_key(), seq)
+        return seq
+
+    def fuse_sequence_from_collection(self, rep):
+        r'''
+        If a loop over the collection `rep` has already been written in the current block, and
+        nothing depends on that loop having finished, move into that loop. This way several
+        columns taken from the same collection are all filled by a single loop. The loop must still
+        be the last thing in the block - otherwise code in it could use values that are only calculated
+        after it.
+
+        rep - The collection we want to loop over
+
+        returns:
+
+        sequence:       The sequence of the existing loop, or None if there isn't one we can use.
+        '''
+        if self._no_loop_fusion > 0:
+            return None
+        key = statement.loop(None, crep.dereference_var(rep)).fusion_key()
+        enclosing_block = self._gc.current_scope().frame_statements(-1)
+        seq = enclosing_block.get_rep(key)
+        if seq is None or not enclosing_block.is_last_statement(seq.iterator_value().scope().frame_statements(-1)):
+            return None
+        self._gc.set_scope(seq.iterator_value().scope())
+        return seq
+
+    def close_loop(self, loop_scope):
+        r'''
+        Code is about to be written after the loop that `loop_scope` is inside, and it depends
+        on the loop having finished (like the result of an aggregate). Nothing else may be fused
+        into that loop.
+
+        loop_scope - The scope of the loop's body
+        '''
+        l = loop_scope.frame_statements(-1)
+        if isinstance(l, statement.loop):
+            enclosing_block = loop_scope[-1].frame_statements(-1)
+            seq = enclosing_block.get_rep(l.fusion_key())
+            if seq is not None and seq.iterator_value().scope().frame_statements(-1) is l:
+                enclosing_block.forget_rep(l.fusion_key())
 
     def as_sequence(self, generation_ast: ast.AST):
         r'''
@@ -237,13 +351,41 @@ class query_ast_visitor(ast.NodeVisitor):
 
         # If this is a collection, then we need to turn it into a sequence.
         if isinstance(rep, crep.cpp_collection):
-            r = self.make_sequence_from_collection(rep)
-            self._gc.set_rep(rep, r)
+            r = self.fuse_sequence_from_collection(rep)
+            if r is None:
+                r = self.make_sequence_from_collection(rep)
+            if self._gc.get_rep(rep) is None:
+                self._gc.set_rep(rep, r)
             return r
 
         # If it isn't a sequence or a collection, then something has gone wrong.
         raise BaseException("Unable to generate a sequence from the given AST. Either there is an internal error, or you are trying to manipulate a '{0}' as a sequence (ast is: {1})".format(type(rep).__name__, ast.dump(generation_ast)))
 
+    def as_exclusive_sequence(self, generation_ast: ast.AST):
+        r'''
+        Like `as_sequence`, but the loop is not shared with any other sequence, so we can leave it
+        early. Nothing else is fused into the loop afterwards either.
+
+        generation_ast - The AST that will generate the collection
+
+        returns:
+
+        sequence:       The sequence (see `as_sequence`)
+        loop:           The loop statement, if it was started just for this sequence. Otherwise None
+                        (the sequence was already being looped over), and the loop can't be left early.
+        '''
+        n_loops = len(self._loops)
+        self._no_loop_fusion += 1
+        try:
+            seq = self.as_sequence(generation_ast)
+        finally:
+            self._no_loop_fusion -= 1
+
+        loop_scope = seq.iterator_value().scope()
+        self.close_loop(loop_scope)
+        l = loop_scope.frame_statements(-1)
+        return seq, (l if any(l is new_l for new_l in self._loops[n_loops:]) else None)
+
     def visit_Call_Lambda(self, call_node):
         'Call to a lambda function. We propagate the arguments through the function'
 
@@ -269,10 +411,9 @@ class query_ast_visitor(ast.NodeVisitor):
         # But if this is a sequence of sequences, we are aggregating over the sequence itself. So we need to do it one level
         # up from where the iterator is running on the interior sequence.
         seq_val = seq.sequence_value()
-        if isinstance(seq_val, crep.cpp_sequence):
-            accumulator_scope = seq_val.iterator_value().scope()[-1]
-        else:
-            accumulator_scope = seq.iterator_value().scope()[-1]
+        loop_scope = seq_val.iterator_value().scope() if isinstance(seq_val, crep.cpp_sequence) else seq.iterator_value().scope()
+        accumulator_scope = loop_scope[-1]
+        self.close_loop(loop_scope)
         accumulator = crep.cpp_variable(unique_name("aggResult"),
                     accumulator_scope,
                     accumulator_type,
@@ -416,8 +557,48 @@ class query_ast_visitor(ast.NodeVisitor):
         # node.rep = result
         # self._result = result
 
+    def invariant_scope(self, node: ast.AST) -> Optional[gc_scope]:
+        r'''
+        If `node` does not depend on anything defined in the loops we are currently in, return
+        the scope it can be calculated in instead (just before the loops). Otherwise return None.
+        '''
+        refs = free_names()
+        refs.visit(node)
+        reps = list(refs.reps)
+        for name in refs.names:
+            defined_as = self.resolve_id(name)
+            if isinstance(defined_as, ast.AST):
+                reps.append(self.get_rep(defined_as, retain_scope=True))
+        dep_scope = dependency_scope(reps)
+        return self._gc.loop_invariant_scope(dep_scope) if dep_scope is not None else None
+
+    def visit_loop_invariant(self, node: ast.AST, visit_here):
+        r'''
+        Calculate a value that needs its own loop (like an aggregate). If it does not depend on
+        the loops we are in (e.g. counting the tracks in an event inside a loop over jets), then it
+        is calculated once, before those loops.
+
+        node - The AST to calculate. Its rep is set.
+        visit_here - Called with node to calculate it at the current scope.
+        '''
+        hoist_scope = self.invariant_scope(node)
+        if hoist_scope is None:
+            return visit_here(node)
+
+        current_scope = self._gc.current_scope()
+        self._gc.add_statement_before_loop(hoist_scope, statement.inline_block())
+        visit_here(node)
+        self._gc.set_scope(current_scope)
+        node.rep = node.rep.copy_with_new_scope(current_scope)
+        self._result = node.rep
+
     def visit_Call_Aggregate(self, node: ast.Call):
-        r'''Implement the aggregate algorithm in C++
+        r'''Implement the aggregate algorithm in C++ (see `visit_loop_invariant` for where it goes).
+        '''
+        self.visit_loop_invariant(node, self.visit_Call_Aggregate_here)
+
+    def visit_Call_Aggregate_here(self, node: ast.Call):
+        r'''Implement the aggregate algorithm in C++, at the current scope
         
         Our source we loop over, and we count out everything. The final result is whatever it is
         we are counting.
@@ -470,9 +651,38 @@ class query_ast_visitor(ast.NodeVisitor):
         # obj.pt() or similar. The translation is direct.
         # TODO: The iterator might be in an argument, so passing calling_against here may not be ok.
         # TODO: We have no type system, who knows what type this function returns. Assume double.
-        c_stub = calling_against.as_cpp() + ("->" if calling_against.is_pointer() else ".")
+        c_stub = "{0}" + ("->" if calling_against.is_pointer() else ".")
         result_type = determine_type_mf(calling_against.cpp_type(), function_name)
-        self._result = crep.cpp_value(c_stub + function_name + "()", calling_against.scope(), result_type)
+        self._result = crep.cpp_value(crep.cpp_format(c_stub + function_name + "()", calling_against), calling_against.scope(), result_type)
+
+        # If we are in a loop that has nothing to do with the object, make the call once, before the loop.
+        # Only simple values are worth it (pointers and collections are cheap to get or expensive to copy).
+        hoist_scope = self._gc.loop_invariant_scope(calling_against.scope())
+        if hoist_scope is not None and isinstance(result_type, ctyp.terminal) and not result_type.is_pointer():
+            self._result = self.hoist_value(self._result, hoist_scope, function_name)
+        elif isinstance(result_type, ctyp.terminal) and not result_type.is_pointer():
+            # The same call made again (like j.pt() in a filter and a column) uses the first result.
+            self._result = self._gc.share_value(self._result, function_name)
+
+    def hoist_value(self, value: crep.cpp_value, scope: gc_scope, name: str) -> crep.cpp_variable:
+        r'''
+        Calculate a value just before the loop the current scope is in, and return the variable
+        holding it. The same value is only calculated once.
+
+        value - The value to calculate
+        scope - Where to calculate it (from `loop_invariant_scope`)
+        name - Base name for the variable
+        '''
+        key = ('hoisted', value.as_cpp())
+        v = scope.frame_statements(-1).get_rep(key)
+        if v is None:
+            v = crep.cpp_variable(unique_name(name), scope, value.cpp_type())
+            scope.declare_variable(v)
+            current_scope = self._gc.current_scope()
+            self._gc.add_statement_before_loop(scope, statement.set_var(v, value))
+            self._gc.set_scope(current_scope)
+            scope.frame_statements(-1).set_rep(key, v)
+        return v
 
     def visit_function_ast(self, call_node):
         'Drop-in replacement for a function'
@@ -482,7 +692,8 @@ class query_ast_visitor(ast.NodeVisitor):
 
         # Code up a call
         # TODO: The iterator might not be Note.
-        r = crep.cpp_value('{0}({1})'.format(cpp_func.cpp_name, ','.join(a.as_cpp() for a in arg_reps)), self._gc.current_scope(), cpp_type = cpp_func.cpp_return_type)
+        arg_format = ','.join('{{{0}}}'.format(i) for i in range(len(arg_reps)))
+        r = crep.cpp_value(crep.cpp_format(cpp_func.cpp_name + '(' + arg_format + ')', *arg_reps), self._gc.current_scope(), cpp_type = cpp_func.cpp_return_type)
 
         # Include files and return the resulting expression
         for i in cpp_func.include_files:
@@ -519,7 +730,7 @@ class query_ast_visitor(ast.NodeVisitor):
             raise BaseException("Do not know how to take the index of type '{0}'".format(v.cpp_type()))
 
         index = self.get_rep(node.slice)
-        node.rep = crep.cpp_value("{0}.at({1})".format(v.as_cpp(), index.as_cpp()), self._gc.current_scope(), cpp_type=v.get_element_type())
+        node.rep = crep.cpp_value(crep.cpp_format("{0}.at({1})", v, index), self._gc.current_scope(), cpp_type=v.get_element_type())
         self._result = node.rep
 
     def visit_Index(self, node):
@@ -545,16 +756,27 @@ class query_ast_visitor(ast.NodeVisitor):
         # TODO: Turn this into a table lookup rather than the same thing repeated over and over
         s = deepest_scope(left, right).scope()
         if isinstance(node.op, ast.Add):
-            r = crep.cpp_value("({0}+{1})".format(left.as_cpp(), right.as_cpp()), s, left.cpp_type())
+            r = crep.cpp_value(crep.cpp_format("({0}+{1})", left, right), s, left.cpp_type())
         elif isinstance(node.op, ast.Div):
-            r = crep.cpp_value("({0}/{1})".format(left.as_cpp(), right.as_cpp()), s, left.cpp_type())
+            r = crep.cpp_value(crep.cpp_format("({0}/{1})", left, right), s, left.cpp_type())
         elif isinstance(node.op, ast.Sub):
-            r = crep.cpp_value("({0}-{1})".format(left.as_cpp(), right.as_cpp()), s, left.cpp_type())
+            r = crep.cpp_value(crep.cpp_format("({0}-{1})", left, right), s, left.cpp_type())
         elif isinstance(node.op, ast.Mult):
-            r = crep.cpp_value("({0}*{1})".format(left.as_cpp(), right.as_cpp()), s, left.cpp_type())
+            r = crep.cpp_value(crep.cpp_format("({0}*{1})", left, right), s, left.cpp_type())
         else:
             raise BaseException("Binary operator {0} is not implemented.".format(type(node.op)))
 
+        # If we are in a loop that has nothing to do with the calculation, do it once, before the loop (numbers
+        # can be used anywhere). Otherwise the same calculation made again in this scope uses the first result.
+        # Neither works for something like an accumulator, which changes as the code runs.
+        if isinstance(r.cpp_type(), ctyp.terminal) and not r.cpp_type().is_pointer() and not crep.changes_as_code_runs(r):
+            depends_on = dependency_scope(rep for n, rep in ((node.left, left), (node.right, right)) if not isinstance(n, ast.Num))
+            hoist_scope = self._gc.loop_invariant_scope(depends_on) if depends_on is not None else None
+            if hoist_scope is not None:
+                r = self.hoist_value(r, hoist_scope, 'expr')
+            else:
+                r = self._gc.share_value(r, 'expr')
+
         # Cache the result to push it back further up.
         node.rep = r
         self._result = r
@@ -598,7 +820,7 @@ class query_ast_visitor(ast.NodeVisitor):
         left = self.get_rep(node.left)
         right = self.get_rep(node.comparators[0])
 
-        r = crep.cpp_value('({0}{1}{2})'.format(left.as_cpp(), compare_operations[type(node.ops[0])], right.as_cpp()), self._gc.current_scope(), ctyp.terminal("bool"))
+        r = crep.cpp_value(crep.cpp_format('({0}' + compare_operations[type(node.ops[0])] + '{1})', left, right), self._gc.current_scope(), ctyp.terminal("bool"))
         node.rep = r
         self._result = r
 
@@ -638,6 +860,21 @@ class query_ast_visitor(ast.NodeVisitor):
         node.rep = crep.cpp_value(node.n, self._gc.current_scope(), guess_type_from_number(node.n))
         self._result = node.rep
 
+    def visit_QueryParameter(self, node):
+        r'''
+        A parameter is a class variable that is set, as an algorithm property, when the job is configured.
+        Its value isn't in the generated code, so queries that differ only in that value build the same code.
+        '''
+        key = ('parameter', node.name)
+        rep = self._gc.get_class_rep(key)
+        if rep is None:
+            rep = crep.cpp_variable(unique_name(node.name, is_class_var=True), top_level_scope(), cpp_type=ctyp.terminal('double'))
+            self._gc.declare_class_variable(rep)
+            self._gc.add_constructor_statement(statement.declare_property(node.name, rep))
+            self._gc.set_class_rep(key, rep)
+        node.rep = rep
+        self._result = rep
+
     def visit_Str(self, node):
         node.rep = crep.cpp_value('"{0}"'.format(node.s), self._gc.current_scope(), ctyp.terminal("string"))
         self._result = node.rep
@@ -680,13 +917,14 @@ class query_ast_visitor(ast.NodeVisitor):
         # Note that the output file and tree are what we are going to return.
         # The output filename is fixed - the hose code in AnalysisBase has that hard coded.
         # To allow it to be different we have to modify that template too, and pass the
-        # information there. If more than one tree is written, the current code would
-        # lead to a bug.
+        # information there. If more than one tree is written (a batch of queries), they all
+        # go into that file, each with its own (unique) name.
         node.rep = rh.cpp_ttree_rep("ANALYSIS.root", tree_name, self._gc.current_scope())
 
         # For each varable we need to save, cache it or push it back, depending.
         # Make sure that it happens at the proper scope, where what we are after is defined!
         s_orig = self._gc.current_scope()
+        scope_tree = scope_fill
         for e_rep,e_name in zip(seq_values.values(), var_names):
             # Set the scope. Normally we want to do it where the variable was calculated
             # (think of cases when you have to calculate something with a `push_back`),
@@ -702,6 +940,7 @@ class query_ast_visitor(ast.NodeVisitor):
             # just set it.
             if rep_is_collection(e_rep):
                 self._gc.add_statement(statement.push_back(e_name[1], e_rep.sequence_value()))
+                self.reserve_for_sequence(e_name[1], e_rep, scope_tree)
             else:
                 self._gc.add_statement(statement.set_var(e_name[1], e_rep))
                 cs = self._gc.current_scope()
@@ -722,6 +961,22 @@ class query_ast_visitor(ast.NodeVisitor):
         self._gc.set_scope(s_orig)
         self._gc.pop_scope()
 
+    def reserve_for_sequence(self, var: crep.cpp_value, seq: crep.cpp_sequence, scope_tree):
+        r'''
+        `var` is a vector being filled, one entry for each element of `seq`, and is written out (and cleared)
+        at `scope_tree`. If the loop over `seq` starts right there, then make room in `var` for everything
+        in the loop's collection before the loop starts. There can be fewer (e.g. if there is a `Where`).
+
+        The current scope must be inside the loop.
+        '''
+        loop_scope = seq.iterator_value().scope()
+        if loop_scope.is_top_level():
+            return
+        l = loop_scope.frame_statements(-1)
+        tree_depth = 1 if scope_tree.is_top_level() else scope_tree.depth()
+        if isinstance(l, statement.loop) and loop_scope.depth() == tree_depth + 1 and loop_scope.starts_with(scope_tree):
+            self._gc.add_statement_before_loop(loop_scope[-1], statement.container_reserve(var, l.size()))
+
     def visit_ResultAwkwardArray(self, node: query_result_asts.ResultAwkwardArray):
         '''
         The result of this guy is an awkward array. We generate a token here, and invoke the resultTTree in order to get the
@@ -746,6 +1001,120 @@ class query_ast_visitor(ast.NodeVisitor):
         node.rep = rh.cpp_pandas_rep(r.filename, r.treename, self._gc.current_scope())
         self._result = node.rep
 
+    def visit_ResultHistogram(self, node: query_result_asts.ResultHistogram):
+        r'''
+        Fill a histogram with each item of the sequence. The histogram is booked in `initialize()` and
+        filled where the values are calculated. If a value is itself a sequence (e.g. the pT of all the jets
+        in the event), each of its elements is filled.
+        '''
+        self.generic_visit(node)
+        seq = self.as_sequence(node.source)
+
+        seq_value = seq.sequence_value()
+        values = list(seq_value.values()) if isinstance(seq_value, crep.cpp_tuple) else [seq_value]
+        n_values = len(node.binning) + (1 if node.weight else 0)
+        if len(values) != n_values:
+            raise BaseException("A {0}D histogram{1} needs {2} values for each fill, but got {3}".format(
+                len(node.binning), " with a weight" if node.weight else "", n_values, len(values)))
+        if any(isinstance(v, crep.cpp_collection) for v in values):
+            raise BaseException("Can only fill a histogram with numbers, not a collection (use Select to pick out a number).")
+        values = [v.sequence_value() if isinstance(v, crep.cpp_sequence) else v for v in values]
+
+        # Fill where all the values are known.
+        scope_fill = dependency_scope([seq.iterator_value()] + values)
+        if scope_fill is None:
+            raise BaseException("The values to fill a histogram with must all come from the same loop.")
+
+        # The histogram, and a pointer to it, set up when it is booked.
+        hist_name = unique_name("hist")
+        hist_var = crep.cpp_variable(unique_name("hist", is_class_var=True), self._gc.current_scope(),
+                                     cpp_type=ctyp.terminal('TH1*' if len(node.binning) == 1 else 'TH2*'))
+        self._gc.declare_class_variable(hist_var)
+        self._gc.add_include('TH1.h' if len(node.binning) == 1 else 'TH2.h')
+        self._gc.add_book_statement(statement.book_histogram(hist_name, hist_var, node.binning))
+
+        s_orig = self._gc.current_scope()
+        self._gc.set_scope(scope_fill)
+        self._gc.add_statement(statement.histogram_fill(hist_var, values))
+
+        # Histograms are written to a file of their own by EventLoop.
+        node.rep = rh.cpp_histogram_rep("hist-ANALYSIS.root", hist_name, len(node.binning), s_orig)
+        self._result = node.rep
+
+        # And we are a terminal, so pop off the block.
+        self._gc.set_scope(s_orig)
+        self._gc.pop_scope()
+
+    def visit_ResultScalar(self, node: query_result_asts.ResultScalar):
+        r'''
+        Reduce the sequence to a single number for the whole job. The number of items, and the running
+        sum, min, or max, are kept in class variables. They are written out once, as an entry in a small
+        tree, after the last event. Each job (or worker) writes its own entry, and they are combined when
+        the result is read back.
+        '''
+        if node.operation not in ['Count', 'Sum', 'Min', 'Max', 'Mean']:
+            raise BaseException("Do not know how to reduce a sequence with '{0}'".format(node.operation))
+        self.generic_visit(node)
+        seq = self.as_sequence(node.source)
+
+        # Count does not need to look at the items.
+        values = [seq.iterator_value()]
+        if node.operation != 'Count':
+            v = seq.sequence_value()
+            if rep_is_collection(v) or isinstance(v, crep.cpp_tuple):
+                raise BaseException("{0} needs a sequence of numbers (use Select to pick out a number).".format(node.operation))
+            values.append(v)
+        scope_fill = dependency_scope(values)
+        if scope_fill is None:
+            raise BaseException("Internal error: the items to reduce are not calculated in the loop over them.")
+
+        # The running values, which are zeroed when the job starts.
+        s_orig = self._gc.current_scope()
+        n_var = crep.cpp_variable(unique_name('n', is_class_var=True), s_orig, cpp_type=ctyp.terminal('long long'))
+        acc_var = crep.cpp_variable(unique_name(node.operation.lower(), is_class_var=True), s_orig, cpp_type=ctyp.terminal('double'))
+        zero = crep.cpp_value('0', s_orig, ctyp.terminal('int'))
+        tree_name = unique_name('scalar')
+        for v in [n_var, acc_var]:
+            self._gc.declare_class_variable(v)
+            self._gc.add_book_statement(statement.set_var(v, zero))
+        self._gc.add_book_statement(statement.book_ttree(tree_name, [('n', n_var), ('value', acc_var)]))
+        self._gc.add_finalize_statement(statement.ttree_fill(tree_name))
+
+        # Accumulate each item. For Min and Max the first item is always taken.
+        self._gc.set_scope(scope_fill)
+        if node.operation in ['Sum', 'Mean']:
+            self._gc.add_statement(statement.set_var(acc_var, crep.cpp_value('{0}+{1}'.format(acc_var.as_cpp(), values[1].as_cpp()), scope_fill, acc_var.cpp_type())))
+        elif node.operation in ['Min', 'Max']:
+            test = crep.cpp_value('{0} == 0 || {1}{2}{3}'.format(n_var.as_cpp(), values[1].as_cpp(), '<' if node.operation == 'Min' else '>', acc_var.as_cpp()),
+                                  scope_fill, ctyp.terminal('bool'))
+            self._gc.add_statement(statement.iftest(test))
+            self._gc.add_statement(statement.set_var(acc_var, values[1]))
+            self._gc.set_scope(scope_fill)
+        self._gc.add_statement(statement.set_var(n_var, crep.cpp_value('{0}+1'.format(n_var.as_cpp()), scope_fill, n_var.cpp_type())))
+
+        # The entries are in the normal output file.
+        node.rep = rh.cpp_scalar_rep("ANALYSIS.root", tree_name, node.operation, s_orig)
+        self._result = node.rep
+
+        # And we are a terminal, so pop off the block.
+        self._gc.set_scope(s_orig)
+        self._gc.pop_scope()
+
+    def visit_QueryBatch(self, node: query_result_asts.QueryBatch):
+        r'''
+        Run each query of the batch in turn for each event. Each writes its own tree. As the queries
+        share the event, anything they have in common (like retrieving a collection) is only done once.
+        '''
+        self._can_skip_events = len(node.queries) == 1
+        reps = []
+        for q in node.queries:
+            self._gc.set_scope(top_level_scope())
+            reps.append(self.get_rep(q))
+        self._gc.set_scope(top_level_scope())
+
+        node.rep = rh.cpp_batch_rep(reps, self._gc.current_scope())
+        self._result = node.rep
+
     def visit_Select(self, select_ast):
         'Transform the iterable from one form to another'
 
@@ -756,6 +1125,9 @@ class query_ast_visitor(ast.NodeVisitor):
         selection = lambda_unwrap(select_ast.selection)
         c = ast.Call(func=selection, args=[seq.sequence_value().as_ast()])
         new_sequence_value = self.get_rep(c)
+        sv = seq.sequence_value()
+        if not isinstance(sv, crep.cpp_sequence):
+            new_sequence_value = valid_in_scope(new_sequence_value, sv.scope())
 
         # We need to build a new sequence.
         # TODO: figure out how to get pyright to not flag new_sequence_value as an error
@@ -793,13 +1165,26 @@ class query_ast_visitor(ast.NodeVisitor):
         # Make sure we are in a loop
         seq = self.as_sequence(node.source)
 
+        # A filter on the events themselves just stops processing the event
+        if self.is_event_sequence(seq):
+            return self.visit_Where_event(node, seq)
+
         # Simulate the filtering call - we want the resulting value to test.
         filter = lambda_unwrap(node.filter)
         c = ast.Call(func=filter, args=[seq.sequence_value().as_ast()])
         rep = self.get_rep(c)
 
-        # Create an if statement
-        self._gc.add_statement(statement.iftest(rep))
+        # Create an if statement. If the same filter has just been applied in this loop
+        # (another column from the same fused loop), then reuse it.
+        filter_key = ('where', rep.as_cpp())
+        enclosing_block = self._gc.current_scope().frame_statements(-1)
+        filter_scope = enclosing_block.get_rep(filter_key)
+        if filter_scope is not None and enclosing_block.is_last_statement(filter_scope.frame_statements(-1)):
+            self._gc.set_scope(filter_scope)
+        else:
+            enclosing_block.forget_rep(filter_key)
+            self._gc.add_statement(statement.iftest(rep))
+            enclosing_block.set_rep(filter_key, self._gc.current_scope())
 
         # Ok - new sequence. This the same as the old sequence, only the sequence value is updated.
         # Protect against sequence of sequences (LOVE type checkers, which caught this as a possibility)
@@ -807,15 +1192,46 @@ class query_ast_visitor(ast.NodeVisitor):
         if isinstance(w_val, crep.cpp_sequence):
             raise BaseException("Internal error: don't know how to look at a sequence")
         new_sequence_var = w_val.copy_with_new_scope(self._gc.current_scope())
-        node.rep = crep.cpp_sequence(new_sequence_var, seq.iterator_value())
+
+        # A filter on the events that can't skip the event (a query in a batch): what is done once for
+        # each event (like filling the tree) must only be done for events that pass, inside the if statement.
+        iterator = seq.iterator_value()
+        if iterator.scope().is_top_level():
+            iterator = iterator.copy_with_new_scope(self._gc.current_scope())
+        node.rep = crep.cpp_sequence(new_sequence_var, iterator)
 
         self._result = node.rep
 
+    def is_event_sequence(self, seq: crep.cpp_sequence) -> bool:
+        'Is this the sequence of events, with nothing else in this event run yet (and we may skip events)?'
+        sv = seq.sequence_value()
+        return self._can_skip_events \
+            and seq.iterator_value().scope().is_top_level() \
+            and not isinstance(sv, crep.cpp_sequence) \
+            and sv.scope().is_top_level() \
+            and self._gc.current_scope().frame_statements(-1) is self._gc.event_scope().frame_statements(-1)
+
+    def visit_Where_event(self, node, seq: crep.cpp_sequence):
+        r'''
+        Filter the events. Each term of the filter that is and-ed together is tested in turn, and
+        processing of the event stops as soon as one fails. Anything not needed for a test (like
+        retrieving other collections) is only done once that test has passed.
+        '''
+        filter = lambda_unwrap(node.filter)
+        event = seq.sequence_value().as_ast()
+        for term in and_terms(filter.body):
+            rep = self.get_rep(ast.Call(func=lambda_body_replace(filter, term), args=[event]))
+            self._gc.set_scope(self._gc.event_scope())
+            self._gc.add_event_filter(crep.cpp_value('!({0})'.format(rep.as_cpp()), self._gc.current_scope(), ctyp.terminal('bool')))
+
+        node.rep = seq
+        self._result = seq
+
     def visit_First(self, node):
         'We are in a sequence. Take the first element of the sequence and use that for future things.'
 
-        # Make sure we are in a loop.
-        seq = self.as_sequence(node.source)
+        # Make sure we are in a loop, and that it is ours alone so we can leave it early.
+        seq, loop = self.as_exclusive_sequence(node.source)
 
         # The First terminal works by protecting the code with a if (first_time) {} block.
         # We need to declare the first_time variable outside the block where the thing we are
@@ -840,9 +1256,82 @@ class query_ast_visitor(ast.NodeVisitor):
             self._gc.set_scope(sv.scope())
         self._gc.add_statement(s)
 
+        # Once we have the first element, there is no need to look at the rest.
+        if loop is not None:
+            loop.set_exit_condition(crep.cpp_value('!{0}'.format(is_first.as_cpp()), loop_scope, ctyp.terminal('bool')))
+
         # If we just found the first sequence in a sequence, return that.
         # Otherwise return a new version of the value.
         first_value = sv if isinstance(sv, crep.cpp_sequence) else sv.copy_with_new_scope(self._gc.current_scope())
 
         node.rep = first_value
-        self._result = first_value
\ No newline at end of file
+        self._result = first_value
+
+    def visit_AnyOf(self, node):
+        'Is any element of the sequence true (or there at all)? Stops looking at the first one that is.'
+        self.visit_loop_invariant(node, lambda n: self.visit_Any_All_here(n, 'false', 'true', lambda t: t))
+
+    def visit_AllOf(self, node):
+        'Is every element of the sequence true? Stops looking at the first one that is not.'
+        self.visit_loop_invariant(node, lambda n: self.visit_Any_All_here(n, 'true', 'false', lambda t: '!{0}'.format(t)))
+
+    def visit_Any_All_here(self, node, initial_value: str, found_value: str, found_test):
+        r'''
+        Look through a sequence for an element that decides the answer, and stop looking once it is found.
+
+        node - The AnyOf or AllOf AST node
+        initial_value - The answer if no element decides it
+        found_value - The answer once an element decides it
+        found_test - Turns the C++ for the filter value into the test that an element decides the answer
+        '''
+        seq, loop = self.as_exclusive_sequence(node.source)
+        loop_scope = seq.iterator_value().scope()
+        result_scope = loop_scope[-1]
+
+        bool_type = ctyp.terminal('bool')
+        result = crep.cpp_variable(unique_name(type(node).__name__.lower()), result_scope, bool_type,
+                    initial_value=crep.cpp_value(initial_value, result_scope, bool_type))
+        result_scope.declare_variable(result)
+
+        # Test each element at the scope it is valid at.
+        sv = seq.sequence_value()
+        self._gc.set_scope(sv.scope())
+        if node.filter is not None:
+            c = ast.Call(func=lambda_unwrap(node.filter), args=[sv.as_ast()])
+            test = self.get_rep(c)
+            self._gc.add_statement(statement.iftest(crep.cpp_value(found_test(test.as_cpp()), self._gc.current_scope(), bool_type)))
+        self._gc.add_statement(statement.set_var(result, crep.cpp_value(found_value, self._gc.current_scope(), bool_type)))
+
+        # Once the answer is known, we are done.
+        if loop is not None:
+            exit_test = result.as_cpp() if found_value == 'true' else '!{0}'.format(result.as_cpp())
+            loop.set_exit_condition(crep.cpp_value(exit_test, loop_scope, bool_type))
+
+        self._gc.set_scope(result_scope)
+        node.rep = result
+        self._result = result
+
+    def visit_Take(self, node):
+        'Only the first few elements of the sequence. The loop stops once they have been seen.'
+        seq, loop = self.as_exclusive_sequence(node.source)
+        loop_scope = seq.iterator_value().scope()
+        count_scope = loop_scope[-1]
+        n_take = self.get_rep(node.count)
+
+        int_type = ctyp.terminal('int')
+        n_taken = crep.cpp_variable(unique_name('n_taken'), count_scope, int_type, initial_value=crep.cpp_value('0', count_scope, int_type))
+        count_scope.declare_variable(n_taken)
+
+        # Only let elements through while we still need them.
+        sv = seq.sequence_value()
+        if isinstance(sv, crep.cpp_sequence):
+            raise BaseException("Internal error: don't know how to Take from a sequence of sequences")
+        self._gc.set_scope(sv.scope())
+        self._gc.add_statement(statement.iftest(crep.cpp_value('({0}<{1})'.format(n_taken.as_cpp(), n_take.as_cpp()), self._gc.current_scope(), ctyp.terminal('bool'))))
+        self._gc.add_statement(statement.set_var(n_taken, crep.cpp_value('({0}+1)'.format(n_taken.as_cpp()), self._gc.current_scope(), int_type)))
+
+        if loop is not None:
+            loop.set_exit_condition(crep.cpp_value('({0}>={1})'.format(n_taken.as_cpp(), n_take.as_cpp()), loop_scope, ctyp.terminal('bool')))
+
+        node.rep = crep.cpp_sequence(sv.copy_with_new_scope(self._gc.current_scope()), seq.iterator_value())
+        self._result = node.rep
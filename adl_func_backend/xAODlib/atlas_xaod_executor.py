@@ -4,18 +4,71 @@ import sys
 import os
 import jinja2
 import ast
+import hashlib
+import json
 from collections import namedtuple
+from typing import Dict, List, Optional
 
 from adl_func_backend.ast.tuple_simplifier import remove_tuple_subscripts
 from adl_func_backend.ast.function_simplifier import simplify_chained_calls
 from adl_func_backend.ast.aggregate_shortcuts import aggregate_node_transformer
+from adl_func_backend.ast.canonical_form import canonicalize_ast
 from adl_func_backend.cpplib.cpp_functions import find_known_functions
+from adl_func_backend.cpplib.cpp_vars import unique_name_scope
 import adl_func_backend.cpplib.cpp_ast as cpp_ast
 from adl_func_backend.xAODlib.ast_to_cpp_translator import query_ast_visitor
 import adl_func_backend.cpplib.cpp_representation as crep
 from adl_func_backend.xAODlib.util_scope import top_level_scope
+from adl_func_backend.xAODlib.query_plan import query_plan
 
-xAODExecutionInfo = namedtuple('xAODExecutionInfo', 'input_urls result_rep output_path main_script all_filenames')
+xAODExecutionInfo = namedtuple('xAODExecutionInfo', 'input_urls result_rep output_path main_script all_filenames build_hash parameters')
+
+# The AnalysisBase release the generated code is built and run against.
+atlas_release = '21.2.62'
+
+# The EventLoop drivers the job script knows how to run with. `proof` is PROOF-Lite, which runs the job
+# in several local processes and merges their output.
+eventloop_drivers = ['direct', 'proof']
+
+# The templates that go into the compiled code. If these render the same way, the build can be re-used.
+build_template_files = ['package_CMakeLists.txt', 'query.cxx', 'query.h']
+
+# The generic query algorithm is built from these in place of the query templates. It is the same for
+# every query it runs, so it is built once (see `query_plan`).
+generic_template_files = {'query.cxx': 'generic_query.cxx', 'query.h': 'generic_query.h'}
+
+# The headers the generic query algorithm uses (they are precompiled, with a release whose CMake can)
+generic_include_files = ['AthContainers/AuxElement.h', 'xAODJet/Jet.h', 'xAODJet/JetContainer.h']
+
+def calc_build_hash(rendered_files: List[str], release: str = atlas_release) -> str:
+    '''Calculate the hash that identifies a build of the generated code.
+
+    Args:
+        rendered_files:     The text of each file that goes into the build, in a fixed order.
+        release:            The AnalysisBase release we build against.
+
+    Returns:
+        Hex digest that is the same for byte-identical source built against the same release.
+    '''
+    h = hashlib.md5()
+    h.update(release.encode())
+    for f in rendered_files:
+        h.update(b'\0')
+        h.update(f.encode())
+    return h.hexdigest()
+
+def write_parameters(parameters: Dict[str, float], run_dir: str):
+    '''
+    Write the values of the query parameters into parameters.json, where the job script will find them
+    and set them on the algorithm. Nothing is written if the query has no parameters.
+
+    Args:
+        parameters:         The value of each parameter, by name
+        run_dir:            The directory the query is run from
+    '''
+    if len(parameters) > 0:
+        with open(os.path.join(run_dir, 'parameters.json'), 'w') as f:
+            json.dump(parameters, f)
 
 class cpp_source_emitter:
     r'''
@@ -55,9 +108,35 @@ def find_dir(path):
     return _find(path, matchFunc=os.path.isdir)
 
 class atlas_xaod_executor:
+    def __init__(self, driver: str = 'direct', workers: int = 1, generic: bool = True):
+        r'''
+        Arguments:
+            driver          The EventLoop driver the job script uses to run the query (one of `eventloop_drivers`)
+            workers         Number of worker processes, for drivers that can run more than one
+            generic         If true, a query the generic query algorithm can run is given to it as a plan,
+                            rather than having C++ written for it (see `query_plan`). The columns are written
+                            with the same types either way. The generic algorithm still has to be built; it
+                            is the same build for every such query, so it is only saved when the build is
+                            kept (a build cache or workspace).
+        '''
+        if driver not in eventloop_drivers:
+            raise BaseException(f'Unknown EventLoop driver "{driver}" - known drivers are {", ".join(eventloop_drivers)}.')
+        if workers < 1:
+            raise BaseException(f'An EventLoop job needs at least one worker, not {workers}.')
+        self._driver = driver
+        self._workers = workers
+        self._generic = generic
+
     def copy_template_file(self, j2_env, info, template_file, final_dir):
         'Copy a file to a final directory'
         j2_env.get_template(template_file).stream(info).dump(final_dir + '/' + template_file)
+
+    def render_template_file(self, j2_env, info, template_file, final_dir, final_file: Optional[str] = None) -> str:
+        'Render a template, write it to the final directory (as final_file, if given), and return the text'
+        text = j2_env.get_template(template_file).render(info)
+        with open(os.path.join(final_dir, final_file if final_file is not None else template_file), 'w') as f_out:
+            f_out.write(text)
+        return text
     
     def apply_ast_transformations(self, ast):
         r'''
@@ -74,40 +153,83 @@ class atlas_xaod_executor:
         # Any C++ custom code needs to be threaded into the ast
         ast = cpp_ast.cpp_ast_finder().visit(ast)
 
+        # Finally, put it in a canonical form so cosmetically different queries look the same.
+        ast = canonicalize_ast().visit(ast)
+
         # And return the modified ast
         return ast
 
     def write_cpp_files(self, ast: ast.AST, output_path: str) -> xAODExecutionInfo:
         r"""
         Given the AST generate the C++ files that need to run. Return them along with
-        the input files.
+        the input files. The same AST always generates the same files.
         """
 
-        # Find the base file dataset and mark it.
-        from adl_func_backend.util_LINQ import find_dataset
-        file = find_dataset(ast)
+        # Find the base file dataset and mark it (a batch of queries has one for each query).
+        from adl_func_backend.util_LINQ import find_datasets
+        datasets = find_datasets(ast)
         iterator = crep.cpp_variable("bogus-do-not-use", top_level_scope(), cpp_type=None)
-        file.rep = crep.cpp_sequence(iterator, iterator)
+        for ds in datasets:
+            ds.rep = crep.cpp_sequence(iterator, iterator)
 
         # Visit the AST to generate the code structure and find out what the
-        # result is going to be.
-        qv = query_ast_visitor()
-        result_rep = qv.get_rep(ast)
-
-        # Emit the C++ code into our dictionaries to be used in template generation below.
-        query_code = cpp_source_emitter()
-        qv.emit_query(query_code)
-        book_code = cpp_source_emitter()
-        qv.emit_book(book_code)
-        class_dec_code = qv.class_declaration_code()
-        includes = qv.include_files()
+        # result is going to be. Variable names are numbered just for this translation,
+        # so the same AST always renders to the same C++. If the generic query algorithm
+        # can run the query, no C++ is needed - just its plan.
+        with unique_name_scope():
+            plan = query_plan(ast) if self._generic else None
+            if plan is not None:
+                return self._write_plan_files(ast, output_path, plan[0], plan[1])
+
+            qv = query_ast_visitor()
+            result_rep = qv.get_rep(ast)
+
+            # Emit the C++ code into our dictionaries to be used in template generation below.
+            query_code = cpp_source_emitter()
+            qv.emit_query(query_code)
+            book_code = cpp_source_emitter()
+            qv.emit_book(book_code)
+            constructor_code = cpp_source_emitter()
+            qv.emit_constructor(constructor_code)
+            finalize_code = cpp_source_emitter()
+            qv.emit_finalize(finalize_code)
+            class_dec_code = qv.class_declaration_code()
+            includes = qv.include_files()
 
         # The replacement dict to pass to the template generator can now be filled
         info = {}
         info['query_code'] = query_code.lines_of_query_code()
         info['book_code'] = book_code.lines_of_query_code()
+        info['constructor_code'] = constructor_code.lines_of_query_code()
+        info['finalize_code'] = finalize_code.lines_of_query_code()
         info['class_dec'] = class_dec_code
         info['include_files'] = includes
+        return self._write_files(ast, output_path, info, result_rep, {}, [])
+
+    def _write_plan_files(self, ast: ast.AST, output_path: str, plan: str, result_rep) -> xAODExecutionInfo:
+        r'''
+        Write out the files to run a query with the generic query algorithm. Its code is the same for every
+        query, so it has the same build hash, and the build can be re-used. The plan is passed to the
+        algorithm by the job script.
+        '''
+        with open(os.path.join(output_path, 'plan.txt'), 'w') as f:
+            f.write(plan)
+        return self._write_files(ast, output_path, {'include_files': generic_include_files}, result_rep, generic_template_files, ['plan.txt'])
+
+    def _write_files(self, ast: ast.AST, output_path: str, info, result_rep, templates: Dict[str, str], other_files: List[str]) -> xAODExecutionInfo:
+        r'''
+        Render the templates to the output directory and return the files to run.
+
+        ast - The query
+        output_path - Directory to write the files to
+        info - Values for the templates
+        result_rep - What the query returns
+        templates - Template to use for a build file (by its name), if not the one of that name
+        other_files - Files already written to `output_path` that are needed to run
+        '''
+        from adl_func_backend.util_LINQ import find_datasets, find_query_parameters
+        info['driver'] = self._driver
+        info['workers'] = self._workers
 
         # We use jinja2 templates. Write out everything.
         template_dir = find_dir("adl_func_backend/R21Code")
@@ -115,13 +237,16 @@ class atlas_xaod_executor:
             loader=jinja2.FileSystemLoader(template_dir))
         self.copy_template_file(
             j2_env, info, 'ATestRun_eljob.py', output_path)
-        self.copy_template_file(
-            j2_env, info, 'package_CMakeLists.txt', output_path)
-        self.copy_template_file(j2_env, info, 'query.cxx', output_path)
-        self.copy_template_file(j2_env, info, 'query.h', output_path)
+        build_files = [self.render_template_file(j2_env, info, templates.get(t, t), output_path, t) for t in build_template_files]
+
+        # The runner uses the build hash to find a previous build of identical code.
+        info['build_hash'] = calc_build_hash(build_files)
         self.copy_template_file(j2_env, info, 'runner.sh', output_path)
 
         os.chmod(os.path.join(str(output_path), 'runner.sh'), 0o755)
 
-        # Build the return object.
-        return xAODExecutionInfo(file.url, result_rep, output_path, 'runner.sh', ['ATestRun_eljob.py', 'package_CMakeLists.txt', 'query.cxx', 'query.h', 'runner.sh'])
\ No newline at end of file
+        # Build the return object. The values of the parameters aren't part of the code; they are set
+        # when the job is run (see `write_parameters`).
+        return xAODExecutionInfo(find_datasets(ast)[0].url, result_rep, output_path, 'runner.sh',
+                                 ['ATestRun_eljob.py', 'package_CMakeLists.txt', 'query.cxx', 'query.h', 'runner.sh'] + other_files, info['build_hash'],
+                                 find_query_parameters(ast))
\ No newline at end of file
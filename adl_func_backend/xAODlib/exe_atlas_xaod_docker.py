@@ -1,5 +1,6 @@
 # Use an in-process docker container to do the actual execution work.
-from adl_func_backend.xAODlib.atlas_xaod_executor import atlas_xaod_executor
+from adl_func_backend.xAODlib.atlas_xaod_executor import atlas_xaod_executor, atlas_release, write_parameters
+from adl_func_backend.util_LINQ import find_event_count_dataset
 import adl_func_backend.xAODlib.result_handlers as rh
 
 import ast
@@ -8,6 +9,8 @@ from urllib.parse import urlparse
 import subprocess
 import os
 import asyncio
+import uproot
+from typing import Dict, List, Optional, Tuple, Union
 
 # Use this to turn on dumping of output and C++
 dump_running_log = True
@@ -22,62 +25,279 @@ result_handlers = {
         rh.cpp_ttree_rep: rh.extract_result_TTree,
         rh.cpp_awkward_rep: rh.extract_awkward_result,
         rh.cpp_pandas_rep: rh.extract_pandas_result,
+        rh.cpp_histogram_rep: rh.extract_histogram_result,
+        rh.cpp_scalar_rep: rh.extract_scalar_result,
+        rh.cpp_batch_rep: lambda rep, run_dir: rh.extract_batch_result(rep, run_dir, result_handlers),
 }
 
-async def use_executor_xaod_docker(a: ast.AST):
+def write_filelist(input_urls, local_run_dir: str) -> Optional[str]:
+    '''
+    Write the list of files the query should run over into filelist.txt, with paths as they
+    will be seen inside the container.
+
+    Arguments:
+        input_urls          The urls of the files to run over
+        local_run_dir       Directory to write filelist.txt into
+
+    Returns:
+        The local directory that must be mounted at /data in the container, or None if no local
+        files are used.
+    '''
+    # Write out a file with the mapped in directories.
+    # Until we better figure out how to deal with this, there are some restrictions
+    # on file locations.
+    datafile_dir = None
+    with open(f'{local_run_dir}/filelist.txt', 'w') as flist_out:
+        for u in input_urls:
+            (scheme, netloc, path, _, _, _) = urlparse(u)
+
+            # How we process this is going to depend a bit on the scheme that we are going to handle.
+            if scheme == 'file':
+                if len(netloc) != 0:
+                    raise AtlasXAODDockerException(f'Only file URLs that have no node specification can be used (e.g. file:///path) : {u}')
+                ds_path = path[1:]
+                datafile = os.path.basename(ds_path)
+                flist_out.write(f'/data/{datafile}\n')
+                if datafile_dir is None:
+                    datafile_dir = os.path.dirname(ds_path)
+                else:
+                    t = os.path.dirname(ds_path)
+                    if t != datafile_dir:
+                        raise BaseException(f'Data files must be from the same directory. Have seen {t} and {datafile_dir} so far.')
+            elif scheme == 'root':
+                flist_out.write(f'{scheme}://{netloc}/{path}\n')
+            else:
+                raise AtlasXAODDockerException(f'Only URLs with scheme `file` can be used: {u}')
+    return datafile_dir
+
+async def run_docker_command(cmd: str) -> Tuple[int, bytes, bytes]:
+    '''
+    Run a docker command, and wait for it to finish.
+
+    Arguments:
+        cmd                 The command line to run
+
+    Returns:
+        Tuple of the return code, the stdout, and the stderr.
+    '''
+    proc = await asyncio.create_subprocess_shell(cmd,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE)
+    p_stdout, p_stderr = await proc.communicate()
+    return proc.returncode, p_stdout, p_stderr
+
+def extract_result(f_spec, local_run_dir: Union[str, List[str]]):
+    '''
+    Once a query has been run, use the result handlers to turn its output into the result. If the
+    query was run in several shards, pass the list of their run directories and the results are merged.
+    '''
+    if type(f_spec.result_rep) not in result_handlers:
+        raise BaseException(f'Do not know how to process result of type {type(f_spec.result_rep.__name__)}.')
+    return result_handlers[type(f_spec.result_rep)](f_spec.result_rep, local_run_dir)
+
+def shard_list(items: List[str], n_shards: int) -> List[List[str]]:
+    '''
+    Split a list into contiguous shards that differ in length by at most one. There are never
+    any empty shards, so fewer than `n_shards` come back if there are fewer items.
+
+    Arguments:
+        items               The list to split up
+        n_shards            How many shards to split it into
+
+    Returns:
+        List of the shards, in order.
+    '''
+    n_shards = max(1, min(n_shards, len(items)))
+    size, extra = divmod(len(items), n_shards)
+    result = []
+    start = 0
+    for i in range(n_shards):
+        end = start + size + (1 if i < extra else 0)
+        result.append(items[start:end])
+        start = end
+    return result
+
+def entry_ranges(n_entries: int, n_splits: int) -> List[Tuple[int, int]]:
+    '''
+    Split the entries in a file into contiguous ranges whose sizes differ by at most one.
+
+    Arguments:
+        n_entries           Number of entries in the file
+        n_splits            How many ranges to split it into
+
+    Returns:
+        List of (skip, count) for each range, in order.
+    '''
+    n_splits = max(1, min(n_splits, n_entries))
+    size, extra = divmod(n_entries, n_splits)
+    ranges = []
+    start = 0
+    for i in range(n_splits):
+        count = size + (1 if i < extra else 0)
+        ranges.append((start, count))
+        start += count
+    return ranges
+
+# The number of events in each file we have looked at, by url, along with the modification time of
+# the file (None for a remote file) when it was counted.
+_entry_counts: Dict[str, Tuple[Optional[float], int]] = {}
+
+def _modification_time(url: str) -> Optional[float]:
+    'The modification time of a local file, or None if the url is not a local file we can find'
+    (scheme, _, path, _, _, _) = urlparse(url)
+    if scheme != 'file':
+        return None
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def count_entries(url: str) -> int:
+    '''
+    Return the number of events in an xAOD file. Each file is only opened the first time (a local
+    file is opened again if it has been changed since).
+
+    Arguments:
+        url                 The file to look at. Must be something uproot can open.
+    '''
+    mtime = _modification_time(url)
+    if url not in _entry_counts or _entry_counts[url][0] != mtime:
+        f = uproot.open(url)
+        _entry_counts[url] = (mtime, f['CollectionTree'].numentries)
+        f._context.source.close()
+    return _entry_counts[url][1]
+
+def count_events(a: ast.AST) -> Optional[int]:
+    '''
+    If the query just counts the events in its dataset, count them from the number of entries in each
+    file - no need to build and run anything.
+
+    Arguments:
+        a                   The query, after the transformations have been applied
+
+    Returns:
+        The number of events, or None if the query can't be answered this way (including when a file
+        can't be opened from here - it may still be readable from inside the container).
+    '''
+    ds = find_event_count_dataset(a)
+    if ds is None or any(urlparse(u).scheme not in ['file', 'root'] for u in ds.url):
+        return None
+    try:
+        return sum(count_entries(u) for u in ds.url)
+    except Exception:
+        return None
+
+async def _run_in_container(main_script: str, scripts_dir: str, run_dir: str, urls: List[str], mounts: str,
+                            event_range: Optional[Tuple[int, int]] = None):
+    '''
+    Run the query over a list of files in a fresh container. Output is left in run_dir. If an
+    event range is given, as (skip, count), only those events are processed.
+    '''
+    datafile_dir = write_filelist(urls, run_dir)
+    if event_range is not None:
+        with open(os.path.join(run_dir, 'eventrange.txt'), 'w') as f:
+            f.write(f'{event_range[0]} {event_range[1]}\n')
+    datafile_mount = "" if datafile_dir is None else f'-v {datafile_dir}:/data'
+    run_mount = f'-v {run_dir}:/results' if run_dir == scripts_dir else f'-v {run_dir}:/results -w /results'
+    docker_cmd = f'docker run --rm -v {scripts_dir}:/scripts {run_mount} {datafile_mount} {mounts} atlas/analysisbase:{atlas_release} /scripts/{main_script} /results'
+    returncode, p_stdout, p_stderr = await run_docker_command(docker_cmd)
+    if returncode != 0 or dump_running_log:
+        print (f"Result of run: {returncode}")
+        print (f'Output:\n{p_stdout}')
+        print (f'Error:\n{p_stderr}')
+    if returncode != 0:
+        raise BaseException("Docker command failed with error {0}".format(returncode))
+
+async def use_executor_xaod_docker(a: ast.AST, build_cache_dir: Optional[str] = None, build_workspace: Optional[str] = None,
+                                   shards: int = 1, max_workers: Optional[int] = None, splits_per_file: int = 1,
+                                   driver: str = 'direct', driver_workers: int = 1, ccache_dir: Optional[str] = None):
     '''
     Execute a query on the local machine, in a docker container.
+
+    Arguments:
+        a                   The query to run
+        build_cache_dir     If not None, a local directory where compiled queries are kept. A query that
+                            generates identical C++ to one already built there skips the build step.
+        build_workspace     If not None, a local directory where a configured build tree is kept for each
+                            release. Each query only swaps in its own C++ and re-runs make. Queries using
+                            the same workspace are run one at a time. If build_cache_dir is also given, it
+                            is used instead.
+        shards              Split the input files into this many shards, and run each in its own container.
+                            The results are merged before being returned.
+        max_workers         Maximum number of shards that run at once. Defaults to all of them.
+        splits_per_file     Split each file into this many ranges of events, and run each range in its own
+                            container. Use this for very large files. The number of events in each file is
+                            read with uproot before the query is run. Overrides `shards`.
+        driver              The EventLoop driver used in the container (see `atlas_xaod_executor`)
+        driver_workers      Number of processes the driver uses in each container
+        ccache_dir          If not None, a local directory for ccache to keep compiled code in. Any
+                            build, of any query, can then re-use code compiled before.
+
+    Notes:
+        A sharded query is built once and the build is shared by all the shards. That uses the build
+        cache (a private one if build_cache_dir isn't given); the workspace isn't used as it would make
+        the shards run one at a time.
+
+        Simple queries are run by the generic query algorithm (see `query_plan`), whose build is the same for
+        all of them. Without a build_cache_dir or build_workspace it is still built every time, so give one
+        of them to skip the build.
     '''
+    # A count of the events in the dataset is already known.
+    exe = atlas_xaod_executor(driver=driver, workers=driver_workers)
+    a = exe.apply_ast_transformations(a)
+    n_events = count_events(a)
+    if n_events is not None:
+        return n_events
+
     # Construct the files we will run.
     with tempfile.TemporaryDirectory() as local_run_dir:
         os.chmod(local_run_dir, 0o777)
 
-        exe = atlas_xaod_executor()
-        f_spec = exe.write_cpp_files(exe.apply_ast_transformations(a), local_run_dir)
-
-        # Write out a file with the mapped in directories.
-        # Until we better figure out how to deal with this, there are some restrictions
-        # on file locations.
-        datafile_dir = None
-        with open(f'{local_run_dir}/filelist.txt', 'w') as flist_out:
-            for u in f_spec.input_urls:
-                (scheme, netloc, path, _, _, _) = urlparse(u)
-
-                # How we process this is going to depend a bit on the scheme that we are going to handle.
-                if scheme == 'file':
-                    if len(netloc) != 0:
-                        raise AtlasXAODDockerException(f'Only file URLs that have no node specification can be used (e.g. file:///path) : {u}')
-                    ds_path = path[1:]
-                    datafile = os.path.basename(ds_path)
-                    flist_out.write(f'/data/{datafile}\n')
-                    if datafile_dir is None:
-                        datafile_dir = os.path.dirname(ds_path)
-                    else:
-                        t = os.path.dirname(ds_path)
-                        if t != datafile_dir:
-                            raise BaseException(f'Data files must be from the same directory. Have seen {t} and {datafile_dir} so far.')
-                elif scheme == 'root':
-                    flist_out.write(f'{scheme}://{netloc}/{path}')
-                else:
-                    raise AtlasXAODDockerException(f'Only URLs with scheme `file` can be used: {u}')
-
-        # Build a docker command to run this.
-        datafile_mount = "" if datafile_dir is None else f'-v {datafile_dir}:/data'
-        docker_cmd = f'docker run --rm -v {f_spec.output_path}:/scripts -v {f_spec.output_path}:/results {datafile_mount} atlas/analysisbase:21.2.62 /scripts/{f_spec.main_script} /results'
-        proc = await asyncio.create_subprocess_shell(docker_cmd,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE)
-        p_stdout, p_stderr = await proc.communicate()
-        if proc.returncode != 0 or dump_running_log:
-            print (f"Result of run: {proc.returncode}")
-            print (f'Output:\n{p_stdout}')
-            print (f'Error:\n{p_stderr}')
-        if proc.returncode != 0:
-            raise BaseException("Docker command failed with error {0}".format(proc.returncode))
+        f_spec = exe.write_cpp_files(a, local_run_dir)
+        write_parameters(f_spec.parameters, f_spec.output_path)
+
+        # Split the work up - each task is a list of files and the range of events to run over.
+        if splits_per_file > 1:
+            tasks = [([u], r) for u in f_spec.input_urls for r in entry_ranges(count_entries(u), splits_per_file)]
+        else:
+            tasks = [(u, None) for u in shard_list(f_spec.input_urls, shards)]
+
+        # Mounts for the build areas
+        if len(tasks) > 1:
+            if build_cache_dir is None:
+                build_cache_dir = os.path.join(local_run_dir, 'build_cache')
+                os.mkdir(build_cache_dir)
+                os.chmod(build_cache_dir, 0o777)
+            build_workspace = None
+        build_cache_mount = "" if build_cache_dir is None else f'-v {build_cache_dir}:/build_cache'
+        workspace_mount = ""
+        if build_workspace is not None:
+            workspace_dir = os.path.join(build_workspace, atlas_release)
+            os.makedirs(workspace_dir, exist_ok=True)
+            workspace_mount = f'-v {workspace_dir}:/workspace'
+        ccache_mount = "" if ccache_dir is None else f'-v {ccache_dir}:/ccache'
+        mounts = f'{build_cache_mount} {workspace_mount} {ccache_mount}'
+
+        # Run everything. With a single task everything happens in the directory with the scripts.
+        if len(tasks) == 1:
+            await _run_in_container(f_spec.main_script, f_spec.output_path, f_spec.output_path, tasks[0][0], mounts, tasks[0][1])
+            run_dirs = local_run_dir
+        else:
+            run_dirs = []
+            for i in range(len(tasks)):
+                d = os.path.join(local_run_dir, f'shard_{i}')
+                os.mkdir(d)
+                os.chmod(d, 0o777)
+                run_dirs.append(d)
+
+            workers = asyncio.Semaphore(len(tasks) if max_workers is None else max_workers)
+            async def run_shard(run_dir: str, urls: List[str], event_range: Optional[Tuple[int, int]]):
+                async with workers:
+                    await _run_in_container(f_spec.main_script, f_spec.output_path, run_dir, urls, mounts, event_range)
+            await asyncio.gather(*[run_shard(d, u, r) for d, (u, r) in zip(run_dirs, tasks)])
+
         if dump_cpp:
             os.system("type " + os.path.join(str(local_run_dir), "query.cxx"))
 
         # Now that we have run, we can pluck out the result.
-        if type(f_spec.result_rep) not in result_handlers:
-            raise BaseException(f'Do not know how to process result of type {type(f_spec.result_rep.__name__)}.')
-        return result_handlers[type(f_spec.result_rep)](f_spec.result_rep, local_run_dir)
+        return extract_result(f_spec, run_dirs)
@@ -0,0 +1,217 @@
+# Run queries in a pool of long lived docker containers that have already been set up.
+from adl_func_backend.xAODlib.atlas_xaod_executor import atlas_xaod_executor, atlas_release, write_parameters
+import adl_func_backend.xAODlib.exe_atlas_xaod_docker as xd
+
+import ast
+import asyncio
+from contextlib import asynccontextmanager
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Optional
+
+# Environment variables that describe the shell rather than the release - not saved when the
+# release environment is captured.
+_shell_variables = ['PWD', 'OLDPWD', 'SHLVL', '_']
+
+def _same_dir(d1: str, d2: str) -> bool:
+    'True if the two paths point at the same directory. Paths from file urls have lost their leading slash.'
+    return os.path.normpath(d1).lstrip('\\/') == os.path.normpath(d2).lstrip('\\/')
+
+class XAODDockerPoolException(BaseException):
+    def __init__ (self, message):
+        BaseException.__init__(self, message)
+
+class _empty_slot:
+    'Stands in for a container in the idle queue when the container of a slot has to be started before it is used'
+    def __init__(self, slot: int):
+        self.slot = slot
+
+class xaod_docker_pool:
+    r'''
+    A pool of running AnalysisBase containers. The release is set up once when a container is
+    started, and each query is then run in one of them with `docker exec`. This saves the container
+    start up and release setup time for every query.
+
+    Since the mounts of a running container can't be changed, the directories a query needs are
+    fixed when the pool is created. Use `execute` as the executor for a query:
+
+        pool = xaod_docker_pool(size=4, data_dir='/data/xaods')
+        r = await ds.Select(...).AsPandasDF(...).future_value(executor=pool.execute)
+        await pool.close()
+
+    The pool must be used from a single event loop.
+    '''
+    def __init__(self, size: int = 2, max_jobs_per_container: int = 50, data_dir: Optional[str] = None,
+                 build_cache_dir: Optional[str] = None, build_workspace: Optional[str] = None,
+                 ccache_dir: Optional[str] = None):
+        r'''
+        Create the pool. No containers are started until the first query arrives or `start` is called.
+
+        Arguments:
+            size                    Number of containers to keep running
+            max_jobs_per_container  A container is replaced after it has run this many queries
+            data_dir                Local directory with the data files, mounted at /data. Local files
+                                    used by queries must be in this directory.
+            build_cache_dir         As for `use_executor_xaod_docker`
+            build_workspace         As for `use_executor_xaod_docker`. Each container gets its own
+                                    workspace so they can build in parallel.
+            ccache_dir              As for `use_executor_xaod_docker`
+        '''
+        if size < 1:
+            raise XAODDockerPoolException(f'The pool needs at least one container, not {size}.')
+        self._size = size
+        self._max_jobs = max_jobs_per_container
+        self._data_dir = data_dir
+        self._build_cache_dir = build_cache_dir
+        self._build_workspace = build_workspace
+        self._ccache_dir = ccache_dir
+
+        self._work_dir: Optional[str] = None
+        self._idle: Optional[asyncio.Queue] = None
+        self._jobs: Dict[str, int] = {}
+        self._slots: Dict[str, int] = {}
+        self._started = False
+
+    @property
+    def containers(self) -> List[str]:
+        'The ids of the containers currently in the pool'
+        return list(self._jobs.keys())
+
+    async def start(self):
+        r'''
+        Start all the containers in the pool. A slot whose container fails to start is tried
+        again when it is next used (and the first failure is raised).
+        '''
+        if self._started:
+            return
+        self._work_dir = tempfile.mkdtemp(prefix='xaod_pool_')
+        os.chmod(self._work_dir, 0o777)
+        self._idle = asyncio.Queue()
+        self._started = True
+        ids = await asyncio.gather(*[self._start_container(i) for i in range(self._size)], return_exceptions=True)
+        for slot, c in enumerate(ids):
+            self._idle.put_nowait(_empty_slot(slot) if isinstance(c, BaseException) else c)
+        errors = [c for c in ids if isinstance(c, BaseException)]
+        if len(errors) > 0:
+            raise errors[0]
+
+    async def close(self):
+        'Stop all the containers and clean up'
+        if not self._started:
+            return
+        self._started = False
+        await asyncio.gather(*[self._stop_container(c) for c in list(self._jobs.keys())])
+        shutil.rmtree(self._work_dir, ignore_errors=True)
+
+    async def _start_container(self, slot: int) -> str:
+        'Start a container, set up the release in it, and save the environment'
+        mounts = [f'-v {self._work_dir}:/pool']
+        if self._data_dir is not None:
+            mounts.append(f'-v {self._data_dir}:/data')
+        if self._build_cache_dir is not None:
+            mounts.append(f'-v {self._build_cache_dir}:/build_cache')
+        if self._build_workspace is not None:
+            workspace_dir = os.path.join(self._build_workspace, atlas_release, f'pool_{slot}')
+            os.makedirs(workspace_dir, exist_ok=True)
+            mounts.append(f'-v {workspace_dir}:/workspace')
+        if self._ccache_dir is not None:
+            mounts.append(f'-v {self._ccache_dir}:/ccache')
+
+        r, out, err = await xd.run_docker_command(f'docker run -d --rm {" ".join(mounts)} atlas/analysisbase:{atlas_release} sleep infinity')
+        if r != 0:
+            raise XAODDockerPoolException(f'Unable to start a pool container ({r}): {err}')
+        c = out.decode().strip()
+
+        ignore = '|'.join(_shell_variables)
+        setup = f'source /home/atlas/release_setup.sh && export -p | grep -v -E "^declare -x ({ignore})=" > /tmp/release_env.sh'
+        r, _, err = await xd.run_docker_command(f"docker exec {c} bash -c '{setup}'")
+        if r != 0:
+            await xd.run_docker_command(f'docker kill {c}')
+            raise XAODDockerPoolException(f'Unable to setup the release in pool container {c} ({r}): {err}')
+
+        self._jobs[c] = 0
+        self._slots[c] = slot
+        return c
+
+    async def _stop_container(self, c: str):
+        'Stop a container and forget about it'
+        del self._jobs[c]
+        del self._slots[c]
+        await xd.run_docker_command(f'docker kill {c}')
+
+    async def _healthy(self, c: str) -> bool:
+        'Check the container is still running and responds'
+        r, _, _ = await xd.run_docker_command(f'docker exec {c} true')
+        return r == 0
+
+    @asynccontextmanager
+    async def container(self):
+        r'''
+        Check out a healthy container from the pool for the duration of the context. A container that
+        no longer responds is replaced. One that has run its quota of queries is stopped once it is returned,
+        and a new one started the next time its slot is used.
+
+        If a container can't be started, the exception is raised and the slot is put back, so the next
+        use tries again. The pool never loses a slot.
+        '''
+        await self.start()
+        c = await self._idle.get()
+        try:
+            if not isinstance(c, _empty_slot) and not await self._healthy(c):
+                dead, c = c, _empty_slot(self._slots[c])
+                await self._stop_container(dead)
+            if isinstance(c, _empty_slot):
+                c = await self._start_container(c.slot)
+        except BaseException:
+            self._idle.put_nowait(c)
+            raise
+
+        self._jobs[c] += 1
+        try:
+            yield c
+        finally:
+            if self._jobs[c] >= self._max_jobs:
+                self._idle.put_nowait(_empty_slot(self._slots[c]))
+                await self._stop_container(c)
+            else:
+                self._idle.put_nowait(c)
+
+    async def execute(self, a: ast.AST):
+        r'''
+        Run a query in one of the containers in the pool.
+
+        Arguments:
+            a                   The query to run
+
+        Returns:
+            The result, as for `use_executor_xaod_docker`.
+        '''
+        exe = atlas_xaod_executor()
+        a = exe.apply_ast_transformations(a)
+        n_events = xd.count_events(a)
+        if n_events is not None:
+            return n_events
+
+        await self.start()
+        with tempfile.TemporaryDirectory(dir=self._work_dir) as local_run_dir:
+            os.chmod(local_run_dir, 0o777)
+
+            f_spec = exe.write_cpp_files(a, local_run_dir)
+            write_parameters(f_spec.parameters, f_spec.output_path)
+
+            datafile_dir = xd.write_filelist(f_spec.input_urls, local_run_dir)
+            if datafile_dir is not None and (self._data_dir is None or not _same_dir(datafile_dir, self._data_dir)):
+                raise XAODDockerPoolException(f'Data files must be in the pool data directory ({self._data_dir}), not in {datafile_dir}.')
+
+            run_dir = f'/pool/{os.path.basename(local_run_dir)}'
+            async with self.container() as c:
+                returncode, p_stdout, p_stderr = await xd.run_docker_command(f'docker exec -w {run_dir} {c} bash {run_dir}/{f_spec.main_script} {run_dir}')
+            if returncode != 0 or xd.dump_running_log:
+                print (f"Result of run: {returncode}")
+                print (f'Output:\n{p_stdout}')
+                print (f'Error:\n{p_stderr}')
+            if returncode != 0:
+                raise XAODDockerPoolException(f'Query failed in pool container {c} with error {returncode}')
+
+            return xd.extract_result(f_spec, local_run_dir)
@@ -3,10 +3,10 @@ import ast
 from collections import namedtuple
 import os
 import pickle
-from typing import Iterable
+from typing import Dict, Iterable
 from adl_func_backend.ast import ast_hash
 from adl_func_backend.xAODlib.atlas_xaod_executor import atlas_xaod_executor
-from adl_func_backend.util_LINQ import find_dataset
+from adl_func_backend.util_LINQ import find_dataset, find_query_parameters
 from adl_func_client.query_result_asts import ResultTTree
 
 class CacheExeException(BaseException):
@@ -14,28 +14,40 @@ class CacheExeException(BaseException):
         BaseException.__init__(self, message)
 
 # Return info
-HashXAODExecutorInfo = namedtuple('HashXAODExecutorInfo', 'hash main_script treename output_filename, filelist')
+HashXAODExecutorInfo = namedtuple('HashXAODExecutorInfo', 'hash main_script treename output_filename, filelist data_hash parameters')
 
-def _build_result(cache: tuple, url_list: Iterable[str]) -> HashXAODExecutorInfo:
+def _build_result(cache: tuple, url_list: Iterable[str], parameters: Dict[str, float]) -> HashXAODExecutorInfo:
     'Helper routine to build out a full result'
-    return HashXAODExecutorInfo(cache[0], cache[1], cache[2], cache[3], url_list)
+    return HashXAODExecutorInfo(cache[0], cache[1], cache[2], cache[3], url_list, ast_hash.calc_data_hash(url_list, parameters), parameters)
 
 def use_executor_xaod_hash_cache(a: ast.AST, cache_path: str) -> HashXAODExecutorInfo:
     r'''Write out the C++ code and supporting files to a cache
+
+    The code is keyed by a hash of the query alone, so running the same query on a different
+    dataset re-uses it. The hash of the dataset's file list is returned as well, to key anything
+    that depends on the data (like the output of running the query).
+
+    The values of the query's parameters aren't in the code either. They are returned, and must be
+    written to parameters.json in the directory the query is run from. They are also part of the
+    data hash.
     
     Arguments:
         a           The ast that will be transformed
         cache_path  Path the cache directory. We will write everything out in there.
 
     Returns:
-        HashXAODExecutorInfo    Named tuple with the hash and the list of files in it.
+        HashXAODExecutorInfo    Named tuple with the code hash, the list of files, the data hash, and the
+                                parameter values.
     '''
     # We can only do this if the result is going to be a ROOT file(s). So make sure.
     if not isinstance(a, ResultTTree):
         raise CacheExeException(f'Can only cache results for a ROOT tree, not for {type(a).__name__}.')
 
-    # Calculate the AST hash. If this is already around then we don't need to do very much!
-    hash = ast_hash.calc_ast_hash(a)
+    # Calculate the query hash. If this is already around then we don't need to do very much!
+    # The hash is of the transformed, canonical, form of the query so cosmetic differences don't matter.
+    exe = atlas_xaod_executor()
+    a = exe.apply_ast_transformations(a)
+    hash = ast_hash.calc_code_hash(a)
 
     # Next, see if the hash file is there.
     query_file_path = os.path.join(cache_path, hash)
@@ -45,17 +57,16 @@ def use_executor_xaod_hash_cache(a: ast.AST, cache_path: str) -> HashXAODExecuto
         file = find_dataset(a)
         with open(cache_file, 'rb') as f:
             result_cache = pickle.load(f)
-            return _build_result(result_cache, file.url)
+            return _build_result(result_cache, file.url, find_query_parameters(a))
 
     # Create the files to run in that location.
     if not os.path.exists(query_file_path):
         os.makedirs(query_file_path)
-    exe = atlas_xaod_executor()
-    f_spec = exe.write_cpp_files(exe.apply_ast_transformations(a), query_file_path)
+    f_spec = exe.write_cpp_files(a, query_file_path)
 
     # Write out the basic info for the result rep and the runner into that location.
     result_cache = (hash, f_spec.main_script, f_spec.result_rep.treename, f_spec.result_rep.filename)
     with open(os.path.join(query_file_path, 'rep_cache.pickle'), 'wb') as f:
         pickle.dump(result_cache, f)
     
-    return _build_result(result_cache, f_spec.input_urls)
+    return _build_result(result_cache, f_spec.input_urls, f_spec.parameters)
@@ -1,21 +1,39 @@
 # Hold onto the generated code
-from adl_func_backend.xAODlib.statement import block
+from adl_func_backend.xAODlib.statement import block, declare_shared_value, iftest, loop, skip_event
 import adl_func_backend.cpplib.cpp_representation as crep
 from adl_func_backend.xAODlib.util_scope import gc_scope, gc_scope_top_level
-from typing import Union
+from typing import Optional, Union
+
+class _no_emitter:
+    'Throw away emitted lines'
+    def add_line(self, l):
+        pass
 
 class generated_code:
     def __init__(self):
         self._block = block()
         self._book_block = block()
+        self._finalize_block = block()
+        self._constructor_block = block()
         self._class_vars = []
+        self._class_rep_dict = {}
         self._scope_stack = (self._block,)
         self._include_files = []
+        self._n_event_statements = 0
+        self._shared_values = []
 
     def declare_class_variable(self, var):
         'Declare a variable as an instance of the query class. var must be a cpp_rep'
         self._class_vars += [var]
 
+    def get_class_rep(self, name):
+        'Get a representation that has been defined for the whole query class'
+        return self._class_rep_dict.get(name, None)
+
+    def set_class_rep(self, name, value):
+        'Set a representation for the whole query class'
+        self._class_rep_dict[name] = value
+
     def declare_variable(self, v):
         'Declare a variable at the current scope'
         self._scope_stack[-1].declare_variable(v)
@@ -54,8 +72,140 @@ class generated_code:
             below._statements = []
             below.add_statement(st)
 
+    def event_scope(self):
+        'Return the scope of the outer most block of the query, which is run once per event'
+        return gc_scope(self._scope_stack[:1])
+
+    def declare_event_variable(self, v):
+        'Declare a variable in the outer most block of the query'
+        self._block.declare_variable(v)
+
+    def get_event_rep(self, name):
+        'Get a representation that has been defined for the whole event'
+        return self._block.get_rep(name)
+
+    def set_event_rep(self, name, value):
+        'Set a representation for the whole event'
+        self._block.set_rep(name, value)
+
+    def add_event_statement(self, st):
+        '''
+        Add a statement to the top of the outer most block of the query, ahead of any code
+        already there. Statements added this way stay in the order they were added. The
+        current cursor is not affected.
+
+        st - The statement to add. It can only depend on the event.
+        '''
+        self._block.insert_statement(self._n_event_statements, st)
+        self._n_event_statements += 1
+
+    def add_event_filter(self, reject: crep.cpp_value):
+        '''
+        Stop processing the event if `reject` is true. The test is added to the end of the outer most block of
+        the query. Statements added with `add_event_statement` from now on are only run once the test has
+        passed - so nothing that is not needed for the test is run for rejected events. The current
+        cursor is not affected.
+
+        reject - A bool value, defined in the outer most block.
+        '''
+        test = iftest(reject)
+        test.add_statement(skip_event())
+        self._block.add_statement(test)
+        self._n_event_statements = len(self._block._statements)
+
+    def loop_invariant_scope(self, scope: Union[gc_scope, gc_scope_top_level]) -> Optional[gc_scope]:
+        '''
+        Code that depends only on things defined at `scope` does not need to be run in any loop
+        that was started after `scope`. Return the scope to move that code out to: just outside the
+        outer most such loop that the current scope is in. Other blocks (like the if statement of a `Where`)
+        are not left, so the code runs no more often than it does now.
+
+        scope - The scope of the deepest thing the code depends on. The top level scope means
+                the code can run anywhere in the event.
+
+        returns:
+        None if the code can't be moved out of any loop, otherwise the scope to put it in.
+        '''
+        if scope.is_top_level():
+            depth = 1
+        else:
+            if not self.current_scope().starts_with(scope):
+                return None
+            depth = scope.depth()
+        while depth < len(self._scope_stack) and not isinstance(self._scope_stack[depth], loop):
+            depth += 1
+        if depth >= len(self._scope_stack):
+            return None
+        return gc_scope(self._scope_stack[:depth])
+
+    def add_statement_before_loop(self, scope: gc_scope, st):
+        '''
+        Add a statement to the block of `scope`, just before the loop the current scope is in
+        (see `loop_invariant_scope`). As with `add_statement`, if the statement is a block, then
+        the cursor is moved into it.
+
+        scope - A scope returned by `loop_invariant_scope`.
+        st - The statement to add
+        '''
+        depth = scope.depth()
+        outer, inner = self._scope_stack[depth-1], self._scope_stack[depth]
+        outer.insert_statement(outer._statements.index(inner), st)
+        if isinstance(st, block):
+            self._scope_stack = self._scope_stack[:depth] + (st,)
+
+    def share_value(self, value: crep.cpp_value, name: str) -> crep.cpp_shared_value:
+        '''
+        Return a value that stands in for `value`. The first time a value is asked for in a scope
+        it is declared at the current point. The same value asked for again in that scope, or a
+        deeper one, gets the same shared value - so it is only calculated once. If, once the query is
+        written, it is used only once, no variable is declared and the value itself is written in its place.
+
+        value - The value to share. It must be valid at the current scope.
+        name - Base name for the variable
+
+        returns:
+        The value to use in place of `value`
+        '''
+        key = ('shared', value.as_cpp())
+        v = self.get_rep(key)
+        if v is None:
+            # The name is not used to make other names, so it does not change them when the variable
+            # ends up not being used.
+            v = crep.cpp_shared_value('{0}_value{1}'.format(name, len(self._shared_values)), self.current_scope(), value)
+            self._shared_values.append(v)
+            self.add_statement(declare_shared_value(v))
+            self.set_rep(key, v)
+        return v
+
+    def _declare_shared_values(self):
+        '''
+        Decide which values from `share_value` are written as variables: those used more than once. The
+        query code is written out (and thrown away) with every value as a variable, to count the uses.
+        Values are looked at in the opposite order they were made, as the later ones may use the earlier
+        ones: a value that is not used at all does not use the ones in its declaration either.
+        '''
+        for v in self._shared_values:
+            v.count_uses()
+        self._block.emit(_no_emitter())
+
+        used_by = {}
+        for v in self._shared_values:
+            before = [u.uses() for u in self._shared_values]
+            v.value().as_cpp()
+            used_by[v] = [(u, u.uses() - n) for u, n in zip(self._shared_values, before) if u.uses() != n]
+            for u, n in used_by[v]:
+                u.remove_uses(n)
+
+        for v in reversed(self._shared_values):
+            if v.uses() == 0:
+                for u, n in used_by[v]:
+                    u.remove_uses(n)
+            v.set_declared(v.uses() > 1)
+
     def add_include (self, path):
-        self._include_files += [path]
+        'Include a file at the top of the generated code. Each file is included once, in the order first asked for.'
+        if path not in self._include_files:
+            self._include_files += [path]
 
     def include_files(self):
         return self._include_files
@@ -82,13 +232,33 @@ class generated_code:
     def add_book_statement(self, st, below=None):
         self._book_block.add_statement(st)
 
+    def add_constructor_statement(self, st):
+        'Add a statement to the constructor of the query class (where its properties are declared)'
+        self._constructor_block.add_statement(st)
+
+    def add_finalize_statement(self, st):
+        'Add a statement to run once, after the last event'
+        self._finalize_block.add_statement(st)
+
     def emit_query_code(self, e):
         'Emit query code'
+        self._declare_shared_values()
         self._block.emit(e)
 
     def emit_book_code(self, e):
-        'Emit the book method code'
-        self._book_block.emit(e)
+        'Emit the book method code (nothing if there is none)'
+        if not self._book_block.is_empty():
+            self._book_block.emit(e)
+
+    def emit_constructor_code(self, e):
+        'Emit the constructor code (nothing if there is none)'
+        if not self._constructor_block.is_empty():
+            self._constructor_block.emit(e)
+
+    def emit_finalize_code(self, e):
+        'Emit the finalize method code (nothing if there is none)'
+        if not self._finalize_block.is_empty():
+            self._finalize_block.emit(e)
 
     def class_declaration_code(self):
         'Return the class variable decls'
@@ -0,0 +1,243 @@
+# Plans for the generic query algorithm. A simple query (a list of columns for each jet
+# that passes some cuts) doesn't need C++ written and compiled for it. Instead it is turned
+# into a plan, which the pre-built generic query algorithm (R21Code/generic_query.cxx) reads
+# when the job starts and interprets as it runs over the events.
+#
+# A plan is text, one statement per line:
+#
+#   collection Jets <name>      The collection of objects to loop over
+#   tree <name>                 The tree the columns are written to - an entry for each object
+#   filter <expr>               Only objects for which <expr> is not zero are written out
+#   column <name> <type> <expr> A column. The type (double, float, int or bool) is the one the
+#                               compiled C++ for the query would write the column with.
+#
+# An expression is a list of words, in prefix order:
+#
+#   num <value>                 A number
+#   par <name>                  The value of a query parameter
+#   acc <name>                  A method of the object (see `object_accessors`)
+#   attr <name>                 A float attribute of the object (`getAttributeFloat`)
+#   add sub mul div             Arithmetic on the next two expressions
+#   lt le gt ge eq ne           Comparisons of the next two expressions (1 or 0)
+#   and or                      Logic on the next two expressions (short circuited)
+#   neg not abs                 Operate on the next expression
+import adl_func_backend.cpplib.cpp_ast as cpp_ast
+from adl_func_backend.cpplib.cpp_functions import FunctionAST
+from adl_func_backend.cpplib.cpp_vars import unique_name
+import adl_func_backend.xAODlib.result_handlers as rh
+from adl_func_backend.xAODlib.util_scope import top_level_scope
+import adl_func_client.query_ast as query_ast
+from adl_func_client.event_dataset import EventDataset
+import adl_func_client.query_result_asts as query_result_asts
+import ast
+from typing import List, Optional, Tuple
+
+# The methods of a jet the generic algorithm knows how to call. This list must match the
+# accessor table in generic_query.cxx.
+object_accessors = ['pt', 'eta', 'phi', 'm', 'e', 'rapidity', 'px', 'py', 'pz']
+
+# The collections the generic algorithm can loop over
+plan_collections = ['Jets']
+
+_binary_ops = {
+    ast.Add: 'add',
+    ast.Sub: 'sub',
+    ast.Mult: 'mul',
+    ast.Div: 'div',
+}
+
+_compare_ops = {
+    ast.Lt: 'lt',
+    ast.LtE: 'le',
+    ast.Gt: 'gt',
+    ast.GtE: 'ge',
+    ast.Eq: 'eq',
+    ast.NotEq: 'ne',
+}
+
+_functions = {
+    'std::abs': 'abs',
+}
+
+# The types a column can be written out as
+column_types = ['double', 'float', 'int', 'bool']
+
+class _not_supported(BaseException):
+    'Thrown when a query has something in it a plan can not do'
+    pass
+
+# The value of a lambda argument that is the object being looped over
+_the_object = 'the-object'
+
+class _plan_expr:
+    r'''
+    An expression: its words, the C++ type the compiled code would give it, and if the C++ the compiled
+    code writes for it is integral (like 2 or a < b, but not 2.0 - even though that has type int).
+    '''
+    def __init__(self, words: List[str], cpp_type: str, integral: bool = False):
+        self.words = words
+        self.cpp_type = cpp_type
+        self.integral = integral
+
+def _number_type(n) -> str:
+    'The type the compiled code gives a number (see `guess_type_from_number`)'
+    return 'int' if int(n) == n else 'double'
+
+def _is_word(s) -> bool:
+    'Can s be used as a single word in the plan?'
+    return isinstance(s, str) and len(s) > 0 and len(s.split()) == 1
+
+def _cpp_method_name(node: ast.AST) -> Optional[str]:
+    'If this is a call to C++ put in by `cpp_ast_finder`, return the name of the method it replaced'
+    if isinstance(node, ast.Call) and isinstance(node.func, cpp_ast.CPPCodeValue):
+        return node.func.method_name
+    return None
+
+class _expression_planner:
+    'Turn the body of a lambda into a plan expression'
+    def __init__(self, arguments):
+        r'''
+        arguments - dict of lambda argument name to its value: `_the_object`, a `_plan_expr`,
+                    or a tuple of them.
+        '''
+        self._arguments = arguments
+
+    def value(self, node: ast.AST):
+        'Return the value of the node: `_the_object`, a `_plan_expr`, or a tuple of them'
+        if isinstance(node, ast.Name):
+            if node.id not in self._arguments:
+                raise _not_supported()
+            return self._arguments[node.id]
+        if isinstance(node, ast.Tuple):
+            return tuple(self.expression(e) for e in node.elts)
+        return self.expression(node)
+
+    def expression(self, node: ast.AST) -> _plan_expr:
+        r'''
+        Return the expression for a single number. Its type follows the rules of the translator to C++
+        (e.g. arithmetic has the type of its left side).
+        '''
+        if isinstance(node, ast.Num):
+            return _plan_expr(['num', repr(float(node.n))], _number_type(node.n), isinstance(node.n, int))
+        if isinstance(node, query_ast.QueryParameter):
+            return _plan_expr(['par', node.name], 'double')
+        if isinstance(node, ast.Name):
+            v = self.value(node)
+            if not isinstance(v, _plan_expr):
+                raise _not_supported()
+            return v
+        if isinstance(node, ast.BinOp) and type(node.op) in _binary_ops:
+            left = self.expression(node.left)
+            right = self.expression(node.right)
+            integral = left.integral and right.integral
+            # The generic algorithm does its arithmetic in double, but dividing two integral values in C++
+            # drops the remainder.
+            if integral and isinstance(node.op, ast.Div):
+                raise _not_supported()
+            return _plan_expr([_binary_ops[type(node.op)]] + left.words + right.words, left.cpp_type, integral)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            operand = self.expression(node.operand)
+            return _plan_expr(['neg'] + operand.words, operand.cpp_type, operand.integral)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return _plan_expr(['not'] + self.expression(node.operand).words, 'bool', True)
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in _compare_ops:
+            words = [_compare_ops[type(node.ops[0])]] + self.expression(node.left).words + self.expression(node.comparators[0]).words
+            return _plan_expr(words, 'bool', True)
+        if isinstance(node, ast.BoolOp):
+            op = 'and' if isinstance(node.op, ast.And) else 'or'
+            terms = [self.expression(v).words for v in node.values]
+            r = terms[-1]
+            for t in reversed(terms[:-1]):
+                r = [op] + t + r
+            return _plan_expr(r, 'bool', True)
+        if isinstance(node, ast.Call):
+            return self.call(node)
+        raise _not_supported()
+
+    def call(self, node: ast.Call) -> _plan_expr:
+        'A call to a method of the object or to a function'
+        if isinstance(node.func, FunctionAST) and node.func.cpp_name in _functions and len(node.args) == 1:
+            arg = self.expression(node.args[0])
+            return _plan_expr([_functions[node.func.cpp_name]] + arg.words, str(node.func.cpp_return_type), arg.integral)
+        if isinstance(node.func, ast.Attribute) and node.func.attr in object_accessors and len(node.args) == 0:
+            if self.value(node.func.value) is _the_object:
+                return _plan_expr(['acc', node.func.attr], 'double')
+        if _cpp_method_name(node) == 'getAttributeFloat':
+            obj = node.func.replacement_instance_obj[1]
+            name = node.args[0].s
+            if self._arguments.get(obj) is _the_object and _is_word(name):
+                return _plan_expr(['attr', name], 'float')
+        raise _not_supported()
+
+def _plan_lambda(l: ast.Lambda, value):
+    'Return the value of the lambda called with value'
+    if not isinstance(l, ast.Lambda) or len(l.args.args) != 1:
+        raise _not_supported()
+    return _expression_planner({l.args.args[0].arg: value}).value(l.body)
+
+def _plan_sequence(node: ast.AST) -> Tuple[str, List[List[str]], object]:
+    r'''
+    Follow a sequence back to the collection it starts from.
+
+    Returns:
+        (collection, filters, value) - the collection statement, the list of filter expressions,
+        and the value of each element of the sequence.
+    '''
+    if isinstance(node, query_ast.Select):
+        collection, filters, value = _plan_sequence(node.source)
+        return collection, filters, _plan_lambda(node.selection, value)
+    if isinstance(node, query_ast.Where):
+        collection, filters, value = _plan_sequence(node.source)
+        f = _plan_lambda(node.filter, value)
+        if not isinstance(f, _plan_expr):
+            raise _not_supported()
+        return collection, filters + [f.words], value
+    if isinstance(node, query_ast.SelectMany) and isinstance(node.source, EventDataset):
+        # The objects come from a collection of the event - nothing else of the event can be used.
+        if not isinstance(node.selection, ast.Lambda):
+            raise _not_supported()
+        return _plan_sequence(node.selection.body)
+    method = _cpp_method_name(node)
+    if method in plan_collections and len(node.args) == 1 and _is_word(node.args[0].s):
+        return f'{method} {node.args[0].s}', [], _the_object
+    raise _not_supported()
+
+def query_plan(a: ast.AST) -> Optional[Tuple[str, object]]:
+    r'''
+    Plan a query for the generic query algorithm.
+
+    Args:
+        a:          The query, after `atlas_xaod_executor.apply_ast_transformations`
+
+    Returns:
+        None if the generic algorithm can't run this query. Otherwise (plan, result_rep): the text of the plan,
+        and the representation of the result the algorithm will write out.
+    '''
+    if not isinstance(a, (query_result_asts.ResultTTree, query_result_asts.ResultPandasDF, query_result_asts.ResultAwkwardArray)):
+        return None
+    try:
+        collection, filters, value = _plan_sequence(a.source)
+    except _not_supported:
+        return None
+
+    # Each element written out is a row of numbers.
+    if value is _the_object:
+        return None
+    columns = list(value) if isinstance(value, tuple) else [value]
+    if len(columns) != len(a.column_names) or not all(_is_word(n) for n in a.column_names):
+        return None
+    if not all(c.cpp_type in column_types for c in columns):
+        return None
+
+    if isinstance(a, query_result_asts.ResultTTree):
+        tree_name = unique_name(a.tree_name)
+        rep = rh.cpp_ttree_rep("ANALYSIS.root", tree_name, top_level_scope())
+    else:
+        tree_name = unique_name('pandatree')
+        rep_type = rh.cpp_pandas_rep if isinstance(a, query_result_asts.ResultPandasDF) else rh.cpp_awkward_rep
+        rep = rep_type("ANALYSIS.root", tree_name, top_level_scope())
+
+    lines = [f'collection {collection}', f'tree {tree_name}'] \
+        + [' '.join(['filter'] + f) for f in filters] \
+        + [' '.join(['column', name, c.cpp_type] + c.words) for name, c in zip(a.column_names, columns)]
+    return '\n'.join(lines) + '\n', rep
@@ -6,11 +6,27 @@ import adl_func_backend.cpplib.cpp_types as ctyp
 from adl_func_backend.cpplib.cpp_vars import unique_name
 from adl_func_client.query_result_asts import ROOTTreeFileInfo, ROOTTreeResult
 from collections import namedtuple
+import numpy as np
 import pandas as pd
 import uproot
 import os
 import sys
 import shutil
+from typing import List, Union
+
+def _run_dirs(run_dir: Union[str, List[str]]) -> List[str]:
+    'A query run in shards has several run directories'
+    return [run_dir] if isinstance(run_dir, str) else list(run_dir)
+
+def _concatenate(arrays: list):
+    'Join the arrays read back from several shards, column by column'
+    if len(arrays) == 1:
+        return arrays[0]
+    if isinstance(arrays[0], dict):
+        return {k: _concatenate([a[k] for a in arrays]) for k in arrays[0].keys()}
+    if isinstance(arrays[0], np.ndarray):
+        return np.concatenate(arrays)
+    return type(arrays[0]).concatenate(arrays)
 
 ##################
 # TTree return
@@ -27,23 +43,25 @@ def extract_result_TTree(rep, run_dir):
     a full filename along with a tree name which the client can then use to open the tree.
 
     rep: the cpp_tree_rep of the file that is going to come back.
-    run_dir: location where run wrote all the files
+    run_dir: location where run wrote all the files, or a list of them if the query was run in shards.
 
     returns:
-    path_to_root_file: Full path to the file, copied into the local directory
-    tree_name: the name of the tree.
+    ROOTTreeResult with the full path to each file, copied into the local directory, and the tree name.
     '''
     # This would be trivial other than the directory is about to be deleted. So in this case we are going to
     # need to copy the file over somewhere else!
-    df_name = os.path.join(os.getcwd(), unique_name("datafile") + ".root")
-    df_current = os.path.join(run_dir, 'data.root')
+    files = []
+    for d in _run_dirs(run_dir):
+        df_name = os.path.join(os.getcwd(), unique_name("datafile") + ".root")
+        df_current = os.path.join(d, rep.filename)
 
-    if not os.path.exists(df_current):
-        raise BaseException("Unable to find ROOT file '{0}' which contains the data we need!".format(df_current))
+        if not os.path.exists(df_current):
+            raise BaseException("Unable to find ROOT file '{0}' which contains the data we need!".format(df_current))
 
-    shutil.copyfile(df_current, df_name)
+        shutil.copyfile(df_current, df_name)
+        files.append(ROOTTreeFileInfo(df_name, rep.treename))
 
-    return ROOTTreeResult(True, [ROOTTreeFileInfo(df_name, rep.treename)])
+    return ROOTTreeResult(True, files)
 
 #############
 # Awkward Array Return
@@ -60,16 +78,19 @@ def extract_awkward_result(rep, run_dir):
     file can be removed or discarded.
 
     rep: the cpp_awkward_rep which will tell us what file to go after
-    run_dir: location where all the data was written out by the docker run.
+    run_dir: location where all the data was written out by the docker run, or a list of them if the
+             query was run in shards.
 
     returns:
     awk: THe awkward array
     '''
-    output_file = "file://{0}/{1}".format(run_dir, rep.filename)
-    data_file = uproot.open(output_file)
-    df = data_file[rep.treename].arrays()
-    data_file._context.source.close()
-    return df
+    arrays = []
+    for d in _run_dirs(run_dir):
+        output_file = "file://{0}/{1}".format(d, rep.filename)
+        data_file = uproot.open(output_file)
+        arrays.append(data_file[rep.treename].arrays())
+        data_file._context.source.close()
+    return _concatenate(arrays)
 
 #############
 # Pandas Return
@@ -80,19 +101,149 @@ class cpp_pandas_rep(cpp_value):
         self.filename = filename
         self.treename = treename
 
+def _offset_entries(df: pd.DataFrame, offset: int) -> pd.DataFrame:
+    'Add offset to the entry (event) numbers in the index of a data frame read back from a shard'
+    if isinstance(df.index, pd.MultiIndex):
+        entry = df.index.names.index('entry')
+        df.index = df.index.set_levels(df.index.levels[entry] + offset, level=entry)
+    else:
+        df.index = df.index + offset
+    return df
+
 def extract_pandas_result(rep, run_dir):
     '''
     Given the rep, and the local running directory, load the result into memory. Once we are done the
     file can be removed or discarded.
 
     rep: the cpp_pandas_rep which will tell us what file to go after
-    run_dir: location where all the data was written out by the docker run.
+    run_dir: location where all the data was written out by the docker run, or a list of them if the
+             query was run in shards.
 
     returns:
     awk: THe awkward array
     '''
-    output_file = "file://{0}/{1}".format(run_dir, rep.filename)
-    data_file = uproot.open(output_file)
-    df = data_file[rep.treename].pandas.df()
-    data_file._context.source.close()
-    return df
+    dfs = []
+    n_entries = 0
+    for d in _run_dirs(run_dir):
+        output_file = "file://{0}/{1}".format(d, rep.filename)
+        data_file = uproot.open(output_file)
+        tree = data_file[rep.treename]
+        # The entries of each shard follow on from those of the one before, as if it were one file.
+        dfs.append(_offset_entries(tree.pandas.df(), n_entries))
+        n_entries += tree.numentries
+        data_file._context.source.close()
+    return dfs[0] if len(dfs) == 1 else pd.concat(dfs)
+
+#############
+# Histogram Return
+class cpp_histogram_rep(cpp_value):
+    'This is what a histogram operator returns'
+    def __init__ (self, filename, histname, n_axes, scope):
+        cpp_value.__init__(self, unique_name("histogram"), scope, ctyp.terminal("histogram"))
+        self.filename = filename
+        self.histname = histname
+        self.n_axes = n_axes
+
+def _read_histogram(h, n_axes: int):
+    'Return the bin contents and edges of a histogram read back by uproot'
+    return (np.array(h.values),) + ((np.array(h.edges),) if n_axes == 1 else (np.array(h.xedges), np.array(h.yedges)))
+
+def _sum_histograms(hists: list):
+    'Add up the histograms filled by each shard. They all have the same binning.'
+    return (sum(h[0] for h in hists),) + tuple(hists[0][1:])
+
+def extract_histogram_result(rep, run_dir):
+    '''
+    Given the rep, read back the histogram the query filled. If the query was run in shards, their
+    histograms are added together.
+
+    rep: the cpp_histogram_rep with the file and name of the histogram
+    run_dir: location where all the data was written out by the docker run, or a list of them if the
+             query was run in shards.
+
+    returns:
+    (contents, edges) for a 1D histogram, and (contents, x_edges, y_edges) for a 2D one. All are numpy
+    arrays, and the under and overflow bins are not included.
+    '''
+    hists = []
+    for d in _run_dirs(run_dir):
+        output_file = "file://{0}/{1}".format(d, rep.filename)
+        data_file = uproot.open(output_file)
+        hists.append(_read_histogram(data_file[rep.histname], rep.n_axes))
+        data_file._context.source.close()
+    return _sum_histograms(hists)
+
+#############
+# Scalar Return
+class cpp_scalar_rep(cpp_value):
+    'This is what a reduction of the whole dataset to a single number returns'
+    def __init__ (self, filename, treename, operation, scope):
+        cpp_value.__init__(self, unique_name("scalar"), scope, ctyp.terminal("scalar"))
+        self.filename = filename
+        self.treename = treename
+        self.operation = operation
+
+def _reduce_scalar(operation: str, n: np.ndarray, value: np.ndarray):
+    '''
+    Combine the partial results written by each job. Each has the number of items it saw, `n`, and
+    its sum, min, or max, `value`. Jobs that saw no items are ignored.
+    '''
+    if operation == 'Count':
+        return int(np.sum(n))
+    if operation == 'Sum':
+        return float(np.sum(value))
+    value = value[n > 0]
+    if len(value) == 0:
+        return None
+    if operation == 'Min':
+        return float(np.min(value))
+    if operation == 'Max':
+        return float(np.max(value))
+    if operation == 'Mean':
+        return float(np.sum(value) / np.sum(n))
+    raise BaseException("Do not know how to combine the results of '{0}'".format(operation))
+
+def extract_scalar_result(rep, run_dir):
+    '''
+    Read back the partial results of a reduction, and combine them into the final number.
+
+    rep: the cpp_scalar_rep with the tree of partial results and the operation
+    run_dir: location where all the data was written out by the docker run, or a list of them if the
+             query was run in shards.
+
+    returns:
+    The number (None for the `Min`, `Max`, or `Mean` of nothing).
+    '''
+    ns = []
+    values = []
+    for d in _run_dirs(run_dir):
+        output_file = "file://{0}/{1}".format(d, rep.filename)
+        data_file = uproot.open(output_file)
+        tree = data_file[rep.treename]
+        ns.append(tree.array('n'))
+        values.append(tree.array('value'))
+        data_file._context.source.close()
+    return _reduce_scalar(rep.operation, np.concatenate(ns), np.concatenate(values))
+
+#############
+# Batch Return
+class cpp_batch_rep(cpp_value):
+    'This is what a batch of queries returns: the result of each query, in order'
+    def __init__ (self, reps, scope):
+        cpp_value.__init__(self, unique_name("batch"), scope, ctyp.terminal("batch"))
+        self.reps = reps
+
+def extract_batch_result(rep, run_dir, handlers):
+    '''
+    Given the rep for a batch of queries, extract the result of each query. They all ran together
+    and wrote their output to the same place.
+
+    rep: the cpp_batch_rep with the rep of each query
+    run_dir: location where all the data was written out by the docker run, or a list of them if the
+             query was run in shards.
+    handlers: dictionary from the type of each query's rep to the function that extracts its result.
+
+    returns:
+    A list of the result of each query, in order.
+    '''
+    return [handlers[type(r)](r, run_dir) for r in rep.reps]
@@ -18,6 +18,18 @@ class block:
         'Add statement s to the list of statements'
         self._statements += [s]
 
+    def is_empty(self):
+        'Return true if there are no statements or variables in this block'
+        return len(self._statements) == 0 and len(self._variables) == 0
+
+    def is_last_statement(self, s):
+        'Return true if s is the last statement in this block'
+        return len(self._statements) > 0 and self._statements[-1] is s
+
+    def insert_statement(self, index, s):
+        'Insert statement s so it is at position index in the list of statements'
+        self._statements.insert(index, s)
+
     def declare_variable(self, n):
         'Declare a variable n, which is of type cpp_variable'
         self._variables += [n]
@@ -25,12 +37,16 @@ class block:
     def emit(self, e):
         'Render the block of code'
         e.add_line("{")
+        self.emit_body(e)
+        e.add_line("}")
+
+    def emit_body(self, e):
+        'Render the variable declarations and statements of the block'
         for v in self._variables:
             init_value = "" if not isinstance(v,crep.cpp_variable) or not v.initial_value() else " ({0})".format(v.initial_value().as_cpp())
             e.add_line("{0} {1}{2};".format(v.cpp_type(), v.as_cpp(), init_value))
         for s in self._statements:
             s.emit(e)
-        e.add_line("}")
 
     def get_rep(self, name: Any) -> Any:
         '''Return the representation for some object. If we do not know its value
@@ -59,6 +75,21 @@ class block:
             raise BlockException(f'Internal Error: Representation for {str(name)} already exists. Cannot set twice')
         self._rep_dict[name] = value
 
+    def forget_rep(self, name: Any):
+        '''Remove the value cached for `name`, if there is one.
+
+        Args:
+            name:       The lookup key
+        '''
+        self._rep_dict.pop(name, None)
+
+class inline_block(block):
+    'A group of statements that is not its own C++ scope. Variables declared here can be used after it.'
+
+    def emit(self, e):
+        'Render the variables and statements, without the surrounding brackets'
+        self.emit_body(e)
+
 class loop(block):
     'A for loop'
 
@@ -70,12 +101,37 @@ class loop(block):
         block.__init__(self)
         self._collection = collection_rep
         self._loop_variable = loop_var_rep
+        self._exit_condition = None
+
+    def size(self) -> str:
+        'Return the C++ for the number of elements in the collection we are looping over'
+        return '({0}).size()'.format(self._collection.as_cpp())
+
+    def fusion_key(self):
+        'Key for other loops over the same collection in the same block, so they can be merged with this one'
+        return ('loop', self._collection.as_cpp())
+
+    def set_exit_condition(self, condition: crep.cpp_value):
+        '''Leave the loop once everything in the loop has run for an element, and condition is true.
+
+        Args:
+            condition:  A bool value, tested at the very end of the loop
+        '''
+        if self._exit_condition is not None:
+            raise BlockException('Internal Error: a loop can only have one exit condition')
+        self._exit_condition = condition
 
     def emit(self, e):
         'Emit a for loop enclosed by a block of code'
-        e.add_line("for (auto {0} : {1})".format(
+        e.add_line("for (auto&& {0} : {1})".format(
             self._loop_variable.as_cpp(), self._collection.as_cpp()))
-        block.emit(self, e)
+        e.add_line("{")
+        self.emit_body(e)
+        if self._exit_condition is not None:
+            exit_test = iftest(self._exit_condition)
+            exit_test.add_statement(break_loop())
+            exit_test.emit(e)
+        e.add_line("}")
 
 class iftest(block):
     'An if statement'
@@ -97,6 +153,18 @@ class elsephrase(block):
         e.add_line('else')
         block.emit(self, e)
 
+class break_loop:
+    'Leave the loop we are in'
+
+    def emit(self, e):
+        e.add_line('break;')
+
+class skip_event:
+    'Stop processing this event, and go on to the next one'
+
+    def emit(self, e):
+        e.add_line('return StatusCode::SUCCESS;')
+
 class book_ttree:
     'Book a TTree for writing out. Meant to be in the Book method'
 
@@ -105,12 +173,14 @@ class book_ttree:
         self._leaves = leaves
 
     def emit(self, e):
-        'Emit the book statement for a tree'
+        'Emit the book statement for a tree. In its own block, as several trees can be booked.'
         e.add_line('ANA_CHECK (book (TTree ("{0}", "My analysis ntuple")));'.format(
             self._tree_name))
+        e.add_line('{')
         e.add_line('auto myTree = tree ("{0}");'.format(self._tree_name))
         for var_pair in self._leaves:
             e.add_line('myTree->Branch("{0}", &{1});'.format(var_pair[0], var_pair[1].as_cpp()))
+        e.add_line('}')
 
 
 class ttree_fill:
@@ -123,6 +193,44 @@ class ttree_fill:
         e.add_line('tree("{0}")->Fill();'.format(self._tree_name))
 
 
+class book_histogram:
+    'Book a 1D or 2D histogram, and keep a pointer to it so it does not have to be looked up for every fill'
+
+    def __init__(self, hist_name, hist_var, binning):
+        self._hist_name = hist_name
+        self._hist_var = hist_var
+        self._binning = binning
+
+    def emit(self, e):
+        axes = ', '.join('{0}, {1}, {2}'.format(*a) for a in self._binning)
+        h_class, h_getter = ('TH1D', 'hist') if len(self._binning) == 1 else ('TH2D', 'hist2d')
+        e.add_line('ANA_CHECK (book ({0} ("{1}", "{1}", {2})));'.format(h_class, self._hist_name, axes))
+        e.add_line('{0} = {1} ("{2}");'.format(self._hist_var.as_cpp(), h_getter, self._hist_name))
+
+
+class histogram_fill:
+    'Fill a histogram'
+
+    def __init__(self, hist_var, values):
+        self._hist_var = hist_var
+        self._values = values
+
+    def emit(self, e):
+        e.add_line('{0}->Fill({1});'.format(self._hist_var.as_cpp(), ', '.join(v.as_cpp() for v in self._values)))
+
+
+class declare_property:
+    'Declare a class variable as a property of the algorithm, so it can be set when the job is configured'
+
+    def __init__(self, property_name, var):
+        self._property_name = property_name
+        self._var = var
+
+    def emit(self, e):
+        e.add_line('{0} = 0;'.format(self._var.as_cpp()))
+        e.add_line('declareProperty("{0}", {1}, "Query parameter {0}");'.format(self._property_name, self._var.as_cpp()))
+
+
 class xaod_get_collection:
     def __init__(self, collection_name, var_name):
         self._collection_name = collection_name
@@ -147,6 +255,19 @@ class set_var:
     def emit(self, e):
         e.add_line('{0} = {1};'.format(self._target.as_cpp(), self._value.as_cpp()))
 
+class declare_shared_value:
+    'Declare the variable of a shared value. Nothing is written if the value is not written as a variable.'
+
+    def __init__(self, shared_value):
+        r'''
+        shared_value: The cpp_shared_value to declare
+        '''
+        self._shared_value = shared_value
+
+    def emit(self, e):
+        if self._shared_value.is_declared():
+            e.add_line('{0} {1} = {2};'.format(self._shared_value.cpp_type(), self._shared_value.variable_name(), self._shared_value.value().as_cpp()))
+
 class push_back:
     'push a variable onto a vector'
 
@@ -161,17 +282,31 @@ class push_back:
         e.add_line('{0}.push_back({1});'.format(self._target.as_cpp(), self._value.as_cpp()))
 
 class container_clear:
-    'push a variable onto a vector'
+    'Empty a vector (it keeps the memory it has allocated)'
 
     def __init__(self, collection):
         r'''
-        target_col, value_var: representations we will use
+        collection: representation of the vector we will clear
         '''
         self._collection = collection
 
     def emit(self, e):
         e.add_line('{0}.clear();'.format(self._collection.as_cpp()))
 
+class container_reserve:
+    'Make sure a vector has room for a number of elements, so it does not grow while it is filled'
+
+    def __init__(self, collection, size: str):
+        r'''
+        collection: representation of the vector
+        size: C++ for the number of elements
+        '''
+        self._collection = collection
+        self._size = size
+
+    def emit(self, e):
+        e.add_line('{0}.reserve({1});'.format(self._collection.as_cpp(), self._size))
+
 class arbitrary_statement:
     'An arbitrary line of C++ code. Avoid if possible, as it makes analysis impossible'
     def __init__(self, line):
@@ -33,6 +33,10 @@ class gc_scope:
         'Return the nth frame block. -1 means the last one, 0 means the deepest (top) one.'
         return self._scope_stack[key]
 
+    def depth(self) -> int:
+        'Return the number of blocks this scope is nested in (1 for the outer most block of the query)'
+        return len(self._scope_stack)
+
     def declare_variable(self, var) -> None:
         'Declare a class at the scope level'
         self._scope_stack[-1].declare_variable(var)
@@ -61,6 +65,10 @@ class gc_scope_top_level:
         return True
     def __getitem__(self, key: int) -> gc_scope:
         raise BaseException("This should never be called. Internal error")
+
+    def depth(self) -> int:
+        'The top level is outside of every block'
+        return 0
     
     def starts_with(self, c):
         'Starts with can only be true for top level if the other guy is top level'
@@ -77,3 +85,18 @@ def deepest_scope(v1, v2):
     if s1.starts_with(s2):
         return v1
     return v2
+
+def dependency_scope(reps):
+    '''
+    Returns the scope where all the reps are defined (the deepest of their scopes). If there are
+    no reps, this is the top level scope. Returns None if the reps are not all defined along
+    the same path of scopes.
+    '''
+    scope = top_level_scope()
+    for r in reps:
+        s = r.scope()
+        if s.starts_with(scope):
+            scope = s
+        elif not scope.starts_with(s):
+            return None
+    return scope
@@ -1,13 +1,21 @@
 # An Object stream represents a stream of objects, floats, integers, etc.
 import adl_func_client.query_ast as query_ast
-from adl_func_client.query_result_asts import ResultTTree, ResultAwkwardArray, ResultPandasDF
+from adl_func_client.query_result_asts import ResultTTree, ResultAwkwardArray, ResultPandasDF, ResultHistogram, ResultScalar, QueryBatch
 from adl_func_client.util_ast_LINQ import parse_as_ast
 # import ast
-from typing import Any, Callable
+from typing import Any, Callable, Iterable, Tuple
 import asyncio
 import ast
 import os
 
+def _axis(bins: int, low: float, high: float) -> Tuple[int, float, float]:
+    'Check the binning of a histogram axis'
+    if not isinstance(bins, int) or bins <= 0:
+        raise BaseException(f'The number of bins of a histogram must be a positive integer, not {bins}.')
+    if not low < high:
+        raise BaseException(f'The low edge of a histogram ({low}) must be below the high edge ({high}).')
+    return (bins, float(low), float(high))
+
 class ObjectStream:
     r'''
     Represents the AST to produce a stream of objects. The objects can be events,
@@ -104,6 +112,70 @@ class ObjectStream:
         '''
         return ObjectStream(ResultAwkwardArray(self._ast, columns))
 
+    def AsHistogram(self, bins: int, low: float, high: float, weight: bool = False):
+        r'''
+        Terminal - fill a histogram with the items in the stream. The histogram is filled as the events are
+        read, so only its bin contents come back (and not every item).
+
+        Args:
+            bins:           Number of bins
+            low:            Low edge of the first bin
+            high:           High edge of the last bin
+            weight:         If true, each item is a tuple `(value, weight)`. Otherwise each item is the value.
+
+        Returns:
+            A new ObjectStream. Its value is `(contents, edges)`, numpy arrays like `numpy.histogram` returns.
+            Underflow and overflow are not included.
+        '''
+        return ObjectStream(ResultHistogram(self._ast, (_axis(bins, low, high),), weight))
+
+    def AsHistogram2D(self, x_bins: int, x_low: float, x_high: float, y_bins: int, y_low: float, y_high: float,
+                      weight: bool = False):
+        r'''
+        Terminal - fill a 2D histogram with the items in the stream. Each item is a tuple `(x, y)`, or
+        `(x, y, weight)` if `weight` is true.
+
+        Args:
+            x_bins, x_low, x_high:  Binning of the x axis (see `AsHistogram`)
+            y_bins, y_low, y_high:  Binning of the y axis
+            weight:                 If true, the last item of each tuple is its weight
+
+        Returns:
+            A new ObjectStream. Its value is `(contents, x_edges, y_edges)`, numpy arrays like `numpy.histogram2d`
+            returns.
+        '''
+        return ObjectStream(ResultHistogram(self._ast, (_axis(x_bins, x_low, x_high), _axis(y_bins, y_low, y_high)), weight))
+
+    def Count(self):
+        r'''
+        Terminal - the number of items in the stream, over the whole dataset.
+        '''
+        return ObjectStream(ResultScalar(self._ast, 'Count'))
+
+    def Sum(self):
+        r'''
+        Terminal - the sum of the items in the stream, over the whole dataset. The items must be numbers.
+        '''
+        return ObjectStream(ResultScalar(self._ast, 'Sum'))
+
+    def Min(self):
+        r'''
+        Terminal - the smallest item in the stream, over the whole dataset, or None if there are no items.
+        '''
+        return ObjectStream(ResultScalar(self._ast, 'Min'))
+
+    def Max(self):
+        r'''
+        Terminal - the largest item in the stream, over the whole dataset, or None if there are no items.
+        '''
+        return ObjectStream(ResultScalar(self._ast, 'Max'))
+
+    def Mean(self):
+        r'''
+        Terminal - the mean of the items in the stream, over the whole dataset, or None if there are no items.
+        '''
+        return ObjectStream(ResultScalar(self._ast, 'Mean'))
+
     def _get_executor(self, executor: Callable[[ast.AST], Any] = None) -> Callable[[ast.AST], Any]:
         r'''
         Returns an executor that can be used to run this.
@@ -179,4 +251,24 @@ class ObjectStream:
             loop = asyncio.ProactorEventLoop() # for subprocess' pipes on Windows
         else:
             loop = asyncio.get_event_loop()
-        return loop.run_until_complete(self.future_value(executor))
\ No newline at end of file
+        return loop.run_until_complete(self.future_value(executor))
+
+def batch(queries: Iterable[ObjectStream]) -> ObjectStream:
+    r'''
+    Run several queries over the same dataset at once. The data is only read once for all of them.
+
+    Args:
+        queries:    The queries. Each must end with `AsROOTTTree`, `AsPandasDF`, `AsAwkwardArray`,
+                    `AsHistogram`, or one of the reductions (`Count`, `Sum`, ...), and they must all start from
+                    the same `EventDataset`.
+
+    Returns:
+        An ObjectStream whose value is a list of the result of each query, in the same order.
+    '''
+    asts = [q._ast for q in queries]
+    if len(asts) == 0:
+        raise BaseException('A batch of queries needs at least one query.')
+    for a in asts:
+        if not isinstance(a, (ResultTTree, ResultPandasDF, ResultAwkwardArray, ResultHistogram, ResultScalar)):
+            raise BaseException(f'Only queries that end with AsROOTTTree, AsPandasDF, AsAwkwardArray, AsHistogram, or a reduction can be batched, not {type(a).__name__}.')
+    return ObjectStream(QueryBatch(asts))
@@ -1,6 +1,7 @@
 # Event dataset
 from urllib import parse
 from adl_func_client.ObjectStream import ObjectStream
+from adl_func_client.query_ast import QueryNode
 import ast
 from typing import Union, Iterable
 
@@ -27,7 +28,7 @@ def fixup_url(url:str, parsed_url) -> str:
         path = path + parsed_url.path
     return f'file:///{path}'
 
-class EventDataset(ObjectStream, ast.AST):
+class EventDataset(ObjectStream, QueryNode):
     r'''
     The URL for an event dataset. 
     '''
@@ -58,9 +59,15 @@ class EventDataset(ObjectStream, ast.AST):
                     raise EventDatasetURLException(f'EventDataSet({l_url}) has no scheme (file://, localds://, etc.)')
                 if (r.netloc is None or len(r.netloc) == 0) and len(r.path) == 0:
                     raise EventDatasetURLException(f'EventDataSet({l_url}) has no dataset or filename')
-            self.url = [fixup_url(u, r) for u in l_url]
+            self.url = [fixup_url(u, r) for u, r in zip(l_url, r_list)]
         else:
             self.url = url
 
         self._ast = self
-        self._fields = ('url',)
\ No newline at end of file
+        self._fields = ('url',)
+
+    def _hash_fields(self, abstract_datasets: bool):
+        'When datasets are abstracted, all datasets look like one with no files'
+        if abstract_datasets:
+            return [('url', None)]
+        return QueryNode._hash_fields(self, abstract_datasets)
@@ -7,10 +7,162 @@
 # Of course, this being python, it is possible to add new things to the class
 # member variables.
 import ast
+import hashlib
+import weakref
+from typing import Tuple
+
+###############################
+# Structural hashing
+#
+# Each query node caches a hash built from the hashes of its fields (a Merkle hash). Building a new
+# query on top of an old one only hashes the new nodes. When a field of a node is assigned, the cached
+# hash of that field, and of every node above it, is thrown away - so re-hashing only touches the path
+# from the change to the top. Fields must be assigned, not modified in place (e.g. `node.url = new_list`,
+# not `node.url.append(...)`), for this to work.
+#
+# This goes for regular python ast nodes (e.g. a `Lambda`) too: their hash is cached along with the field
+# that holds them, so a lambda changed in place keeps its old hash. Assign a new lambda to the field instead.
+
+# For each query node, the query nodes that hold it, and in which of their fields. Links are never
+# removed - at worst a parent's hash is thrown away when it didn't need to be.
+_parents = weakref.WeakKeyDictionary()
+
+# Cached hashes that should not be pickled or copied
+_hash_caches = ('_node_hashes', '_field_hashes', '_hashed')
+
+def _query_children(v):
+    'Return the query nodes in v, looking through lists and regular python ast nodes'
+    if isinstance(v, QueryNode):
+        yield v
+    elif isinstance(v, (list, tuple)):
+        for i in v:
+            yield from _query_children(i)
+    elif isinstance(v, ast.AST):
+        for _, f in ast.iter_fields(v):
+            yield from _query_children(f)
+
+def _value_hash(v, abstract_datasets: bool) -> str:
+    'Return the structural hash of a value'
+    if isinstance(v, QueryNode):
+        return v.node_hash(abstract_datasets)
+    h = hashlib.md5()
+    if isinstance(v, ast.AST):
+        h.update(type(v).__name__.encode())
+        for f, fv in ast.iter_fields(v):
+            h.update(f'\0{f}='.encode())
+            h.update(_value_hash(fv, abstract_datasets).encode())
+    elif isinstance(v, (list, tuple)):
+        h.update(b'[')
+        for i in v:
+            h.update(_value_hash(i, abstract_datasets).encode())
+            h.update(b',')
+    else:
+        h.update(repr(v).encode())
+    return h.hexdigest()
+
+def value_hash(v, abstract_datasets: bool = False) -> str:
+    r'''
+    Return the structural hash of a value in an AST.
+
+    Args:
+        v:                  A query node, a python ast node, a list of them, or a simple value.
+        abstract_datasets:  If true, all datasets hash the same, no matter what files they contain (and
+                            so do query parameters, no matter what their value).
+
+    Returns:
+        Hex digest of `v`. Two values that would `ast.dump` the same have the same hash.
+    '''
+    return _value_hash(v, abstract_datasets)
+
+class QueryNode(ast.AST):
+    r'''
+    Base class for all the query AST nodes. Keeps a cached hash of the node's structure.
+    '''
+    def __setattr__(self, name, value):
+        ast.AST.__setattr__(self, name, value)
+        # Nodes often set their fields before they set _fields.
+        if name == '_fields':
+            self._invalidate_hash()
+            for f in value:
+                self._adopt(f, getattr(self, f, None))
+        elif name in getattr(self, '_fields', ()):
+            self._invalidate_hash({name})
+            self._adopt(name, value)
+
+    def __delattr__(self, name):
+        ast.AST.__delattr__(self, name)
+        if name in getattr(self, '_fields', ()):
+            self._invalidate_hash({name})
+
+    def __reduce__(self):
+        # The cached hashes are cheap to rebuild - no need to send them along.
+        r = ast.AST.__reduce__(self)
+        state = {k: v for k, v in r[2].items() if k not in _hash_caches}
+        return (r[0], r[1], state) + tuple(r[3:])
+
+    def __setstate__(self, state):
+        # A copy (or an unpickled node) gets its fields without going through __setattr__, so
+        # the query nodes in them have to be told who holds them.
+        self.__dict__.update(state)
+        for f in getattr(self, '_fields', ()):
+            self._adopt(f, getattr(self, f, None))
+
+    def _adopt(self, field: str, value):
+        'Record that the query nodes in value are in our field'
+        for c in _query_children(value):
+            _parents.setdefault(c, weakref.WeakKeyDictionary()).setdefault(self, set()).add(field)
+
+    def _invalidate_hash(self, fields = None):
+        r'''
+        Throw away our cached hash, and those of all nodes that contain us.
+
+        Args:
+            fields:     The fields whose cached hashes are no longer good. None for all of them.
+        '''
+        field_hashes = self.__dict__.get('_field_hashes')
+        if field_hashes:
+            for k in [k for k in field_hashes if fields is None or k[0] in fields]:
+                del field_hashes[k]
+        self.__dict__.pop('_node_hashes', None)
+        if self.__dict__.pop('_hashed', False):
+            for p, p_fields in list(_parents.get(self, {}).items()):
+                p._invalidate_hash(p_fields)
+
+    def _hash_fields(self, abstract_datasets: bool):
+        'The (name, value) pairs that go into our hash'
+        return ast.iter_fields(self)
+
+    def node_hash(self, abstract_datasets: bool = False) -> str:
+        r'''
+        Return the structural hash of this node, calculating it if it isn't cached.
+
+        Args:
+            abstract_datasets:  If true, all datasets hash the same, no matter what files they contain (and
+                            so do query parameters, no matter what their value).
+
+        Returns:
+            Hex digest of this node and everything below it.
+        '''
+        hashes = self.__dict__.setdefault('_node_hashes', {})
+        if abstract_datasets in hashes:
+            return hashes[abstract_datasets]
+
+        # The nodes that contain us may now hold on to our hash, and must hear if it changes.
+        self.__dict__['_hashed'] = True
+        field_hashes = self.__dict__.setdefault('_field_hashes', {})
+        h = hashlib.md5(type(self).__name__.encode())
+        for f, v in self._hash_fields(abstract_datasets):
+            key = (f, abstract_datasets)
+            if key not in field_hashes:
+                field_hashes[key] = _value_hash(v, abstract_datasets)
+            h.update(f'\0{f}='.encode())
+            h.update(field_hashes[key].encode())
+        hashes[abstract_datasets] = h.hexdigest()
+        return hashes[abstract_datasets]
 
 ###############################
 # First, the sequences
-class SelectMany(ast.AST):
+class SelectMany(QueryNode):
     r"""
     AST node for SelectMany. A selection function picks out
     a collection, and then one iterates over that collection.
@@ -31,7 +183,7 @@ class SelectMany(ast.AST):
         self._fields = ('source', 'selection')
 
 
-class Select(ast.AST):
+class Select(QueryNode):
     r"""
     AST node for Select. Transforms the input to the output by applying
     a selection function.
@@ -52,7 +204,7 @@ class Select(ast.AST):
         self.source = source
         self._fields = ('source', 'selection')
 
-class Where(ast.AST):
+class Where(QueryNode):
     r'''
     AST node for filtering: Where. Filters input, only allowing parts of the sequence that
     satisfy the operator to move on.
@@ -74,7 +226,7 @@ class Where(ast.AST):
         self._fields = ('source', 'filter')
 
 # The terminals
-class First(ast.AST):
+class First(QueryNode):
     r'''
     AST Node for taking the first element of a sequence. Returns the object for use, and also pops the sequence
     up one level.
@@ -87,4 +239,81 @@ class First(ast.AST):
         source - AST of the source sequence.
         '''
         self.source = source
-        self._fields= ('source',)
\ No newline at end of file
+        self._fields= ('source',)
+
+
+class AnyOf(QueryNode):
+    r'''
+    AST Node for testing if any element of a sequence passes a test. Returns True or False.
+    '''
+
+    def __init__ (self, source = None, filter = None):
+        r'''
+        Initialize the AnyOf AST node (`Any` in a query).
+
+        source - AST of the source sequence.
+        filter - A lambda that returns True/False for each element. If None, then
+                 test if there are any elements at all.
+        '''
+        self.source = source
+        self.filter = filter
+        self._fields = ('source', 'filter')
+
+
+class AllOf(QueryNode):
+    r'''
+    AST Node for testing if all elements of a sequence pass a test. Returns True or False.
+    '''
+
+    def __init__ (self, source = None, filter = None):
+        r'''
+        Initialize the AllOf AST node (`All` in a query).
+
+        source - AST of the source sequence.
+        filter - A lambda that returns True/False for each element.
+        '''
+        self.source = source
+        self.filter = filter
+        self._fields = ('source', 'filter')
+
+
+class Take(QueryNode):
+    r'''
+    AST Node for taking the first few elements of a sequence. Returns a sequence with at most
+    that many elements.
+    '''
+
+    def __init__ (self, source = None, count = None):
+        r'''
+        Initialize the Take AST node.
+
+        source - AST of the source sequence.
+        count - AST for the number of elements to take.
+        '''
+        self.source = source
+        self.count = count
+        self._fields = ('source', 'count')
+
+class QueryParameter(QueryNode):
+    r'''
+    AST Node for a named constant in a lambda whose value is only given to the query when it runs.
+    Written as `Parameter("pt_cut", 30.0)` in a lambda. Queries that differ only in the values of their
+    parameters compile to the same code.
+    '''
+
+    def __init__ (self, name = None, value = None):
+        r'''
+        Initialize the QueryParameter AST node.
+
+        name - Name of the parameter. Must be a valid identifier.
+        value - The value (a number) to use for this run of the query.
+        '''
+        self.name = name
+        self.value = value
+        self._fields = ('name', 'value')
+
+    def _hash_fields(self, abstract_datasets: bool):
+        'Like the datasets, the value is data the code runs on, not part of the code'
+        if abstract_datasets:
+            return [('name', self.name)]
+        return QueryNode._hash_fields(self, abstract_datasets)
@@ -1,8 +1,9 @@
 # AST and friends that denote a note that will emit a TTree.
 import ast
 from collections import namedtuple
+from adl_func_client.query_ast import QueryNode
 
-class ResultTTree(ast.AST):
+class ResultTTree(QueryNode):
     r'''
     An AST node that transforms a iterator into a TTree file.
     '''
@@ -26,7 +27,7 @@ ROOTTreeFileInfo = namedtuple('ROOTTreeFileInfo', 'filename treename')
 # is present.
 ROOTTreeResult = namedtuple('ROOTTreeResult', 'is_complete fileinfo_list')
 
-class ResultPandasDF(ast.AST):
+class ResultPandasDF(QueryNode):
     r'''
     An AST node that indicates we should be rendering everything
     coming into us as a Pandas DF. This will have restrictions on the
@@ -44,7 +45,7 @@ class ResultPandasDF(ast.AST):
         self.column_names = column_names
         self._fields=('source', 'column_names')
 
-class ResultAwkwardArray(ast.AST):
+class ResultAwkwardArray(QueryNode):
     r'''
     An AST node that indicates we should be rendering everything
     coming into us as an awkward array.
@@ -60,3 +61,55 @@ class ResultAwkwardArray(ast.AST):
         self.source = source
         self.column_names = column_names
         self._fields=('source', 'column_names')
+
+class ResultHistogram(QueryNode):
+    r'''
+    An AST node that fills a histogram with the items of the stream. The histogram is filled as the
+    data is read, so only its bin contents come back.
+    '''
+
+    def __init__(self, source=None, binning=None, weight=False):
+        r'''
+        Initialize the histogram AST node.
+
+        source - The iterator containing the values to fill the histogram with. Each is a number (1D), or a
+                 tuple of a number for each axis. If `weight` is true, the weight is the last item of the tuple.
+        binning - A tuple with a (number of bins, low edge, high edge) tuple for each axis.
+        weight - True if each item carries a weight.
+        '''
+        self.source = source
+        self.binning = binning
+        self.weight = weight
+        self._fields = ('source', 'binning', 'weight')
+
+class ResultScalar(QueryNode):
+    r'''
+    An AST node that reduces all the items of the stream, over the whole dataset, to a single number.
+    '''
+
+    def __init__(self, source=None, operation=None):
+        r'''
+        Initialize the scalar AST node.
+
+        source - The iterator containing the items to reduce. Except for `Count`, each must be a number.
+        operation - One of `Count`, `Sum`, `Min`, `Max`, or `Mean`.
+        '''
+        self.source = source
+        self.operation = operation
+        self._fields = ('source', 'operation')
+
+class QueryBatch(QueryNode):
+    r'''
+    An AST node that runs several queries over the same dataset at once (so the data is read only once).
+    Its result is a list of the result of each query, in order.
+    '''
+
+    def __init__(self, queries=None):
+        r'''
+        Initialize the batch AST node.
+
+        queries - List of the queries. Each must end in a terminal that writes out its data (`ResultTTree`,
+                  `ResultPandasDF`, `ResultAwkwardArray`, `ResultHistogram`, or `ResultScalar`).
+        '''
+        self.queries = queries
+        self._fields = ('queries',)
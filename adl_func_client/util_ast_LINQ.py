@@ -36,7 +36,7 @@ class replace_LINQ_operators(ast.NodeTransformer):
 
     ObjectStream has methods called Select and SelectMany. When they are called, they build up the AST tree. But they do that
     by creating Select and SelectMany, etc., ast nodes. When we parse a lambda passed as text, that does not happen. This
-    NodeTransformer does that replacement in-place.
+    NodeTransformer does that replacement in-place. It also turns `Parameter("name", value)` into a `QueryParameter`.
     '''
 
     def visit_Call(self, node: ast.Call) -> Optional[ast.AST]:
@@ -46,19 +46,61 @@ class replace_LINQ_operators(ast.NodeTransformer):
         if isinstance(node.func, ast.Attribute):
             func_name =  node.func.attr
             if func_name == "Select":
+                check_argument_count(node, func_name, [1])
                 source = self.visit(node.func.value)
                 selection = self.visit(node.args[0])
                 return query_ast.Select(source, selection)
             elif func_name == "SelectMany":
+                check_argument_count(node, func_name, [1])
                 source = self.visit(node.func.value)
                 selection = self.visit(node.args[0])
                 return query_ast.SelectMany(source, selection)
             elif func_name == "Where":
+                check_argument_count(node, func_name, [1])
                 source = self.visit(node.func.value)
                 filter = self.visit(node.args[0])
                 return query_ast.Where(source, filter)
             elif func_name == "First":
+                check_argument_count(node, func_name, [0])
                 source = self.visit(node.func.value)
                 return query_ast.First(source)
+            elif func_name == "Any":
+                check_argument_count(node, func_name, [0, 1])
+                source = self.visit(node.func.value)
+                filter = self.visit(node.args[0]) if len(node.args) > 0 else None
+                return query_ast.AnyOf(source, filter)
+            elif func_name == "All":
+                check_argument_count(node, func_name, [1])
+                source = self.visit(node.func.value)
+                filter = self.visit(node.args[0])
+                return query_ast.AllOf(source, filter)
+            elif func_name == "Take":
+                check_argument_count(node, func_name, [1])
+                source = self.visit(node.func.value)
+                count = self.visit(node.args[0])
+                return query_ast.Take(source, count)
             # Fall through to process the inside in the next step.
+        elif isinstance(node.func, ast.Name) and node.func.id == "Parameter":
+            return parameter_node(node)
         return self.generic_visit(node)
+
+def check_argument_count(node: ast.Call, name: str, counts):
+    'Make sure a call to a LINQ operator has a number of arguments it can take'
+    if len(node.args) not in counts:
+        allowed = ' or '.join(str(c) for c in counts)
+        raise BaseException(f'{name} takes {allowed} argument(s), not {len(node.args)}: {ast.dump(node)}')
+
+def parameter_node(node: ast.Call) -> query_ast.QueryParameter:
+    'Turn a call `Parameter("name", value)` into a query parameter'
+    if len(node.args) != 2:
+        raise BaseException(f'Parameter needs a name and a value: {ast.dump(node)}')
+    try:
+        name = ast.literal_eval(node.args[0])
+        value = ast.literal_eval(node.args[1])
+    except ValueError:
+        raise BaseException(f'The name and value of a Parameter must be constants: {ast.dump(node)}')
+    if not isinstance(name, str) or not name.isidentifier():
+        raise BaseException(f'The name of a Parameter must be a valid identifier, not {name!r}')
+    if type(value) not in [int, float]:
+        raise BaseException(f'The value of Parameter {name} must be a number, not {value!r}')
+    return query_ast.QueryParameter(name, value)
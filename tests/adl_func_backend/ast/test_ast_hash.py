@@ -36,4 +36,111 @@ def test_slightly_different_queries():
     a2 = build_ast_array_2('file://root1.root')
 
     assert ast_hash.calc_ast_hash(a1) != ast_hash.calc_ast_hash(a2)
-    
\ No newline at end of file
+    
+def test_code_hash_same_for_different_files():
+    a1 = build_ast("file://root1.root")
+    a2 = build_ast(["file://root1.root", "file://root2.root"])
+    assert ast_hash.calc_code_hash(a1) == ast_hash.calc_code_hash(a2)
+
+def test_code_hash_different_queries():
+    a1 = build_ast_array_1('file://root1.root')
+    a2 = build_ast_array_2('file://root1.root')
+    assert ast_hash.calc_code_hash(a1) != ast_hash.calc_code_hash(a2)
+
+def test_code_hash_leaves_dataset_alone():
+    a = build_ast("file://root1.root")
+    ast_hash.calc_code_hash(a)
+    assert ast_hash.calc_ast_hash(a) == ast_hash.calc_ast_hash(build_ast("file://root1.root"))
+
+def test_data_hash_same():
+    assert ast_hash.calc_data_hash(['file:///a.root']) == ast_hash.calc_data_hash(['file:///a.root'])
+
+def test_data_hash_extra_file():
+    assert ast_hash.calc_data_hash(['file:///a.root']) != ast_hash.calc_data_hash(['file:///a.root', 'file:///b.root'])
+
+def test_data_hash_file_boundaries():
+    assert ast_hash.calc_data_hash(['ab', 'c']) != ast_hash.calc_data_hash(['a', 'bc'])
+
+def test_hash_same_for_separately_built_queries():
+    assert ast_hash.calc_ast_hash(build_ast('file://root1.root')) == ast_hash.calc_ast_hash(build_ast('file://root1.root'))
+
+def test_hash_is_cached():
+    a = build_ast('file://root1.root')
+    h = ast_hash.calc_ast_hash(a)
+    assert a.source.source._node_hashes[False] is not None
+    assert ast_hash.calc_ast_hash(a) == h
+
+def test_hash_changes_when_deep_node_modified():
+    a = build_ast('file://root1.root')
+    h = ast_hash.calc_ast_hash(a)
+    a.source.source.url = ['file:///root2.root']
+    assert ast_hash.calc_ast_hash(a) != h
+    assert ast_hash.calc_ast_hash(a) == ast_hash.calc_ast_hash(build_ast('file://root2.root'))
+
+def test_hash_changes_when_node_in_lambda_modified():
+    a = EventDataset('file://root.root') \
+        .Select('lambda e: e.Jets("jets").Select(lambda j: j.pt())') \
+        .value(executor=lambda a: a)
+    from adl_func_client.util_ast_LINQ import replace_LINQ_operators
+    a = replace_LINQ_operators().visit(a)
+    h = ast_hash.calc_ast_hash(a)
+    inner = a.selection.body
+    inner.selection = ast.parse('lambda j: j.eta()').body[0].value
+    assert ast_hash.calc_ast_hash(a) != h
+
+def test_hash_only_new_nodes_hashed():
+    ds = EventDataset('file://root1.root')
+    q1 = ds.Select('lambda e: e.x()')
+    ast_hash.calc_ast_hash(q1._ast)
+    cached = ds._node_hashes
+    q2 = q1.Select('lambda x: x + 1')
+    ast_hash.calc_ast_hash(q2._ast)
+    assert ds._node_hashes is cached
+
+def test_hash_pickle():
+    import pickle
+    a = build_ast('file://root1.root')
+    h = ast_hash.calc_ast_hash(a)
+    a_new = pickle.loads(pickle.dumps(a))
+    assert '_node_hashes' not in a_new.__dict__
+    assert ast_hash.calc_ast_hash(a_new) == h
+
+def build_ast_parameter(cut: float) -> ast.AST:
+    return EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("jets")') \
+        .Where(f'lambda j: j.pt() > Parameter("pt_cut", {cut})') \
+        .Select('lambda j: j.pt()') \
+        .AsROOTTTree('dude.root', 'analysis', 'JetPt') \
+        .value(executor=lambda a: a)
+
+def test_code_hash_same_for_different_parameter_values():
+    a1 = build_ast_parameter(30.0)
+    a2 = build_ast_parameter(40.0)
+    assert ast_hash.calc_code_hash(a1) == ast_hash.calc_code_hash(a2)
+    assert ast_hash.calc_ast_hash(a1) != ast_hash.calc_ast_hash(a2)
+
+def test_data_hash_parameters():
+    assert ast_hash.calc_data_hash(['a'], {}) == ast_hash.calc_data_hash(['a'])
+    assert ast_hash.calc_data_hash(['a'], {'pt_cut': 30.0}) != ast_hash.calc_data_hash(['a'], {'pt_cut': 40.0})
+
+def test_hash_of_lambda_is_cached():
+    a = build_ast_parameter(30.0)
+    h = ast_hash.calc_ast_hash(a)
+    a.source.selection.body.func.attr = 'eta'
+    assert ast_hash.calc_ast_hash(a) == h
+
+def test_hash_changes_when_lambda_replaced():
+    a = build_ast_parameter(30.0)
+    h = ast_hash.calc_ast_hash(a)
+    a.source.selection = ast.parse('lambda j: j.eta()').body[0].value
+    assert ast_hash.calc_ast_hash(a) != h
+
+def test_hash_of_deepcopy_changes_when_copy_modified():
+    import copy
+    a = EventDataset('file://root1.root').Count().value(executor=lambda a: a)
+    h = ast_hash.calc_ast_hash(a)
+    d = copy.deepcopy(a)
+    assert ast_hash.calc_ast_hash(d) == h
+    d.source.url = ['file:///root2.root']
+    assert ast_hash.calc_ast_hash(d) != h
+    assert ast_hash.calc_ast_hash(a) == h
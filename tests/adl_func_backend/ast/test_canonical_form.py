@@ -0,0 +1,67 @@
+# Test putting an AST into canonical form
+import ast
+from adl_func_backend.ast.canonical_form import canonicalize_ast
+from adl_func_backend.ast import ast_hash
+from adl_func_backend.xAODlib.atlas_xaod_executor import atlas_xaod_executor
+from adl_func_client.event_dataset import EventDataset
+from adl_func_client.util_ast import lambda_unwrap
+
+def canonical_lambda(s: str) -> str:
+    return ast.dump(canonicalize_ast().visit(lambda_unwrap(ast.parse(s))))
+
+def transformed_hash(q) -> str:
+    a = q.value(executor=lambda a: a)
+    return ast_hash.calc_code_hash(atlas_xaod_executor().apply_ast_transformations(a))
+
+def jet_query(l_select: str, l_where: str):
+    return EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select(l_select) \
+        .Where(l_where) \
+        .AsROOTTTree('dude.root', 'forkme', 'JetPt')
+
+def test_rename_args():
+    assert canonical_lambda('lambda j: j.pt()') == canonical_lambda('lambda jet: jet.pt()')
+
+def test_rename_nested_args():
+    assert canonical_lambda('lambda e: e.jets().Select(lambda j: j.pt() + e.x())') \
+        == canonical_lambda('lambda evt: evt.jets().Select(lambda jet: jet.pt() + evt.x())')
+
+def test_rename_keeps_different_references():
+    assert canonical_lambda('lambda e: e.jets().Select(lambda j: j.pt())') \
+        != canonical_lambda('lambda e: e.jets().Select(lambda j: e.pt())')
+
+def test_free_names_left_alone():
+    assert canonical_lambda('lambda j: j.pt() + x') != canonical_lambda('lambda j: j.pt() + y')
+
+def test_compare_constants():
+    assert canonical_lambda('lambda j: j.pt() > 30') == canonical_lambda('lambda j: j.pt() > 30.0')
+
+def test_arithmetic_constants_left_alone():
+    assert canonical_lambda('lambda j: j.n() / 2') != canonical_lambda('lambda j: j.n() / 2.0')
+
+def test_bool_constants_left_alone():
+    assert canonical_lambda('lambda j: j.good() == True') != canonical_lambda('lambda j: j.good() == 1')
+
+def test_query_renames_hash_same():
+    assert transformed_hash(jet_query('lambda j: j.pt()', 'lambda p: p > 30')) \
+        == transformed_hash(jet_query('lambda jet: jet.pt()', 'lambda pt: pt > 30.0'))
+
+def test_query_different_hash_different():
+    assert transformed_hash(jet_query('lambda j: j.pt()', 'lambda p: p > 30')) \
+        != transformed_hash(jet_query('lambda j: j.eta()', 'lambda p: p > 30'))
+
+def test_different_collections_hash_different():
+    q1 = EventDataset("file://root.root").SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")').Select('lambda j: j.pt()').AsROOTTTree('dude.root', 'forkme', 'JetPt')
+    q2 = EventDataset("file://root.root").SelectMany('lambda e: e.Tracks("AntiKt4EMTopoJets")').Select('lambda j: j.pt()').AsROOTTTree('dude.root', 'forkme', 'JetPt')
+    assert transformed_hash(q1) != transformed_hash(q2)
+
+def test_identity_select_removed():
+    q1 = EventDataset("file://root.root").SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")').Select('lambda j: j').Select('lambda j: j.pt()').AsROOTTTree('dude.root', 'forkme', 'JetPt')
+    q2 = EventDataset("file://root.root").SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")').Select('lambda j: j.pt()').AsROOTTTree('dude.root', 'forkme', 'JetPt')
+    assert transformed_hash(q1) == transformed_hash(q2)
+
+def test_where_true_removed():
+    q1 = EventDataset("file://root.root").SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")').Where('lambda j: True').Select('lambda j: j.pt()').AsROOTTTree('dude.root', 'forkme', 'JetPt')
+    q2 = EventDataset("file://root.root").SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")').Select('lambda j: j.pt()').AsROOTTTree('dude.root', 'forkme', 'JetPt')
+    assert transformed_hash(q1) == transformed_hash(q2)
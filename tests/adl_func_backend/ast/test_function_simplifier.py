@@ -6,6 +6,8 @@ sys.path.append(".")
 
 from adl_func_client.util_ast_LINQ import replace_LINQ_operators
 from adl_func_backend.ast.function_simplifier import simplify_chained_calls
+from adl_func_client.event_dataset import EventDataset
+from adl_func_client.query_ast import Where
 from tests.util_debug_ast import normalize_ast
 import ast
 
@@ -64,6 +66,26 @@ def test_where_always_true():
 def test_where_where():
     util_process('jets.Where(lambda j: j.pt>10).Where(lambda j1: j1.eta < 4.0)', 'jets.Where(lambda j: (j.pt>10) and (j.eta < 4.0))')
 
+def event_where(filter: str) -> ast.AST:
+    'A Where on the events, with filter the text of its lambda'
+    return Where(EventDataset("file://root.root"), replace_LINQ_operators().visit(ast.parse(filter).body[0].value))
+
+def test_where_cheap_term_first():
+    util_process(event_where('lambda e: e.jets.Where(lambda j: j.pt > 10).First().pt > 20 and e.run > 100'),
+        event_where('lambda e: e.run > 100 and e.jets.Where(lambda j: j.pt > 10).First().pt > 20'))
+
+def test_where_cheap_term_first_only_for_events():
+    util_process('jets.Where(lambda j: j.tracks.Where(lambda t: t.pt > 1).Count() > 2 and j.pt > 10)',
+        'jets.Where(lambda j: j.tracks.Where(lambda t: t.pt > 1).Count() > 2 and j.pt > 10)')
+
+def test_where_term_that_can_fail_not_moved():
+    util_process(event_where('lambda e: e.jets.Where(lambda j: j.pt > 10).First().pt > 20 and e.jets[0].pt > 20 and e.run > 100'),
+        event_where('lambda e: e.run > 100 and e.jets.Where(lambda j: j.pt > 10).First().pt > 20 and e.jets[0].pt > 20'))
+
+def test_where_term_that_can_fail_moved_if_independent():
+    util_process(event_where('lambda e: e.jets.Where(lambda j: j.pt > 10).First().pt > 20 and e.met / e.sumet > 0.5'),
+        event_where('lambda e: e.met / e.sumet > 0.5 and e.jets.Where(lambda j: j.pt > 10).First().pt > 20'))
+
 def test_where_select():
     util_process('jets.Select(lambda j: j.pt).Where(lambda p: p > 40)', 'jets.Where(lambda j: j.pt > 40).Select(lambda k: k.pt)')
 
@@ -101,4 +123,11 @@ def test_tuple_in_lambda_2deep():
     util_process('(lambda t: t[0])((lambda s: s[1])((j0, (j1, j2))))', 'j1')
 
 def test_tuple_around_first():
-    util_process('events.Select(lambda e: e.jets.Select(lambda j: (j, e)).First()[0])', 'events.Select(lambda e: e.jets.First())')
\ No newline at end of file
+    util_process('events.Select(lambda e: e.jets.Select(lambda j: (j, e)).First()[0])', 'events.Select(lambda e: e.jets.First())')
+
+def test_arg_names_numbered_per_instance():
+    s1 = simplify_chained_calls()
+    s1.arg_name()
+    s2 = simplify_chained_calls()
+    assert s2.arg_name() == 'arg_0'
+    assert s1.arg_name() == 'arg_1'
@@ -2,10 +2,20 @@
 
 from adl_func_backend.cpplib.math_utils import DeltaR
 from adl_func_client.event_dataset import EventDataset
-from tests.adl_func_backend.xAODlib.utils_for_testing import exe_for_test
+from tests.adl_func_backend.xAODlib.utils_for_testing import exe_for_test, get_lines_of_code, find_line_numbers_with
 
 def test_deltaR_call():
     r=EventDataset("file://root.root").Select('lambda e: DeltaR(1.0, 1.0, 1.0, 1.0)').AsROOTTTree('root.root', 'analysis', 'RunNumber').value(executor=exe_for_test)
     vs = r.QueryVisitor._gc._class_vars
     assert 1 == len(vs)
     assert "double" == str(vs[0].cpp_type())
+
+def test_deltaR_calculated_once():
+    r=EventDataset("file://root.root").Select('lambda e: (DeltaR(1.0, 1.0, 1.0, 2.0), DeltaR(1.0, 1.0, 1.0, 2.0)*2.0)').AsROOTTTree('root.root', 'analysis', ['dr', 'dr2']).value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    assert 1 == len(find_line_numbers_with("Phi_mpi_pi", lines))
+
+def test_different_deltaR_calculated_twice():
+    r=EventDataset("file://root.root").Select('lambda e: (DeltaR(1.0, 1.0, 1.0, 2.0), DeltaR(1.0, 1.0, 1.0, 3.0))').AsROOTTTree('root.root', 'analysis', ['dr', 'dr2']).value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    assert 2 == len(find_line_numbers_with("Phi_mpi_pi", lines))
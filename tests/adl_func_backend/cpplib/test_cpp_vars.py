@@ -0,0 +1,24 @@
+# Test the variable naming
+from adl_func_backend.cpplib.cpp_vars import unique_name, unique_name_scope
+
+def test_unique_names_differ():
+    assert unique_name('dude') != unique_name('dude')
+
+def test_class_var_name():
+    assert unique_name('dude', is_class_var=True).startswith('_dude')
+
+def test_names_restart_in_scope():
+    with unique_name_scope():
+        n1 = unique_name('dude')
+    unique_name('dude')
+    with unique_name_scope():
+        n2 = unique_name('dude')
+    assert n1 == n2 == 'dude0'
+
+def test_scope_does_not_touch_global_numbering():
+    n1 = unique_name('dude')
+    with unique_name_scope():
+        unique_name('dude')
+        unique_name('dude')
+    n2 = unique_name('dude')
+    assert int(n2[4:]) == int(n1[4:]) + 1
@@ -1,6 +1,7 @@
 # A few tests on the LINQ ast funcitonality
 from adl_func_client.event_dataset import EventDataset
-from adl_func_backend.util_LINQ import find_dataset
+from adl_func_client.ObjectStream import batch
+from adl_func_backend.util_LINQ import find_dataset, find_datasets, find_event_count_dataset, find_query_parameters
 import ast
 
 
@@ -39,4 +40,52 @@ def test_find_EventDataset_Select_and_Many():
         .SelectMany("lambda x: x") \
         .value(executor=lambda a: a)
 
-    assert ["file:///dude.root"] == find_dataset(a).url
\ No newline at end of file
+    assert ["file:///dude.root"] == find_dataset(a).url
+def test_find_EventDataset_batch():
+    ds = EventDataset("file://dude.root")
+    q1 = ds.Select("lambda x: x").AsROOTTTree("f.root", "t1", "x")
+    q2 = EventDataset("file://dude.root").Select("lambda x: x").AsROOTTTree("f.root", "t2", "x")
+    a = batch([q1, q2]).value(executor=lambda a: a)
+
+    assert 2 == len(find_datasets(a))
+    assert ["file:///dude.root"] == find_dataset(a).url
+
+def test_find_EventDataset_batch_different():
+    q1 = EventDataset("file://dude.root").Select("lambda x: x").AsROOTTTree("f.root", "t1", "x")
+    q2 = EventDataset("file://other.root").Select("lambda x: x").AsROOTTTree("f.root", "t2", "x")
+    a = batch([q1, q2]).value(executor=lambda a: a)
+
+    try:
+        find_dataset(a)
+        assert False
+    except BaseException:
+        pass
+
+def test_find_event_count_dataset():
+    ds = EventDataset("file://junk.root")
+    assert find_event_count_dataset(ds.Count()._ast) is ds
+    assert find_event_count_dataset(ds.Select("lambda e: e.met()").Count()._ast) is ds
+
+def test_find_event_count_dataset_filtered():
+    ds = EventDataset("file://junk.root")
+    assert find_event_count_dataset(ds.Where("lambda e: e.met() > 10").Count()._ast) is None
+    assert find_event_count_dataset(ds.SelectMany("lambda e: e.jets()").Count()._ast) is None
+    assert find_event_count_dataset(ds.Select("lambda e: e.met()").Sum()._ast) is None
+
+def test_find_query_parameters():
+    a = EventDataset("file://junk.root") \
+        .SelectMany("lambda e: e.jets()") \
+        .Where("lambda j: j.pt() > Parameter('pt_cut', 30.0) and abs(j.eta()) < Parameter('eta_cut', 2.5)") \
+        .Select("lambda j: j.pt() > Parameter('pt_cut', 30.0)")._ast
+    assert find_query_parameters(a) == {'pt_cut': 30.0, 'eta_cut': 2.5}
+
+def test_find_query_parameters_different_values():
+    a = EventDataset("file://junk.root") \
+        .SelectMany("lambda e: e.jets()") \
+        .Where("lambda j: j.pt() > Parameter('pt_cut', 30.0)") \
+        .Where("lambda j: j.pt() > Parameter('pt_cut', 40.0)")._ast
+    try:
+        find_query_parameters(a)
+        assert False
+    except BaseException as e:
+        assert "two different values" in str(e)
@@ -0,0 +1,275 @@
+# Tests for the driver that writes out the C++ files
+from adl_func_backend.xAODlib.atlas_xaod_executor import atlas_xaod_executor, calc_build_hash, write_parameters
+from adl_func_client.event_dataset import EventDataset
+import ast
+import json
+import os
+import subprocess
+import tempfile
+import pytest
+from typing import List
+
+@pytest.fixture
+def local_run_dir():
+    with tempfile.TemporaryDirectory() as local_run_dir:
+        yield local_run_dir
+
+def build_ast() -> ast.AST:
+    return EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: j.pt()') \
+        .AsROOTTTree('dude.root', 'forkme', 'JetPt') \
+        .value(executor=lambda a: a)
+
+def write_files(a: ast.AST, output_dir: str, **kwargs):
+    exe = atlas_xaod_executor(**kwargs)
+    return exe.write_cpp_files(exe.apply_ast_transformations(a), output_dir)
+
+def test_build_hash_same_source():
+    assert calc_build_hash(['a', 'b']) == calc_build_hash(['a', 'b'])
+
+def test_build_hash_different_source():
+    assert calc_build_hash(['a', 'b']) != calc_build_hash(['a', 'c'])
+
+def test_build_hash_file_boundaries():
+    assert calc_build_hash(['ab', 'c']) != calc_build_hash(['a', 'bc'])
+
+def test_build_hash_different_release():
+    assert calc_build_hash(['a', 'b'], '21.2.62') != calc_build_hash(['a', 'b'], '21.2.63')
+
+def test_build_hash_in_runner(local_run_dir):
+    f_spec = write_files(build_ast(), local_run_dir)
+    assert f_spec.build_hash is not None
+    with open(os.path.join(local_run_dir, 'runner.sh')) as f:
+        assert f'build_hash={f_spec.build_hash}' in f.read()
+
+def test_build_hash_matches_files(local_run_dir):
+    f_spec = write_files(build_ast(), local_run_dir)
+    files = []
+    for name in ['package_CMakeLists.txt', 'query.cxx', 'query.h']:
+        with open(os.path.join(local_run_dir, name)) as f:
+            files.append(f.read())
+    assert calc_build_hash(files) == f_spec.build_hash
+
+def test_runner_reuses_workspace(local_run_dir):
+    write_files(build_ast(), local_run_dir)
+    with open(os.path.join(local_run_dir, 'runner.sh')) as f:
+        runner = f.read()
+    assert 'rel_dir=/workspace/rel' in runner
+
+    # Build the same query twice, then another one, in one workspace
+    work = os.path.join(local_run_dir, 'work')
+    os.mkdir(work)
+    build = lambda: [c.split()[0] for c in run_runner_part(runner, 'update_file()', 'source $rel_dir', work, f'rel_dir={work}/rel\nDIR={local_run_dir}\ncmake_args=""')]
+    assert build() == ['cmake', 'make']
+    query_cxx = os.path.join(work, 'rel', 'source', 'analysis', 'Root', 'query.cxx')
+    os.utime(query_cxx, (0, 0))
+
+    assert build()[2:] == ['make']
+    assert os.path.getmtime(query_cxx) == 0
+
+    with open(os.path.join(local_run_dir, 'query.cxx'), 'a') as f:
+        f.write('// another query\n')
+    assert build()[3:] == ['make']
+    assert read_file(os.path.join(work, 'rel', 'source', 'analysis', 'Root'), 'query.cxx').endswith('// another query\n')
+
+def read_eljob(local_run_dir: str) -> str:
+    with open(os.path.join(local_run_dir, 'ATestRun_eljob.py')) as f:
+        return f.read()
+
+def test_eljob_default_driver(local_run_dir):
+    write_files(build_ast(), local_run_dir)
+    assert 'driver_name = "direct"' in read_eljob(local_run_dir)
+
+def test_eljob_proof_driver(local_run_dir):
+    write_files(build_ast(), local_run_dir, driver='proof', workers=8)
+    eljob = read_eljob(local_run_dir)
+    assert 'driver_name = "proof"' in eljob
+    assert 'int("8")' in eljob
+
+def test_unknown_driver():
+    with pytest.raises(BaseException):
+        atlas_xaod_executor(driver='grid')
+
+def test_bad_worker_count():
+    with pytest.raises(BaseException):
+        atlas_xaod_executor(driver='proof', workers=0)
+
+def read_query(local_run_dir: str) -> str:
+    with open(os.path.join(local_run_dir, 'query.cxx')) as f:
+        return f.read()
+
+def build_ast_renamed() -> ast.AST:
+    return EventDataset("file://root.root") \
+        .SelectMany('lambda evt: evt.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda jet: jet.pt()') \
+        .AsROOTTTree('dude.root', 'forkme', 'JetPt') \
+        .value(executor=lambda a: a)
+
+def test_same_ast_same_cxx():
+    with tempfile.TemporaryDirectory() as d1, tempfile.TemporaryDirectory() as d2:
+        h1 = write_files(build_ast(), d1, generic=False).build_hash
+        h2 = write_files(build_ast(), d2, generic=False).build_hash
+        assert read_query(d1) == read_query(d2)
+        assert h1 == h2
+
+def test_canonical_equivalent_ast_same_cxx():
+    with tempfile.TemporaryDirectory() as d1, tempfile.TemporaryDirectory() as d2:
+        write_files(build_ast(), d1, generic=False)
+        write_files(build_ast_renamed(), d2, generic=False)
+        assert read_query(d1) == read_query(d2)
+
+def test_driver_does_not_change_build(local_run_dir):
+    h1 = write_files(build_ast(), local_run_dir, generic=False).build_hash
+    h2 = write_files(build_ast(), local_run_dir, driver='proof', workers=4, generic=False).build_hash
+    assert h1 == h2
+
+def build_ast_parameter(cut: float) -> ast.AST:
+    return EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where(f'lambda j: j.pt() > Parameter("pt_cut", {cut})') \
+        .Select('lambda j: j.pt()') \
+        .AsROOTTTree('dude.root', 'forkme', 'JetPt') \
+        .value(executor=lambda a: a)
+
+def test_parameter_values_same_build():
+    with tempfile.TemporaryDirectory() as d1, tempfile.TemporaryDirectory() as d2:
+        f1 = write_files(build_ast_parameter(30.0), d1, generic=False)
+        f2 = write_files(build_ast_parameter(40.0), d2, generic=False)
+        assert read_query(d1) == read_query(d2)
+        assert f1.build_hash == f2.build_hash
+        assert f1.parameters == {'pt_cut': 30.0}
+        assert f2.parameters == {'pt_cut': 40.0}
+        assert 'declareProperty("pt_cut",' in read_query(d1)
+
+def test_write_parameters(local_run_dir):
+    write_parameters({'pt_cut': 30.0}, local_run_dir)
+    with open(os.path.join(local_run_dir, 'parameters.json')) as f:
+        assert json.load(f) == {'pt_cut': 30.0}
+
+def test_write_no_parameters(local_run_dir):
+    write_parameters({}, local_run_dir)
+    assert not os.path.exists(os.path.join(local_run_dir, 'parameters.json'))
+
+def read_plan(local_run_dir: str) -> str:
+    with open(os.path.join(local_run_dir, 'plan.txt')) as f:
+        return f.read()
+
+def test_generic_query_for_simple_query(local_run_dir):
+    f_spec = write_files(build_ast(), local_run_dir)
+    assert 'plan.txt' in f_spec.all_filenames
+    assert 'declareProperty ("plan"' in read_query(local_run_dir)
+    assert 'column JetPt double acc pt' in read_plan(local_run_dir)
+    assert f_spec.result_rep.treename == 'forkme0'
+
+def test_generic_query_same_build():
+    with tempfile.TemporaryDirectory() as d1, tempfile.TemporaryDirectory() as d2:
+        f1 = write_files(build_ast(), d1)
+        f2 = write_files(build_ast_parameter(30.0), d2)
+        assert f1.build_hash == f2.build_hash
+        assert read_plan(d1) != read_plan(d2)
+        assert 'par pt_cut' in read_plan(d2)
+
+def test_generic_query_same_plan():
+    with tempfile.TemporaryDirectory() as d1, tempfile.TemporaryDirectory() as d2:
+        write_files(build_ast(), d1)
+        write_files(build_ast_renamed(), d2)
+        assert read_plan(d1) == read_plan(d2)
+
+def test_generic_query_turned_off(local_run_dir):
+    f_spec = write_files(build_ast(), local_run_dir, generic=False)
+    assert 'plan.txt' not in f_spec.all_filenames
+    assert not os.path.exists(os.path.join(local_run_dir, 'plan.txt'))
+
+def test_generic_query_not_for_event_query(local_run_dir):
+    a = EventDataset("file://root.root") \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Count()') \
+        .AsROOTTTree('dude.root', 'forkme', 'NJets') \
+        .value(executor=lambda a: a)
+    f_spec = write_files(a, local_run_dir)
+    assert 'plan.txt' not in f_spec.all_filenames
+
+def read_file(local_run_dir: str, name: str) -> str:
+    with open(os.path.join(local_run_dir, name)) as f:
+        return f.read()
+
+def test_runner_optimized_parallel_build(local_run_dir):
+    write_files(build_ast(), local_run_dir)
+    runner = read_file(local_run_dir, 'runner.sh')
+    assert 'cmake_args="-DCMAKE_BUILD_TYPE=Release' in runner
+    assert 'make -j$(nproc)' in runner
+    assert 'CCACHE_DIR=/ccache' in runner
+
+def run_runner_part(runner: str, start: str, end: str, cwd: str, script_vars: str) -> List[str]:
+    r'''
+    Run the lines of runner.sh from the one starting with `start` up to (not including) the one starting
+    with `end`, with a cmake and make on the path that only log how they were called. Returns the
+    log, one line per call, of this and any earlier runs in cwd.
+    '''
+    lines = runner.split('\n')
+    first = next(i for i, l in enumerate(lines) if l.startswith(start))
+    last = next(i for i, l in enumerate(lines) if i > first and l.startswith(end))
+    bin_dir = os.path.join(cwd, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    log = os.path.join(cwd, 'commands.log')
+    for command in ['cmake', 'make']:
+        with open(os.path.join(bin_dir, command), 'w') as f:
+            f.write(f'#!/bin/bash\necho "{command} $@" >> {log}\n')
+        os.chmod(os.path.join(bin_dir, command), 0o755)
+    script = script_vars + '\n' + '\n'.join(lines[first:last])
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'])
+    subprocess.run(['bash', '-e', '-c', script], cwd=cwd, env=env, check=True)
+    if not os.path.exists(log):
+        return []
+    with open(log) as f:
+        return f.read().splitlines()
+
+def test_runner_reconfigures_for_new_cmake_args(local_run_dir):
+    write_files(build_ast(), local_run_dir)
+    runner = read_file(local_run_dir, 'runner.sh')
+    tree = os.path.join(local_run_dir, 'tree')
+    os.makedirs(os.path.join(tree, 'source'))
+    os.makedirs(os.path.join(tree, 'build'))
+    configure = lambda args: run_runner_part(runner, 'cd ../build', 'make -j', os.path.join(tree, 'source'), f'cmake_args="{args}"')
+    assert configure('-DA=1') == ['cmake -DA=1 ../source']
+    assert configure('-DA=1') == ['cmake -DA=1 ../source']
+    assert configure('-DA=2') == ['cmake -DA=1 ../source', 'cmake -DA=2 ../source']
+
+def test_precompiled_headers(local_run_dir):
+    write_files(build_ast(), local_run_dir, generic=False)
+    cmake = read_file(local_run_dir, 'package_CMakeLists.txt')
+    assert 'target_precompile_headers' in cmake
+    assert '<xAODJet/JetContainer.h>' in cmake
+
+def test_precompiled_headers_generic(local_run_dir):
+    write_files(build_ast(), local_run_dir)
+    assert '<xAODJet/JetContainer.h>' in read_file(local_run_dir, 'package_CMakeLists.txt')
+
+def test_repeated_expression_calculated_once(local_run_dir):
+    a = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: j.pt()/1000.0 > 30.0') \
+        .Select('lambda j: (j.pt()/1000.0, j.pt()/1000.0*2.0)') \
+        .AsPandasDF(['pt', 'pt2']) \
+        .value(executor=lambda a: a)
+    write_files(a, local_run_dir, generic=False)
+    query = read_file(local_run_dir, 'query.cxx')
+    assert query.count('pt()/1000.0') == 1
+
+def test_query_includes(local_run_dir):
+    a = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: abs(j.getAttributeFloat("EMFrac"))') \
+        .AsPandasDF(['emf']) \
+        .value(executor=lambda a: a)
+    write_files(a, local_run_dir, generic=False)
+    header = read_file(local_run_dir, 'query.h')
+    assert '#include <memory>' in header
+    assert '#include <cmath>' in header
+    assert '#include <xAODJet/JetContainer.h>' in header
+    assert '#include "' not in header
+
+def test_no_empty_finalize_block(local_run_dir):
+    write_files(build_ast(), local_run_dir, generic=False)
+    finalize = read_file(local_run_dir, 'query.cxx').split('query :: finalize ()')[1]
+    assert 1 == finalize.count('{')
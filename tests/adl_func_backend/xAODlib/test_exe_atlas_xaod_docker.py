@@ -0,0 +1,225 @@
+# Tests for the docker executor that do not need docker.
+import adl_func_backend.xAODlib.exe_atlas_xaod_docker as xd
+from adl_func_backend.xAODlib.exe_atlas_xaod_docker import entry_ranges, shard_list, use_executor_xaod_docker
+from adl_func_backend.xAODlib.result_handlers import _concatenate, _reduce_scalar, _sum_histograms
+from adl_func_client.event_dataset import EventDataset
+from adl_func_client.ObjectStream import batch
+from adl_func_client.query_result_asts import ROOTTreeResult
+import asyncio
+import numpy as np
+import os
+import re
+import pytest
+
+def run(coro):
+    'Run a coroutine in its own event loop, leaving the default loop alone'
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+class fake_docker:
+    'Pretend to run a query, leaving an output file behind'
+    def __init__(self):
+        self.commands = []
+        self.filelists = []
+        self.event_ranges = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, cmd: str):
+        self.commands.append(cmd)
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        run_dir = re.search(r'-v (\S+):/results', cmd).group(1)
+        with open(os.path.join(run_dir, 'filelist.txt')) as f:
+            self.filelists.append(f.read().split())
+        range_file = os.path.join(run_dir, 'eventrange.txt')
+        if os.path.exists(range_file):
+            with open(range_file) as f:
+                self.event_ranges.append(f.read().split())
+        with open(os.path.join(run_dir, 'ANALYSIS.root'), 'w') as f:
+            f.write(run_dir)
+        return 0, b'', b''
+
+@pytest.fixture
+def docker(monkeypatch, tmp_path):
+    d = fake_docker()
+    monkeypatch.setattr(xd, 'run_docker_command', d)
+    monkeypatch.setattr(xd, 'dump_running_log', False)
+    monkeypatch.chdir(tmp_path)
+    return d
+
+def ttree_query(n_files: int):
+    return EventDataset([f'root://server/file{i}.root' for i in range(n_files)]) \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: j.pt()') \
+        .AsROOTTTree('ANALYSIS.root', 'forkme', 'JetPt') \
+        .value(executor=lambda a: a)
+
+def test_shard_list_even():
+    assert shard_list(['a', 'b', 'c', 'd'], 2) == [['a', 'b'], ['c', 'd']]
+
+def test_shard_list_balanced():
+    shards = shard_list([str(i) for i in range(10)], 4)
+    assert [len(s) for s in shards] == [3, 3, 2, 2]
+    assert [i for s in shards for i in s] == [str(i) for i in range(10)]
+
+def test_shard_list_more_shards_than_items():
+    assert shard_list(['a', 'b'], 5) == [['a'], ['b']]
+
+def test_concatenate_columns():
+    r = _concatenate([{'a': np.array([1, 2])}, {'a': np.array([3])}])
+    assert list(r['a']) == [1, 2, 3]
+
+def test_single_shard(docker):
+    r = run(use_executor_xaod_docker(ttree_query(3)))
+    assert len(docker.commands) == 1
+    assert len(docker.filelists[0]) == 3
+    assert len(r.fileinfo_list) == 1
+
+def test_sharded_run(docker):
+    r = run(use_executor_xaod_docker(ttree_query(5), shards=2))
+    assert len(docker.commands) == 2
+    assert sorted(len(f) for f in docker.filelists) == [2, 3]
+    assert all('/build_cache' in c for c in docker.commands)
+    assert len(r.fileinfo_list) == 2
+    assert all(os.path.exists(f.filename) for f in r.fileinfo_list)
+
+def test_sharded_run_bounded(docker):
+    r = run(use_executor_xaod_docker(ttree_query(4), shards=4, max_workers=2))
+    assert len(docker.commands) == 4
+    assert docker.max_running == 2
+    assert len(r.fileinfo_list) == 4
+
+def test_entry_ranges():
+    assert entry_ranges(10, 3) == [(0, 4), (4, 3), (7, 3)]
+
+def test_entry_ranges_small_file():
+    assert entry_ranges(2, 4) == [(0, 1), (1, 1)]
+
+def test_entry_ranges_empty_file():
+    assert entry_ranges(0, 4) == [(0, 0)]
+
+def test_entry_ranges_large_file():
+    r = entry_ranges(10**12 + 1, 3)
+    assert r[0] == (0, 333333333334)
+    assert sum(c for _, c in r) == 10**12 + 1
+
+def test_split_files(docker, monkeypatch):
+    monkeypatch.setattr(xd, 'count_entries', lambda u: 100)
+    r = run(use_executor_xaod_docker(ttree_query(2), splits_per_file=2))
+    assert len(docker.commands) == 4
+    assert [os.path.basename(f[0]) for f in docker.filelists] == ['file0.root', 'file0.root', 'file1.root', 'file1.root']
+    assert docker.event_ranges == [['0', '50'], ['50', '50'], ['0', '50'], ['50', '50']]
+    assert len(r.fileinfo_list) == 4
+
+def test_batch_run(docker):
+    ds = EventDataset([f'root://server/file{i}.root' for i in range(2)])
+    q1 = ds.SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")').Select('lambda j: j.pt()').AsROOTTTree('ANALYSIS.root', 'jets', 'JetPt')
+    q2 = ds.Select('lambda e: e.Jets("AntiKt4EMTopoJets").Count()').AsROOTTTree('ANALYSIS.root', 'njets', 'NJets')
+    a = batch([q1, q2]).value(executor=lambda a: a)
+    r = run(use_executor_xaod_docker(a, shards=2))
+    assert len(docker.commands) == 2
+    assert isinstance(r, list) and len(r) == 2
+    assert all(isinstance(t, ROOTTreeResult) and len(t.fileinfo_list) == 2 for t in r)
+    assert r[0].fileinfo_list[0].treename.startswith('jets')
+    assert r[1].fileinfo_list[0].treename.startswith('njets')
+
+def test_sum_histograms():
+    edges = np.array([0.0, 1.0, 2.0])
+    r = _sum_histograms([(np.array([1.0, 2.0]), edges), (np.array([3.0, 0.0]), edges)])
+    assert list(r[0]) == [4.0, 2.0]
+    assert r[1] is edges
+
+def test_reduce_scalar():
+    n = np.array([2, 0, 3])
+    assert _reduce_scalar('Count', n, np.array([0.0, 0.0, 0.0])) == 5
+    assert _reduce_scalar('Sum', n, np.array([1.0, 0.0, 4.0])) == 5.0
+    assert _reduce_scalar('Mean', n, np.array([1.0, 0.0, 4.0])) == 1.0
+    assert _reduce_scalar('Min', n, np.array([-1.0, 0.0, 4.0])) == -1.0
+    assert _reduce_scalar('Max', n, np.array([-1.0, 10.0, 4.0])) == 4.0
+
+def test_reduce_scalar_nothing_seen():
+    assert _reduce_scalar('Min', np.array([0]), np.array([0.0])) is None
+    assert _reduce_scalar('Mean', np.array([0]), np.array([0.0])) is None
+
+def test_event_count_not_run(docker, monkeypatch):
+    monkeypatch.setattr(xd, 'count_entries', lambda u: 100)
+    a = EventDataset([f'root://server/file{i}.root' for i in range(3)]).Count().value(executor=lambda a: a)
+    assert run(use_executor_xaod_docker(a)) == 300
+    assert len(docker.commands) == 0
+
+def test_filtered_event_count_run(docker, monkeypatch):
+    monkeypatch.setattr(xd, 'count_entries', lambda u: 100)
+    a = EventDataset('root://server/file0.root') \
+        .Where('lambda e: e.EventInfo("EventInfo").runNumber() > 10') \
+        .Count() \
+        .value(executor=lambda a: a)
+    with pytest.raises(BaseException):
+        # The fake docker run does not write out the counts
+        run(use_executor_xaod_docker(a))
+    assert len(docker.commands) == 1
+
+def test_event_count_unreadable_file_run(docker, monkeypatch):
+    def no_open(u):
+        raise OSError(f'Unable to open {u}')
+    monkeypatch.setattr(xd, 'count_entries', no_open)
+    a = EventDataset('root://server/file0.root').Count().value(executor=lambda a: a)
+    with pytest.raises(BaseException):
+        # The fake docker run does not write out the counts
+        run(use_executor_xaod_docker(a))
+    assert len(docker.commands) == 1
+
+class fake_root_file:
+    'Just enough of an uproot file to count the events'
+    class source:
+        def close(self):
+            pass
+    class tree:
+        numentries = 10
+
+    def __init__(self):
+        self._context = type('context', (), {'source': fake_root_file.source()})
+
+    def __getitem__(self, name):
+        assert name == 'CollectionTree'
+        return fake_root_file.tree
+
+class fake_uproot:
+    'Count the files opened'
+    def __init__(self):
+        self.opened = []
+
+    def open(self, url):
+        self.opened.append(url)
+        return fake_root_file()
+
+def test_count_entries_cached(monkeypatch):
+    u = fake_uproot()
+    monkeypatch.setattr(xd, 'uproot', u)
+    monkeypatch.setattr(xd, '_entry_counts', {})
+    assert xd.count_entries('root://server/file0.root') == 10
+    assert xd.count_entries('root://server/file0.root') == 10
+    assert xd.count_entries('root://server/file1.root') == 10
+    assert u.opened == ['root://server/file0.root', 'root://server/file1.root']
+
+def test_count_entries_local_file_changed(monkeypatch, tmp_path):
+    u = fake_uproot()
+    monkeypatch.setattr(xd, 'uproot', u)
+    monkeypatch.setattr(xd, '_entry_counts', {})
+    f = tmp_path / 'file0.root'
+    f.write_text('')
+    url = f'file://{f}'
+    assert xd.count_entries(url) == 10
+    assert xd.count_entries(url) == 10
+    os.utime(f, (0, 0))
+    assert xd.count_entries(url) == 10
+    assert u.opened == [url, url]
+
+def test_ccache_mounted(docker):
+    run(use_executor_xaod_docker(ttree_query(1), ccache_dir='/home/ccache'))
+    assert '-v /home/ccache:/ccache' in docker.commands[0]
@@ -0,0 +1,135 @@
+# Tests for the pool of docker containers. Docker itself is never run.
+import adl_func_backend.xAODlib.exe_atlas_xaod_docker as xd
+from adl_func_backend.xAODlib.exe_atlas_xaod_docker_pool import xaod_docker_pool, XAODDockerPoolException
+import asyncio
+import pytest
+
+class fake_docker:
+    'Record docker commands, and pretend to run them'
+    def __init__(self):
+        self.commands = []
+        self.n_started = 0
+        self.dead = set()
+        self.run_fails = False
+
+    async def __call__(self, cmd: str):
+        self.commands.append(cmd)
+        if cmd.startswith('docker run'):
+            if self.run_fails:
+                return 125, b'', b'no space left on device'
+            self.n_started += 1
+            return 0, f'container{self.n_started}\n'.encode(), b''
+        if cmd.endswith(' true'):
+            c = cmd.split()[2]
+            return (1 if c in self.dead else 0), b'', b''
+        return 0, b'', b''
+
+def run(coro):
+    'Run a coroutine in its own event loop, leaving the default loop alone'
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+@pytest.fixture
+def docker(monkeypatch):
+    d = fake_docker()
+    monkeypatch.setattr(xd, 'run_docker_command', d)
+    return d
+
+def test_pool_start(docker):
+    async def run_test():
+        pool = xaod_docker_pool(size=3)
+        await pool.start()
+        assert len(pool.containers) == 3
+        assert len([c for c in docker.commands if 'release_setup.sh' in c]) == 3
+        await pool.close()
+        assert len(pool.containers) == 0
+        assert len([c for c in docker.commands if c.startswith('docker kill')]) == 3
+    run(run_test())
+
+def test_pool_data_dir_mounted(docker):
+    async def run_test():
+        pool = xaod_docker_pool(size=1, data_dir='/home/data')
+        await pool.start()
+        assert '-v /home/data:/data' in docker.commands[0]
+        await pool.close()
+    run(run_test())
+
+def test_pool_reuses_container(docker):
+    async def run_test():
+        pool = xaod_docker_pool(size=1)
+        async with pool.container() as c1:
+            pass
+        async with pool.container() as c2:
+            pass
+        assert c1 == c2
+        assert docker.n_started == 1
+        await pool.close()
+    run(run_test())
+
+def test_pool_recycle(docker):
+    async def run_test():
+        pool = xaod_docker_pool(size=1, max_jobs_per_container=2)
+        ids = []
+        for _ in range(3):
+            async with pool.container() as c:
+                ids.append(c)
+        assert ids == ['container1', 'container1', 'container2']
+        assert pool.containers == ['container2']
+        await pool.close()
+    run(run_test())
+
+def test_pool_replaces_unhealthy(docker):
+    async def run_test():
+        pool = xaod_docker_pool(size=1)
+        await pool.start()
+        docker.dead.add('container1')
+        async with pool.container() as c:
+            assert c == 'container2'
+        assert pool.containers == ['container2']
+        await pool.close()
+    run(run_test())
+
+def test_pool_replacement_fails(docker):
+    async def run_test():
+        pool = xaod_docker_pool(size=1, max_jobs_per_container=1)
+        async def use_container():
+            async with pool.container() as c:
+                return c
+
+        assert await use_container() == 'container1'
+
+        # The container has to be replaced, but docker can't start one. The slot is not lost.
+        docker.run_fails = True
+        for _ in range(2):
+            with pytest.raises(XAODDockerPoolException):
+                await asyncio.wait_for(use_container(), 5)
+        docker.run_fails = False
+        assert await asyncio.wait_for(use_container(), 5) == 'container2'
+        await pool.close()
+    run(run_test())
+
+def test_pool_bad_size():
+    with pytest.raises(XAODDockerPoolException):
+        xaod_docker_pool(size=0)
+
+def test_pool_event_count_not_run(docker, monkeypatch):
+    from adl_func_client.event_dataset import EventDataset
+    monkeypatch.setattr(xd, 'count_entries', lambda u: 5)
+    async def run_test():
+        pool = xaod_docker_pool(size=1)
+        a = EventDataset('root://server/file0.root').Count()._ast
+        assert await pool.execute(a) == 5
+        assert len(pool.containers) == 0
+        await pool.close()
+    run(run_test())
+
+def test_pool_ccache_mounted(docker):
+    async def run_test():
+        pool = xaod_docker_pool(size=1, ccache_dir='/home/ccache')
+        await pool.start()
+        assert '-v /home/ccache:/ccache' in docker.commands[0]
+        await pool.close()
+    run(run_test())
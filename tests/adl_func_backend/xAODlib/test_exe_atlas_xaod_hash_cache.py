@@ -66,3 +66,30 @@ def test_twice(local_cache_dir):
     assert r.treename.startswith('forkme')
     # Because it isn't easy to change this in the ATLAS framework
     assert r.output_filename == 'ANALYSIS.root'
+
+def build_ast_ds(ds_name: str) -> ast.AST:
+    return EventDataset(ds_name) \
+        .Select('lambda e: e.Jets("jets").SelectMany(lambda j: e.Tracks("InnerTracks")).First()') \
+        .AsROOTTTree('dude.root', 'forkme', 'JetPt') \
+        .value(executor=lambda a: a)
+
+def test_code_shared_across_datasets(local_cache_dir):
+    r1 = use_executor_xaod_hash_cache(build_ast_ds("file://root1.root"), local_cache_dir)
+    r2 = use_executor_xaod_hash_cache(build_ast_ds(["file://root1.root", "file://root2.root"]), local_cache_dir)
+    assert r1.hash == r2.hash
+    assert r1.data_hash != r2.data_hash
+    assert r2.filelist == ['file:///root1.root', 'file:///root2.root']
+    assert len(os.listdir(local_cache_dir)) == 1
+
+def test_cosmetic_differences_shared(local_cache_dir):
+    a1 = EventDataset("file://root.root") \
+        .Select('lambda e: e.Jets("jets").Select(lambda j: j.pt()).Where(lambda pt: pt > 30)') \
+        .AsROOTTTree('dude.root', 'forkme', 'JetPt') \
+        .value(executor=lambda a: a)
+    a2 = EventDataset("file://root.root") \
+        .Select('lambda evt: evt.Jets("jets").Select(lambda jet: jet.pt()).Where(lambda p: p > 30.0)') \
+        .AsROOTTTree('dude.root', 'forkme', 'JetPt') \
+        .value(executor=lambda a: a)
+    r1 = use_executor_xaod_hash_cache(a1, local_cache_dir)
+    r2 = use_executor_xaod_hash_cache(a2, local_cache_dir)
+    assert r1.hash == r2.hash
@@ -1,6 +1,8 @@
 # Test the generated code object
 from adl_func_backend.xAODlib.generated_code import generated_code
 import adl_func_backend.xAODlib.statement as statement
+import adl_func_backend.cpplib.cpp_representation as crep
+import adl_func_backend.cpplib.cpp_types as ctyp
 
 class dummy_emitter:
     def __init__ (self):
@@ -78,3 +80,110 @@ def test_get_rep_hidden():
     assert 10 is g.get_rep("dude")
     g.pop_scope()
     assert 5 is g.get_rep("dude")
+
+def test_event_statement_at_top():
+    s1 = statement.iftest("true")
+    s2 = statement.set_var("v1", "true")
+    s3 = statement.set_var("v2", "true")
+    g = generated_code()
+
+    g.add_statement(s1)
+    g.add_event_statement(s2)
+    g.add_event_statement(s3)
+
+    assert g._block._statements == [s2, s3, s1]
+    assert 0 == len(s1._statements)
+
+def test_event_statement_after_event_filter():
+    s1 = statement.block()
+    s2 = statement.block()
+    s3 = statement.block()
+    g = generated_code()
+
+    g.add_event_statement(s1)
+    g.add_event_filter(crep.cpp_value("!ok", g.current_scope(), "bool"))
+    g.add_statement(s2)
+    g.add_event_statement(s3)
+
+    st = g._block._statements
+    assert len(st) == 4
+    assert st[0] is s1
+    assert isinstance(st[1], statement.iftest)
+    assert st[2:] == [s3, s2]
+
+def test_event_rep_seen_everywhere():
+    g = generated_code()
+    s1 = statement.iftest("true")
+    g.add_statement(s1)
+    g.set_event_rep("dude", 5)
+    assert 5 is g.get_event_rep("dude")
+    assert 5 is g.get_rep("dude")
+
+def test_loop_invariant_scope_not_in_loop():
+    g = generated_code()
+    g.add_statement(statement.iftest("true"))
+    assert None is g.loop_invariant_scope(g.current_scope())
+
+def test_loop_invariant_scope_out_of_loop():
+    g = generated_code()
+    s_top = g.current_scope()
+    l = statement.loop(crep.cpp_value("j", None, None), crep.cpp_value("jets", None, None))
+    g.add_statement(l)
+    g.add_statement(statement.iftest("true"))
+    s = g.loop_invariant_scope(s_top)
+    assert s is not None
+    assert s.frame_statements(-1) is s_top.frame_statements(-1)
+
+def test_loop_invariant_scope_stays_in_if():
+    g = generated_code()
+    s_top = g.current_scope()
+    s1 = statement.iftest("true")
+    g.add_statement(s1)
+    g.add_statement(statement.loop(crep.cpp_value("j", None, None), crep.cpp_value("jets", None, None)))
+    s = g.loop_invariant_scope(s_top)
+    assert s.frame_statements(-1) is s1
+
+def test_add_statement_before_loop():
+    g = generated_code()
+    s_top = g.current_scope()
+    s1 = statement.set_var("v1", "true")
+    l = statement.loop(crep.cpp_value("j", None, None), crep.cpp_value("jets", None, None))
+    g.add_statement(s1)
+    g.add_statement(l)
+    s2 = statement.set_var("v2", "true")
+    g.add_statement_before_loop(g.loop_invariant_scope(s_top), s2)
+    assert g._block._statements == [s1, s2, l]
+
+def test_include_once():
+    g = generated_code()
+    g.add_include('xAODJet/JetContainer.h')
+    g.add_include('TH1.h')
+    g.add_include('xAODJet/JetContainer.h')
+    assert g.include_files() == ['xAODJet/JetContainer.h', 'TH1.h']
+
+def test_share_value_used_once():
+    g = generated_code()
+    v = g.share_value(crep.cpp_value("j->pt()", g.current_scope(), ctyp.terminal('double')), 'pt')
+    g.add_statement(statement.set_var(crep.cpp_value("a", None, None), v))
+    assert dummy_emitter().process(g.emit_query_code).Lines == ['{', 'a = j->pt();', '}']
+
+def test_share_value_used_twice():
+    g = generated_code()
+    value = crep.cpp_value("j->pt()", g.current_scope(), ctyp.terminal('double'))
+    v1 = g.share_value(value, 'pt')
+    v2 = g.share_value(value, 'pt')
+    assert v1 is v2
+    g.add_statement(statement.set_var(crep.cpp_value("a", None, None), v1))
+    g.add_statement(statement.set_var(crep.cpp_value("b", None, None), v2))
+    assert dummy_emitter().process(g.emit_query_code).Lines == \
+        ['{', 'double pt_value0 = j->pt();', 'a = pt_value0;', 'b = pt_value0;', '}']
+
+def test_no_finalize_code():
+    g = generated_code()
+    assert 0 == len(dummy_emitter().process(g.emit_finalize_code).Lines)
+    assert 0 == len(dummy_emitter().process(g.emit_constructor_code).Lines)
+
+def test_finalize_code():
+    g = generated_code()
+    g.add_finalize_statement(statement.set_var(crep.cpp_value("a", None, None), crep.cpp_value("1", None, None)))
+    assert dummy_emitter().process(g.emit_finalize_code).Lines == ['{', 'a = 1;', '}']
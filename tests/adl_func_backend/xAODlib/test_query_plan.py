@@ -0,0 +1,76 @@
+# Tests for planning queries for the generic query algorithm
+from adl_func_backend.cpplib.cpp_vars import unique_name_scope
+from adl_func_backend.xAODlib.atlas_xaod_executor import atlas_xaod_executor
+from adl_func_backend.xAODlib.query_plan import query_plan
+import adl_func_backend.xAODlib.result_handlers as rh
+from adl_func_client.event_dataset import EventDataset
+
+def jets():
+    return EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")')
+
+def plan(q):
+    with unique_name_scope():
+        return query_plan(atlas_xaod_executor().apply_ast_transformations(q.value(executor=lambda a: a)))
+
+def test_plan_single_column():
+    p, rep = plan(jets().Select('lambda j: j.pt()').AsROOTTTree('dude.root', 'forkme', 'JetPt'))
+    assert p.splitlines() == ['collection Jets AntiKt4EMTopoJets', 'tree forkme0', 'column JetPt double acc pt']
+    assert isinstance(rep, rh.cpp_ttree_rep)
+
+def test_plan_filter_and_columns():
+    p, rep = plan(jets()
+        .Where('lambda j: j.pt()/1000.0 > 30.0 and abs(j.eta()) < 2.5')
+        .Select('lambda j: (j.pt(), j.getAttributeFloat("EMFrac"))')
+        .AsPandasDF(['pt', 'emf']))
+    assert p.splitlines() == [
+        'collection Jets AntiKt4EMTopoJets',
+        'tree pandatree0',
+        'filter and gt div acc pt num 1000.0 num 30.0 lt abs acc eta num 2.5',
+        'column pt double acc pt',
+        'column emf float attr EMFrac']
+    assert isinstance(rep, rh.cpp_pandas_rep)
+
+def test_plan_filter_after_select():
+    p, _ = plan(jets()
+        .Select('lambda j: j.pt()*2.0')
+        .Where('lambda pt: not pt < 10.0')
+        .AsAwkwardArray(['pt']))
+    assert 'filter not lt mul acc pt num 2.0 num 10.0' in p.splitlines()
+    assert 'column pt double mul acc pt num 2.0' in p.splitlines()
+
+def test_plan_column_types():
+    p, _ = plan(jets()
+        .Select('lambda j: (j.pt()/1000.0, j.getAttributeFloat("EMFrac")*2.0, 2*j.eta(), j.pt() > 30.0)')
+        .AsPandasDF(['pt', 'emf', 'eta2', 'hard']))
+    types = {l.split()[1]: l.split()[2] for l in p.splitlines() if l.startswith('column')}
+    assert types == {'pt': 'double', 'emf': 'float', 'eta2': 'int', 'hard': 'bool'}
+
+def test_plan_parameter():
+    p, _ = plan(jets().Where('lambda j: j.pt() > Parameter("pt_cut", 30.0)').Select('lambda j: j.pt()').AsPandasDF(['pt']))
+    assert 'filter gt acc pt par pt_cut' in p.splitlines()
+
+def test_no_plan_for_event_values():
+    assert plan(EventDataset("file://root.root")
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Count()')
+        .AsPandasDF(['n'])) is None
+
+def test_no_plan_for_unknown_method():
+    assert plan(jets().Select('lambda j: j.jvt()').AsPandasDF(['jvt'])) is None
+
+def test_no_plan_for_other_collections():
+    assert plan(EventDataset("file://root.root")
+        .SelectMany('lambda e: e.Tracks("InDetTrackParticles")')
+        .Select('lambda t: t.pt()')
+        .AsPandasDF(['pt'])) is None
+
+def test_no_plan_for_histogram():
+    assert plan(jets().Select('lambda j: j.pt()').AsHistogram(50, 0.0, 500.0)) is None
+
+def test_no_plan_for_integer_division():
+    assert plan(jets().Select('lambda j: (j.pt(), j.eta()*(7/2))').AsPandasDF(['pt', 'eta'])) is None
+    assert plan(jets().Select('lambda j: 7').Select('lambda n: n/2').AsPandasDF(['half'])) is None
+
+def test_plan_for_double_division():
+    p, _ = plan(jets().Select('lambda j: (j.pt(), j.eta()*(7/2.0))').AsPandasDF(['pt', 'eta']))
+    assert 'column eta double mul acc eta div num 7.0 num 2.0' in p.splitlines()
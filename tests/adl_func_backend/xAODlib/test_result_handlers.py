@@ -0,0 +1,59 @@
+# Tests for reading the results of a query back
+import adl_func_backend.xAODlib.result_handlers as rh
+from adl_func_backend.xAODlib.util_scope import top_level_scope
+import pandas as pd
+
+class fake_root_file:
+    'Just enough of an uproot file to read a data frame back'
+    class source:
+        def close(self):
+            pass
+
+    class tree:
+        def __init__(self, df, numentries):
+            self.numentries = numentries
+            self.pandas = type('pandas', (), {'df': lambda _: df})()
+
+    def __init__(self, df, numentries):
+        self._context = type('context', (), {'source': fake_root_file.source()})
+        self._tree = fake_root_file.tree(df, numentries)
+
+    def __getitem__(self, name):
+        assert name == 'pandatree'
+        return self._tree
+
+class fake_uproot:
+    'Hand back a data frame for each run directory'
+    def __init__(self, files):
+        self._files = files
+
+    def open(self, url):
+        return self._files[url]
+
+def jagged_df(jet_pts):
+    'A data frame the way uproot reads back a jagged column: one row per jet, indexed by (entry, subentry)'
+    index = pd.MultiIndex.from_tuples([(e, s) for e, pts in enumerate(jet_pts) for s in range(len(pts))], names=['entry', 'subentry'])
+    return pd.DataFrame({'JetPt': [pt for pts in jet_pts for pt in pts]}, index=index)
+
+def test_pandas_shards_keep_entry_index(monkeypatch):
+    # The last event of the first shard has no jets, so it isn't in the data frame.
+    monkeypatch.setattr(rh, 'uproot', fake_uproot({
+        'file://run0/ANALYSIS.root': fake_root_file(jagged_df([[1.0, 2.0], [3.0], []]), 3),
+        'file://run1/ANALYSIS.root': fake_root_file(jagged_df([[4.0], [5.0, 6.0]]), 2),
+    }))
+    rep = rh.cpp_pandas_rep('ANALYSIS.root', 'pandatree', top_level_scope())
+    df = rh.extract_pandas_result(rep, ['run0', 'run1'])
+    assert list(df.index) == [(0, 0), (0, 1), (1, 0), (3, 0), (4, 0), (4, 1)]
+    assert list(df.index.names) == ['entry', 'subentry']
+    assert list(df.JetPt) == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+
+def test_pandas_shards_flat(monkeypatch):
+    flat = lambda pts: pd.DataFrame({'MET': pts}, index=pd.RangeIndex(len(pts), name='entry'))
+    monkeypatch.setattr(rh, 'uproot', fake_uproot({
+        'file://run0/ANALYSIS.root': fake_root_file(flat([1.0, 2.0]), 2),
+        'file://run1/ANALYSIS.root': fake_root_file(flat([3.0]), 1),
+    }))
+    rep = rh.cpp_pandas_rep('ANALYSIS.root', 'pandatree', top_level_scope())
+    df = rh.extract_pandas_result(rep, ['run0', 'run1'])
+    assert list(df.index) == [0, 1, 2]
+    assert list(df.MET) == [1.0, 2.0, 3.0]
@@ -1,5 +1,6 @@
 # Test the statement objects
-from adl_func_backend.xAODlib.statement import block, BlockException
+from adl_func_backend.xAODlib.statement import block, inline_block, set_var, BlockException
+from adl_func_backend.cpplib.cpp_representation import cpp_value
 # Looking up representations in blocks
 
 def test_create_top_level_block():
@@ -24,3 +25,16 @@ def test_set_rep_twice_fail():
         assert False
     except BlockException:
         pass
+
+def test_inline_block_has_no_brackets():
+    class emitter:
+        def __init__(self):
+            self.lines = []
+        def add_line(self, l):
+            self.lines.append(l)
+
+    b = inline_block()
+    b.add_statement(set_var(cpp_value("v1", None, None), cpp_value("1", None, None)))
+    e = emitter()
+    b.emit(e)
+    assert e.lines == ['v1 = 1;']
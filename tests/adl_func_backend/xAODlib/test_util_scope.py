@@ -5,7 +5,7 @@ from adl_func_backend.xAODlib.generated_code import generated_code
 import adl_func_backend.xAODlib.statement as statement
 import adl_func_backend.cpplib.cpp_types as ctyp
 import adl_func_backend.cpplib.cpp_representation as crep
-from adl_func_backend.xAODlib.util_scope import deepest_scope, gc_scope_top_level
+from adl_func_backend.xAODlib.util_scope import deepest_scope, dependency_scope, gc_scope_top_level
 
 def test_deepest_scope_one_greater():
     g = generated_code()
@@ -57,4 +57,42 @@ def test_top_level_starts_with_top_level():
     top1 = gc_scope_top_level()
     top2 = gc_scope_top_level()
 
-    assert top1.starts_with(top2)
\ No newline at end of file
+    assert top1.starts_with(top2)
+
+def test_dependency_scope_none():
+    assert dependency_scope([]).is_top_level()
+
+def test_dependency_scope_deepest():
+    g = generated_code()
+    g.add_statement(statement.iftest("true"))
+    scope_1 = g.current_scope()
+    g.add_statement(statement.iftest("true"))
+    scope_2 = g.current_scope()
+
+    v1 = crep.cpp_value("v1", scope_1, ctyp.terminal('int'))
+    v2 = crep.cpp_value("v2", scope_2, ctyp.terminal('int'))
+    v3 = crep.cpp_value("v3", gc_scope_top_level(), ctyp.terminal('int'))
+
+    assert dependency_scope([v1, v2, v3]) is scope_2
+    assert dependency_scope([v3, v2, v1]) is scope_2
+
+def test_dependency_scope_different_paths():
+    g = generated_code()
+    s = g.current_scope()
+    g.add_statement(statement.iftest("true"))
+    scope_1 = g.current_scope()
+    g.set_scope(s)
+    g.add_statement(statement.iftest("false"))
+    scope_2 = g.current_scope()
+
+    v1 = crep.cpp_value("v1", scope_1, ctyp.terminal('int'))
+    v2 = crep.cpp_value("v2", scope_2, ctyp.terminal('int'))
+
+    assert dependency_scope([v1, v2]) is None
+
+def test_scope_depth():
+    g = generated_code()
+    assert g.current_scope().depth() == 1
+    g.add_statement(statement.iftest("true"))
+    assert g.current_scope().depth() == 2
+    assert gc_scope_top_level().depth() == 0
@@ -10,8 +10,11 @@ def test_Aggregate_not_initial_const_SUM():
         .value(executor=exe_for_test)
     lines = get_lines_of_code(r)
     print_lines(lines)
+    # The value is calculated once, and used for both the first and the other jets.
     l_sets = find_line_numbers_with("/1000", lines)
-    assert 2 == len(l_sets)
+    assert 1 == len(l_sets)
+    value_var = lines[l_sets[0]].split()[1]
+    assert 3 == len(find_line_numbers_with(value_var, lines))
 
 def test_count_after_single_sequence():
     r = EventDataset("file://root.root") \
@@ -7,6 +7,7 @@ from adl_func_backend.xAODlib.util_scope import top_level_scope
 from tests.adl_func_backend.xAODlib.utils_for_testing import *
 from adl_func_client.event_dataset import EventDataset
 from adl_func_backend.cpplib.math_utils import DeltaR
+from adl_func_client.ObjectStream import batch
 import ast
 
 class Atlas_xAOD_File_Type:
@@ -260,3 +261,534 @@ def test_per_jet_with_matching_and_zeros_and_sum():
 
 
 
+
+def test_collection_retrieved_once_per_event():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()), e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.eta()))') \
+        .AsPandasDF(('JetPts', 'JetEta')) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len(find_line_numbers_with("evtStore()->retrieve", lines))
+
+def test_collection_retrieval_hoisted_out_of_loop():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Tracks("InDetTrackParticles").Count())') \
+        .AsPandasDF('NTracks') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_tracks = find_line_with('"InDetTrackParticles"', lines)
+    active_blocks = find_open_blocks(lines[:l_tracks])
+    assert 0 == ["for" in a for a in active_blocks].count(True)
+
+def test_different_collections_retrieved_separately():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Count(), e.Jets("AntiKt4LCTopoJets").Count())') \
+        .AsPandasDF(('n1', 'n2')) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    assert 2 == len(find_line_numbers_with("evtStore()->retrieve", lines))
+
+def test_collection_looped_inside_itself():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j1: e.Jets("AntiKt4EMTopoJets").Where(lambda j2: j2.pt() > j1.pt()).Count())') \
+        .AsPandasDF('NHarder') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len(find_line_numbers_with("evtStore()->retrieve", lines))
+    assert 2 == len(find_line_numbers_with("for (", lines))
+
+def test_columns_from_same_collection_share_a_loop():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()), e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.eta()))') \
+        .AsPandasDF(('JetPts', 'JetEta')) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len(find_line_numbers_with("for (", lines))
+    l_push_back = find_line_numbers_with("push_back", lines)
+    assert 2 == len(l_push_back)
+    assert all([len([l for l in find_open_blocks(lines[:pb]) if "for" in l])==1 for pb in l_push_back])
+
+def test_columns_with_same_filter_share_the_if():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30.0).Select(lambda j: j.pt()), e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30.0).Select(lambda j: j.eta()))') \
+        .AsPandasDF(('JetPts', 'JetEta')) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len(find_line_numbers_with("for (", lines))
+    assert 1 == len(find_line_numbers_with("if (", lines))
+
+def test_columns_with_different_filters_share_the_loop():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30.0).Select(lambda j: j.pt()), e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 40.0).Select(lambda j: j.eta()))') \
+        .AsPandasDF(('JetPts', 'JetEta')) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    assert 1 == len(find_line_numbers_with("for (", lines))
+    assert 2 == len(find_line_numbers_with("if (", lines))
+
+def test_count_shares_the_loop():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()), e.Jets("AntiKt4EMTopoJets").Count())') \
+        .AsPandasDF(('JetPts', 'NJets')) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len(find_line_numbers_with("for (", lines))
+    l_count = find_line_with("_NJets", lines)
+    assert 0 == ["for" in a for a in find_open_blocks(lines[:l_count])].count(True)
+
+def test_attribute_in_where_and_select_read_once():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: j.getAttributeFloat("JVT") > 0.5') \
+        .Select('lambda j: j.getAttributeFloat("JVT")') \
+        .AsPandasDF('JVT') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 1 == len(find_line_numbers_with("(*_moment_accessor", lines))
+
+def test_duplicate_attribute_columns_read_once():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: j.pt() > 30.0') \
+        .Select('lambda j: (j.getAttributeFloat("JVT"), j.getAttributeFloat("JVT")*2.0, j.getAttributeFloat("EMFrac"))') \
+        .AsPandasDF(('JVT', 'JVT2', 'EMFrac')) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 2 == len(find_line_numbers_with("(*_moment_accessor", lines))
+    l_fill = find_line_with("->Fill()", lines)
+    l_jvt = find_line_with("_JVT", lines)
+    assert l_jvt < l_fill
+    assert find_open_blocks(lines[:l_jvt]) == find_open_blocks(lines[:l_fill])
+
+def test_no_fusion_past_later_code():
+    # DeltaR is calculated after the first loop, so the last column can't be filled in that loop.
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()), DeltaR(1.0, 1.0, 1.0, 2.0), e.Jets("AntiKt4EMTopoJets").Select(lambda j: DeltaR(1.0, 1.0, 1.0, 2.0)))') \
+        .AsPandasDF(('JetPts', 'dr', 'JetDR')) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_dr = find_line_with("Phi_mpi_pi", lines)
+    l_push_back = find_line_with("_JetDR", lines)
+    assert l_dr < l_push_back
+
+def test_event_level_value_out_of_jet_loop():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: (j.pt(), e.EventInfo("EventInfo").eventNumber()))') \
+        .AsPandasDF(('JetPts', 'EventNumber')) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_number = find_line_with("->eventNumber()", lines)
+    assert 0 == ["for" in a for a in find_open_blocks(lines[:l_number])].count(True)
+
+def test_event_level_count_out_of_jet_loop():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: (j.pt(), e.Tracks("InDetTrackParticles").Where(lambda t: t.pt() > 1000.0).Count()))') \
+        .AsPandasDF(('JetPts', 'NTracks')) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_count = find_line_with("+1)", lines)
+    assert 1 == ["for" in a for a in find_open_blocks(lines[:l_count])].count(True)
+    l_fill = find_line_with("->Fill()", lines)
+    assert 1 == ["for" in a for a in find_open_blocks(lines[:l_fill])].count(True)
+
+def test_event_level_expression_out_of_jet_loop():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > e.EventInfo("EventInfo").runNumber()/1000.0).Select(lambda j: j.pt())') \
+        .AsPandasDF('JetPts') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_div = find_line_with("/1000.0", lines)
+    assert 0 == ["for" in a for a in find_open_blocks(lines[:l_div])].count(True)
+
+def test_jet_dependent_count_stays_in_jet_loop():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: e.Tracks("InDetTrackParticles").Where(lambda t: t.eta() > j.eta()).Count())') \
+        .AsPandasDF('NTracks') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_count = find_line_with("+1)", lines)
+    assert 2 == ["for" in a for a in find_open_blocks(lines[:l_count])].count(True)
+
+def test_outer_jet_attribute_out_of_inner_loop():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j1: e.Jets("AntiKt4EMTopoJets").Select(lambda j2: j1.getAttributeFloat("JVT")*j2.pt()))') \
+        .AsPandasDF('stuff') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_attr = find_line_with("(*_moment_accessor", lines)
+    assert 1 == ["for" in a for a in find_open_blocks(lines[:l_attr])].count(True)
+
+def test_event_level_where_protects_retrieved_value():
+    r = EventDataset("file://root.root") \
+        .Where('lambda e: e.Jets("AntiKt4EMTopoJets").Count() > 2') \
+        .Select('lambda e: e.EventInfo("EventInfo").runNumber()') \
+        .AsROOTTTree('root.root', 'analysis', 'RunNumber') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_skip = find_line_with("return StatusCode::SUCCESS;", lines)
+    assert l_skip < find_line_with('"EventInfo"', lines)
+    assert l_skip < find_line_with("->Fill()", lines)
+
+def test_first_breaks_out_of_loop():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").First().pt()') \
+        .AsROOTTTree('root.root', 'analysis', 'FirstJetPt') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_break = find_line_with("break;", lines)
+    assert 1 == ["for" in a for a in find_open_blocks(lines[:l_break])].count(True)
+    assert "is_first" in lines[l_break-2]
+
+def test_event_level_where_any():
+    r = EventDataset("file://root.root") \
+        .Where('lambda e: e.Jets("AntiKt4EMTopoJets").Any(lambda j: j.pt() > 50.0)') \
+        .Select('lambda e: e.EventInfo("EventInfo").runNumber()') \
+        .AsROOTTTree('root.root', 'analysis', 'RunNumber') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert find_line_with("bool any", lines) < find_line_with("for (", lines)
+    l_set = find_line_with("= true;", lines)
+    assert 1 == ["for" in a for a in find_open_blocks(lines[:l_set])].count(True)
+    assert "pt()>50.0" in find_open_blocks(lines[:l_set])[-1]
+    l_break = find_line_with("break;", lines)
+    assert 1 == ["for" in a for a in find_open_blocks(lines[:l_break])].count(True)
+    l_skip = find_line_with("return StatusCode::SUCCESS;", lines)
+    assert "if (!(any" in lines[l_skip-2]
+    assert l_break < l_skip
+    l_fill = find_line_with("->Fill()", lines)
+    assert l_skip < l_fill
+    assert 0 == ["for" in a for a in find_open_blocks(lines[:l_fill])].count(True)
+
+def test_all():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").All(lambda j: j.pt() > 50.0)') \
+        .AsROOTTTree('root.root', 'analysis', 'AllHard') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert "(true)" in lines[find_line_with("bool all", lines)]
+    assert "= false;" in lines[find_line_with("if (!(", lines) + 2]
+    l_break = find_line_with("break;", lines)
+    assert "if (!all" in lines[l_break-2]
+
+def test_take_pushes_elements_inside_count():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Take(2)') \
+        .Select('lambda j: j.pt()') \
+        .AsROOTTTree('root.root', 'analysis', 'JetPt') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_fill = find_line_with("->Fill()", lines)
+    assert "<2)" in find_open_blocks(lines[:l_fill])[-1]
+    l_break = find_line_with("break;", lines)
+    assert ">=2)" in lines[l_break-2]
+
+def test_early_exit_loop_not_fused():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Any(lambda j: j.pt() > 50.0), e.Jets("AntiKt4EMTopoJets").Count())') \
+        .AsROOTTTree('root.root', 'analysis', ['HasHardJet', 'NJets']) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 2 == len(find_line_numbers_with("for (", lines))
+    l_count = find_line_with("+1)", lines)
+    assert 0 == ["break" in l for l in lines[find_line_numbers_with("for (", lines)[1]:l_count]].count(True)
+
+def test_event_level_where_skips_event():
+    r = EventDataset("file://root.root") \
+        .Where('lambda e: e.EventInfo("EventInfo").runNumber() > 100') \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: j.pt()') \
+        .AsROOTTTree('root.root', 'analysis', 'JetPt') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_skip = find_line_with("return StatusCode::SUCCESS;", lines)
+    assert "runNumber()" in lines[l_skip-2]
+    assert l_skip < find_line_with('"AntiKt4EMTopoJets"', lines)
+    assert l_skip < find_line_with("for (", lines)
+
+def test_event_level_where_cheap_term_first():
+    r = EventDataset("file://root.root") \
+        .Where('lambda e: e.Jets("AntiKt4EMTopoJets").Count() > 2 and e.EventInfo("EventInfo").runNumber() > 100') \
+        .Select('lambda e: e.Tracks("InDetTrackParticles").Count()') \
+        .AsROOTTTree('root.root', 'analysis', 'NTracks') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_skips = find_line_numbers_with("return StatusCode::SUCCESS;", lines)
+    assert 2 == len(l_skips)
+    assert "runNumber()" in lines[l_skips[0]-2]
+    assert l_skips[0] < find_line_with('"AntiKt4EMTopoJets"', lines) < l_skips[1]
+    assert l_skips[1] < find_line_with('"InDetTrackParticles"', lines)
+
+def test_where_in_loop_not_skipping_event():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > 30.0)') \
+        .Select('lambda j: j.pt()') \
+        .AsROOTTTree('root.root', 'analysis', 'JetPt') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 0 == len(find_line_numbers_with("return", lines))
+
+def test_attribute_accessor_set_up_once():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: (j.getAttributeFloat("EMFrac"), j.getAttributeFloat("Width"), j.getAttributeFloat("EMFrac")*2)') \
+        .AsROOTTTree('root.root', 'analysis', ['EMFrac', 'Width', 'EMFrac2']) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 0 == len(find_line_numbers_with("getAttribute", lines))
+
+    book = dummy_emitter()
+    r.QueryVisitor.emit_book(book)
+    print_lines(book.Lines)
+    assert 1 == len(find_line_numbers_with('ConstAccessor<float>>("EMFrac")', book.Lines))
+    assert 1 == len(find_line_numbers_with('ConstAccessor<float>>("Width")', book.Lines))
+
+    accessors = [l for l in r.QueryVisitor.class_declaration_code() if 'ConstAccessor' in l]
+    assert 2 == len(accessors)
+    name = accessors[0].split()[-1][:-1]
+    assert 1 == len(find_line_numbers_with("(*{0})(*".format(name), lines))
+
+def test_attribute_vector_not_copied():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: j.getAttributeVectorFloat("EnergyPerSampling").Sum()') \
+        .AsROOTTTree('root.root', 'analysis', 'ESum') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert "const std::vector<double>& result = (*_moment_accessor" in lines[find_line_with("& result", lines)]
+    l_decl = find_line_with("const std::vector<double>* jet_vec_attrib", lines)
+    var = lines[l_decl].split()[-1][:-1]
+    assert "{0} = &result;".format(var) in lines[find_line_with("= &result;", lines)]
+    assert "*{0})".format(var) in lines[find_line_with("for (", lines[l_decl:]) + l_decl]
+
+def test_output_vector_reserved_before_loop():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: (e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt()), e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.eta() > 1.0).Select(lambda j: j.eta()))') \
+        .AsROOTTTree('root.root', 'analysis', ['JetPt', 'JetEta']) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_reserves = find_line_numbers_with(".reserve((*jets", lines)
+    assert 2 == len(l_reserves)
+    l_loop = find_line_with("for (", lines)
+    assert all(l < l_loop for l in l_reserves)
+    assert 0 == ["for" in a for a in find_open_blocks(lines[:l_reserves[0]])].count(True)
+
+def test_output_vector_not_reserved_in_inner_loop():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").SelectMany(lambda j: e.Tracks("InDetTrackParticles")).Select(lambda t: t.pt())') \
+        .AsROOTTTree('root.root', 'analysis', 'TrackPt') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    assert 0 == len(find_line_numbers_with(".reserve(", lines))
+
+def test_batch_one_event_loop():
+    ds = EventDataset("file://root.root")
+    q1 = ds.Where('lambda e: e.EventInfo("EventInfo").runNumber() > 100') \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: j.pt()') \
+        .AsPandasDF('JetPt')
+    q2 = ds.Select('lambda e: e.Jets("AntiKt4EMTopoJets").Count()') \
+        .AsROOTTTree('root.root', 'njets', 'NJets')
+    r = batch([q1, q2]).value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+
+    # The jets are only retrieved once, and the Where of one query does not stop the other.
+    assert 1 == len(find_line_numbers_with('"AntiKt4EMTopoJets"', lines))
+    assert 0 == len(find_line_numbers_with("return", lines))
+    l_fills = find_line_numbers_with("->Fill()", lines)
+    assert 2 == len(l_fills)
+    assert 1 == ["if" in a for a in find_open_blocks(lines[:l_fills[0]])].count(True)
+    assert 0 == ["if" in a for a in find_open_blocks(lines[:l_fills[1]])].count(True)
+
+    # Each query has its own tree, and its own result
+    book = dummy_emitter()
+    r.QueryVisitor.emit_book(book)
+    assert 2 == len(find_line_numbers_with("book (TTree", book.Lines))
+    reps = r.ResultRep.reps
+    assert [type(rep).__name__ for rep in reps] == ['cpp_pandas_rep', 'cpp_ttree_rep']
+    assert reps[0].treename != reps[1].treename
+    assert all('tree("{0}")->Fill()'.format(rep.treename) in lines[l] for rep, l in zip(reps, l_fills))
+
+def test_batch_event_filter_around_fill():
+    ds = EventDataset("file://root.root")
+    q = ds.Where('lambda e: e.EventInfo("EventInfo").runNumber() > 100') \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt())') \
+        .AsROOTTTree('root.root', 'analysis', 'JetPt')
+    q_other = ds.Select('lambda e: e.Jets("AntiKt4EMTopoJets").Count()') \
+        .AsROOTTTree('root.root', 'njets', 'NJets')
+
+    # Alone, the event is skipped before the tree is filled.
+    lines = get_lines_of_code(q.value(executor=exe_for_test))
+    print_lines(lines)
+    l_skip = find_line_with("return StatusCode::SUCCESS;", lines)
+    assert "runNumber()" in lines[l_skip-2]
+    l_fill = find_line_with('->Fill()', lines)
+    assert l_skip < l_fill
+    assert l_fill < find_line_with('.clear()', lines)
+
+    # In a batch, the tree is filled, and the vector cleared, inside the filter.
+    lines = get_lines_of_code(batch([q, q_other]).value(executor=exe_for_test))
+    print_lines(lines)
+    assert 0 == len(find_line_numbers_with("return", lines))
+    l_fill = find_line_numbers_with('->Fill()', lines)[0]
+    l_clear = find_line_with('.clear()', lines)
+    for l in [l_fill, l_clear]:
+        open_ifs = [b for b in find_open_blocks(lines[:l]) if "if" in b]
+        assert 1 == len(open_ifs)
+        assert "runNumber()" in open_ifs[0]
+
+def test_histogram_filled_in_loop():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Select('lambda j: j.pt()/1000.0') \
+        .AsHistogram(50, 0, 500) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    hist_var = r.QueryVisitor._gc._class_vars[0]
+    assert "TH1*" == str(hist_var.cpp_type())
+    l_fill = find_line_with("{0}->Fill(".format(hist_var.as_cpp()), lines)
+    assert 1 == ["for" in a for a in find_open_blocks(lines[:l_fill])].count(True)
+
+    book = dummy_emitter()
+    r.QueryVisitor.emit_book(book)
+    name = r.ResultRep.histname
+    book_lines = [l.strip() for l in book.Lines]
+    assert 'ANA_CHECK (book (TH1D ("{0}", "{0}", 50, 0.0, 500.0)));'.format(name) in book_lines
+    assert '{0} = hist ("{1}");'.format(hist_var.as_cpp(), name) in book_lines
+    assert "TH1.h" in r.QueryVisitor._gc.include_files()
+
+def test_histogram_each_element_of_collection():
+    r = EventDataset("file://root.root") \
+        .Select('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: j.pt())') \
+        .AsHistogram(50, 0, 500) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_fill = find_line_with("->Fill(", lines)
+    assert 1 == ["for" in a for a in find_open_blocks(lines[:l_fill])].count(True)
+    assert 0 == len(find_line_numbers_with("push_back", lines))
+
+def test_histogram_2D_weighted():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets").Select(lambda j: (j.pt(), j.eta(), e.EventInfo("EventInfo").mcEventWeight()))') \
+        .AsHistogram2D(50, 0, 500, 20, -4, 4, weight=True) \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    l_fill = find_line_with("->Fill(", lines)
+    assert lines[l_fill].count(",") == 2
+    assert "TH2*" == str(r.QueryVisitor._gc._class_vars[0].cpp_type())
+    book = dummy_emitter()
+    r.QueryVisitor.emit_book(book)
+    assert 1 == len(find_line_numbers_with("book (TH2D (", book.Lines))
+    assert 1 == len(find_line_numbers_with("= hist2d (", book.Lines))
+    assert 2 == r.ResultRep.n_axes
+
+def test_histogram_wrong_number_of_values():
+    try:
+        EventDataset("file://root.root") \
+            .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+            .Select('lambda j: j.pt()') \
+            .AsHistogram(50, 0, 500, weight=True) \
+            .value(executor=exe_for_test)
+        assert False
+    except BaseException as e:
+        assert "needs 2 values" in str(e)
+
+def test_count_events_written_at_finalize():
+    r = EventDataset("file://root.root") \
+        .Where('lambda e: e.Jets("AntiKt4EMTopoJets").Count() > 2') \
+        .Count() \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    n_var = r.QueryVisitor._gc._class_vars[0]
+    assert "long long" == str(n_var.cpp_type())
+    l_count = find_line_with("{0} = {0}+1;".format(n_var.as_cpp()), lines)
+    assert 0 == ["for" in a for a in find_open_blocks(lines[:l_count])].count(True)
+    assert 0 == len(find_line_numbers_with("Fill()", lines))
+
+    # Zeroed when the job starts, and written out once at the end.
+    book = dummy_emitter()
+    r.QueryVisitor.emit_book(book)
+    assert 1 == len(find_line_numbers_with("{0} = 0;".format(n_var.as_cpp()), book.Lines))
+    assert 1 == len(find_line_numbers_with("book (TTree", book.Lines))
+    final = dummy_emitter()
+    r.QueryVisitor.emit_finalize(final)
+    assert ['tree("{0}")->Fill();'.format(r.ResultRep.treename)] == [l.strip() for l in final.Lines if l not in '{}']
+    assert "Count" == r.ResultRep.operation
+
+def test_max_of_jets():
+    r = EventDataset("file://root.root") \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: j.pt() > 30.0') \
+        .Select('lambda j: j.eta()') \
+        .Max() \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    n_var, max_var = r.QueryVisitor._gc._class_vars
+    l_test = find_line_with("{0} == 0 ||".format(n_var.as_cpp()), lines)
+    assert ">{0})".format(max_var.as_cpp()) in lines[l_test]
+    assert "{0} = ".format(max_var.as_cpp()) in lines[l_test+2]
+    l_count = find_line_with("{0} = {0}+1;".format(n_var.as_cpp()), lines)
+    assert l_count > l_test
+    assert 1 == ["if" in a for a in find_open_blocks(lines[:l_test])].count(True)
+
+def test_sum_needs_numbers():
+    try:
+        EventDataset("file://root.root") \
+            .Select('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+            .Sum() \
+            .value(executor=exe_for_test)
+        assert False
+    except BaseException as e:
+        assert "Sum needs a sequence of numbers" in str(e)
+
+def test_parameter_is_algorithm_property():
+    r = EventDataset("file://root.root") \
+        .Where('lambda e: e.Jets("AntiKt4EMTopoJets").Where(lambda j: j.pt() > Parameter("pt_cut", 30.0)).Count() > 2') \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: j.pt() > Parameter("pt_cut", 30.0)') \
+        .Select('lambda j: j.pt()') \
+        .AsPandasDF('JetPt') \
+        .value(executor=exe_for_test)
+    lines = get_lines_of_code(r)
+    print_lines(lines)
+    param_vars = [v for v in r.QueryVisitor._gc._class_vars if v.as_cpp().startswith("_pt_cut")]
+    assert 1 == len(param_vars)
+    assert "double" == str(param_vars[0].cpp_type())
+    assert 2 == len(find_line_numbers_with(">{0})".format(param_vars[0].as_cpp()), lines))
+    assert 0 == len(find_line_numbers_with("30.0", lines))
+
+    ctor = dummy_emitter()
+    r.QueryVisitor.emit_constructor(ctor)
+    assert 1 == len(find_line_numbers_with('declareProperty("pt_cut", {0},'.format(param_vars[0].as_cpp()), ctor.Lines))
@@ -4,7 +4,7 @@
 from adl_func_backend.xAODlib.atlas_xaod_executor import atlas_xaod_executor
 from adl_func_backend.cpplib.cpp_representation import cpp_variable, cpp_sequence
 from adl_func_backend.xAODlib.util_scope import top_level_scope
-from adl_func_backend.util_LINQ import find_dataset
+from adl_func_backend.util_LINQ import find_datasets
 from adl_func_backend.xAODlib.ast_to_cpp_translator import query_ast_visitor
 
 import ast
@@ -31,9 +31,9 @@ class dummy_executor:
 def exe_for_test(a: ast.AST):
     'Dummy executor that will return the ast properly rendered'
     # Setup the rep for this filter
-    file = find_dataset(a)
     iterator = cpp_variable("bogus-do-not-use", top_level_scope(), cpp_type=None)
-    file.rep = cpp_sequence(iterator, iterator)
+    for file in find_datasets(a):
+        file.rep = cpp_sequence(iterator, iterator)
 
     # Use the dummy executor to process this, and return it.
     exe = dummy_executor()
@@ -73,3 +73,40 @@ async def test_2await_exe_from_coroutine():
     rpair = await asyncio.gather(r1, r2)
     assert isinstance(rpair[0], ast.AST)
     assert isinstance(rpair[1], ast.AST)
+
+def test_batch_query():
+    ds = EventDataset("file://junk.root")
+    q1 = ds.SelectMany("lambda e: e.jets()").Select("lambda j: j.pT()").AsROOTTTree("junk.root", "analysis", "jetPT")
+    q2 = ds.Select("lambda e: e.met()").AsPandasDF("met")
+    r = ObjectStream.batch([q1, q2])._ast
+    assert type(r).__name__ == "QueryBatch"
+    assert [type(q).__name__ for q in r.queries] == ["ResultTTree", "ResultPandasDF"]
+
+def test_batch_needs_terminals():
+    ds = EventDataset("file://junk.root")
+    with pytest.raises(BaseException):
+        ObjectStream.batch([ds.Select("lambda e: e.met()")])
+
+def test_batch_needs_queries():
+    with pytest.raises(BaseException):
+        ObjectStream.batch([])
+
+def test_histogram_binning():
+    r = EventDataset("file://junk.root").Select("lambda e: e.met()").AsHistogram(10, 0, 100)._ast
+    assert type(r).__name__ == "ResultHistogram"
+    assert r.binning == ((10, 0.0, 100.0),)
+    assert not r.weight
+
+def test_histogram_bad_binning():
+    ds = EventDataset("file://junk.root").Select("lambda e: e.met()")
+    with pytest.raises(BaseException):
+        ds.AsHistogram(0, 0, 100)
+    with pytest.raises(BaseException):
+        ds.AsHistogram2D(10, 0, 100, 10, 5, 5)
+
+def test_scalar_terminals():
+    ds = EventDataset("file://junk.root").Select("lambda e: e.met()")
+    for op in ['Count', 'Sum', 'Min', 'Max', 'Mean']:
+        r = getattr(ds, op)()._ast
+        assert type(r).__name__ == "ResultScalar"
+        assert r.operation == op
@@ -65,6 +65,10 @@ def test_good_file_urls():
 def test_root_good_file_urls():
     _ = EventDataset(['file:///data/test.root'])
 
+def test_several_file_urls_keep_order():
+    e = EventDataset(['file://test1.root', 'file:///data/test2.root'])
+    assert e.url == ['file:///test1.root', 'file:///data/test2.root']
+
 def test_good_grid_urls():
     _ = EventDataset(['gridds://mc16_13TeV.311309.MadGraphPythia8EvtGen_A14NNPDF31LO_HSS_LLP_mH125_mS5_ltlow.deriv.DAOD_EXOT15.e7270_e5984_s3234_r10201_r10210_p3795'])
 
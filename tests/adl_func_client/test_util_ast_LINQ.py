@@ -40,6 +40,34 @@ def test_First_in_func():
     ast_s = ast.dump(a)
     assert "First(source" in ast_s
 
+def test_Any_in_func():
+    a = get_ast("jets.Any(lambda j: j.pt() > 30.0)")
+    ast_s = ast.dump(a)
+    assert "AnyOf(source" in ast_s
+    assert "filter=Lambda" in ast_s
+
+def test_Any_no_filter():
+    a = get_ast("jets.Any()")
+    ast_s = ast.dump(a)
+    assert "AnyOf(source" in ast_s
+
+def test_All_in_func():
+    a = get_ast("jets.All(lambda j: j.pt() > 30.0)")
+    ast_s = ast.dump(a)
+    assert "AllOf(source" in ast_s
+
+def test_All_no_filter():
+    try:
+        get_ast("jets.All()")
+        assert False
+    except BaseException as e:
+        assert "All takes 1 argument(s), not 0" in str(e)
+
+def test_Take_in_func():
+    a = get_ast("jets.Take(2).Select(lambda j: j.pt())")
+    ast_s = ast.dump(a)
+    assert "Take(source" in ast_s
+
 def test_Select_in_func():
     a = get_ast("jets.Select(lambda x: j.pt())")
     ast_s = ast.dump(a)
@@ -77,4 +105,22 @@ def test_parse_as_ast_wrapped_lambda():
 def test_parse_as_ast_lambda():
     l = lambda_unwrap(ast.parse("lambda x: x + 1"))
     r = parse_as_ast(l)
-    assert isinstance(r, ast.Lambda)
\ No newline at end of file
+    assert isinstance(r, ast.Lambda)
+def test_Parameter_in_func():
+    a = get_ast("lambda j: j.pt() > Parameter('pt_cut', 30.0)")
+    ast_s = ast.dump(a)
+    assert "QueryParameter(name='pt_cut', value=30.0)" in ast_s
+
+def test_Parameter_bad_name():
+    try:
+        get_ast("lambda j: j.pt() > Parameter('pt cut', 30.0)")
+        assert False
+    except BaseException as e:
+        assert "valid identifier" in str(e)
+
+def test_Parameter_value_not_constant():
+    try:
+        get_ast("lambda j: j.pt() > Parameter('pt_cut', j.eta())")
+        assert False
+    except BaseException as e:
+        assert "must be constants" in str(e)
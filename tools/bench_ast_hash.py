@@ -0,0 +1,63 @@
+# Compare the cached structural hash of a query with hashing the full ast.dump of it.
+#
+# Usage: python tools/bench_ast_hash.py [n_columns] [n_files]
+import ast
+import hashlib
+import os
+import sys
+import timeit
+
+# Run from the repository, without installing it.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from adl_func_backend.ast.ast_hash import calc_ast_hash
+from adl_func_client.event_dataset import EventDataset
+
+def dump_hash(a: ast.AST) -> str:
+    'How the hash used to be calculated'
+    b = bytearray()
+    b.extend(map(ord, ast.dump(a)))
+    return hashlib.md5(b).hexdigest()
+
+def build_query(n_columns: int, n_files: int):
+    'A query with lots of columns over a dataset with lots of files'
+    ds = EventDataset([f'root://server.cern.ch//data/file_{i:05}.root' for i in range(n_files)])
+    columns = ', '.join(f'j.getAttributeFloat("moment_{i}")' for i in range(n_columns))
+    return ds \
+        .SelectMany('lambda e: e.Jets("AntiKt4EMTopoJets")') \
+        .Where('lambda j: j.pt() > 30.0') \
+        .Select(f'lambda j: ({columns})') \
+        .AsPandasDF([f'moment_{i}' for i in range(n_columns)]) \
+        .value(executor=lambda a: a)
+
+def timed(name: str, f, number: int):
+    t = timeit.timeit(f, number=number) / number
+    print(f'  {name:<40} {t*1000.0:10.3f} ms')
+
+def run(n_columns: int, n_files: int, number: int = 20):
+    print(f'Query with {n_columns} columns over {n_files} files:')
+    a = build_query(n_columns, n_files)
+
+    timed('ast.dump hash', lambda: dump_hash(a), number)
+
+    # The first structural hash has to visit everything.
+    timed('structural hash (first time)', lambda: calc_ast_hash(build_query(n_columns, n_files)), number)
+    timed('  (building the query alone)', lambda: build_query(n_columns, n_files), number)
+
+    # After that the whole hash is cached.
+    calc_ast_hash(a)
+    timed('structural hash (cached)', lambda: calc_ast_hash(a), number)
+
+    # Change the Where cut - only the path from there to the top is re-hashed.
+    where = a.source.source
+    cuts = [ast.parse(f'lambda j: j.pt() > {c}').body[0].value for c in [30.0, 40.0]]
+    def modify():
+        where.filter = cuts[0]
+        cuts.reverse()
+    timed('structural hash (after changing the cut)', lambda: (modify(), calc_ast_hash(a)), number)
+    timed('ast.dump hash (after changing the cut)', lambda: (modify(), dump_hash(a)), number)
+
+if __name__ == '__main__':
+    n_columns = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    n_files = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    run(n_columns, n_files)
@@ -0,0 +1,166 @@
+// Count the memory allocations per event made by the code we generate to fill the output
+// vectors, on a mock xAOD jet container. Compares the old way of filling (no reserve, copy
+// vector attributes out of the object) with what is generated now (reserve, bind vector
+// attributes by const reference).
+//
+// Usage: g++ -O2 -std=c++14 -o bench_fill_alloc tools/bench_fill_alloc.cxx && ./bench_fill_alloc [n_events] [max_jets]
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <memory>
+#include <new>
+#include <random>
+#include <string>
+#include <vector>
+
+// Count every allocation made in the process.
+static size_t n_allocations = 0;
+
+void* operator new(size_t size)
+{
+  ++n_allocations;
+  if (void* p = std::malloc(size)) {
+    return p;
+  }
+  throw std::bad_alloc();
+}
+
+void operator delete(void* p) noexcept
+{
+  std::free(p);
+}
+
+void operator delete(void* p, size_t) noexcept
+{
+  std::free(p);
+}
+
+// A jet, with a vector decoration (like EnergyPerSampling).
+struct MockJet {
+  double m_pt;
+  double m_eta;
+  std::vector<double> m_energy_per_sampling;
+
+  double pt() const { return m_pt; }
+  double eta() const { return m_eta; }
+  const std::vector<double>& energyPerSampling() const { return m_energy_per_sampling; }
+};
+
+// Like a DataVector: a vector of pointers to objects owned elsewhere.
+typedef std::vector<const MockJet*> MockJetContainer;
+
+// The class level output variables (as they are declared in the query class).
+struct Output {
+  std::vector<double> jet_pt;
+  std::vector<double> jet_eta;
+  std::vector<double> jet_e_sum;
+};
+
+// The events we will run over. Built before counting starts.
+std::vector<std::vector<MockJet>> make_events(int n_events, int max_jets)
+{
+  std::mt19937 rnd(1234);
+  std::uniform_int_distribution<int> n_jets(0, max_jets);
+  std::uniform_real_distribution<double> value(0.0, 100.0);
+  std::vector<std::vector<MockJet>> events(n_events);
+  for (auto& ev : events) {
+    ev.resize(n_jets(rnd));
+    for (auto& j : ev) {
+      j.m_pt = value(rnd);
+      j.m_eta = value(rnd) / 25.0 - 2.0;
+      j.m_energy_per_sampling.assign(24, value(rnd));
+    }
+  }
+  return events;
+}
+
+// What used to be generated: vectors grow as they are filled, and the vector attribute is copied.
+void fill_old(const MockJetContainer* jets, Output& out)
+{
+  for (auto i_obj : *jets) {
+    out.jet_pt.push_back(i_obj->pt());
+    if (i_obj->eta() > 1.0) {
+      out.jet_eta.push_back(i_obj->eta());
+    }
+    std::vector<double> e_sampling;
+    {
+      auto result = i_obj->energyPerSampling();
+      e_sampling = result;
+    }
+    double sum = 0.0;
+    for (auto e : e_sampling) {
+      sum = sum + e;
+    }
+    out.jet_e_sum.push_back(sum);
+  }
+}
+
+// What is generated now: room is made before the loop, and the vector attribute is not copied.
+void fill_new(const MockJetContainer* jets, Output& out)
+{
+  out.jet_pt.reserve((*jets).size());
+  out.jet_eta.reserve((*jets).size());
+  out.jet_e_sum.reserve((*jets).size());
+  for (auto&& i_obj : *jets) {
+    out.jet_pt.push_back(i_obj->pt());
+    if (i_obj->eta() > 1.0) {
+      out.jet_eta.push_back(i_obj->eta());
+    }
+    const std::vector<double>* e_sampling;
+    {
+      const std::vector<double>& result = i_obj->energyPerSampling();
+      e_sampling = &result;
+    }
+    double sum = 0.0;
+    for (auto&& e : *e_sampling) {
+      sum = sum + e;
+    }
+    out.jet_e_sum.push_back(sum);
+  }
+}
+
+// Run over all events, as the query would (fill, then clear the vectors for the next event).
+template <typename F>
+void run(const char* name, F fill, const std::vector<MockJetContainer>& containers)
+{
+  Output out;
+  size_t n_first = 0;
+  size_t n_start = n_allocations;
+  auto t_start = std::chrono::steady_clock::now();
+  for (size_t i = 0; i < containers.size(); i++) {
+    fill(&containers[i], out);
+    out.jet_pt.clear();
+    out.jet_eta.clear();
+    out.jet_e_sum.clear();
+    if (i == 99) {
+      n_first = n_allocations - n_start;
+    }
+  }
+  auto t_end = std::chrono::steady_clock::now();
+  size_t n_total = n_allocations - n_start;
+  double us = std::chrono::duration<double, std::micro>(t_end - t_start).count();
+  std::printf("  %-6s %12.3f allocations/event (%6.3f in the first 100 events) %10.3f us/event\n",
+    name, double(n_total) / containers.size(), double(n_first) / 100.0, us / containers.size());
+}
+
+int main(int argc, char** argv)
+{
+  int n_events = argc > 1 ? std::atoi(argv[1]) : 100000;
+  int max_jets = argc > 2 ? std::atoi(argv[2]) : 40;
+  if (n_events < 100) {
+    n_events = 100;
+  }
+
+  auto events = make_events(n_events, max_jets);
+  std::vector<MockJetContainer> containers(events.size());
+  for (size_t i = 0; i < events.size(); i++) {
+    for (auto& j : events[i]) {
+      containers[i].push_back(&j);
+    }
+  }
+
+  std::printf("%d events with up to %d jets:\n", n_events, max_jets);
+  run("old", fill_old, containers);
+  run("new", fill_new, containers);
+  return 0;
+}